@@ -1,7 +1,19 @@
-from . import dataset
-from . import schema
-from . import models
-from . import fields
-from . import utils
-from . import batchifiers
-from .registry import batchifier_classes, field_classes, field_model_classes
+import importlib
+
+# submodules and registries are only imported when first used, so that e.g. command-line tools
+# that don't need torch or scipy start quickly
+_submodules = ["batchifiers", "benchmarks", "cache", "checkpoint", "dataset", "ensemble", "fields", "memory", "models", "optimizers", "plan", "profiling",
+               "quantization", "registry", "schedulers", "schema", "search", "splitters", "synthetic", "tabular", "trainer", "utils"]
+_registry_names = ["batchifier_classes", "field_classes", "field_model_classes"]
+
+
+def __getattr__(name):
+    if name in _submodules:
+        return importlib.import_module("." + name, __name__)
+    elif name in _registry_names:
+        return getattr(importlib.import_module(".registry", __name__), name)
+    raise AttributeError("module '{}' has no attribute '{}'".format(__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals().keys()) + _submodules + _registry_names)
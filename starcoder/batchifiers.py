@@ -1,11 +1,10 @@
 import logging
 import random
 import numpy
-import scipy.sparse
-import torch
 import functools
 import argparse
-from starcoder.utils import Configurable, tensorize, split_batch, stack_batch
+from starcoder.utils import Configurable, stack_batch
+from starcoder import profiling
 
 
 logger = logging.getLogger(__name__)
@@ -31,8 +30,10 @@ class SampleEntities(Batchifier):
         while len(other_entities) > 0:
             indices = entities_to_duplicate + other_entities[:num_other_entities]
             other_entities = other_entities[num_other_entities:]
-            new_data = data.subselect_entities_by_index(indices)
-            comps = [new_data.component(i) for i in range(new_data.num_components)]
+            with profiling.stage("subselect", batchifier=type(self).__name__):
+                new_data = data.subselect_entities_by_index(indices)
+            with profiling.stage("components", batchifier=type(self).__name__):
+                comps = [new_data.component(i) for i in range(new_data.num_components)]
             retval = stack_batch(comps, data.schema)
             logger.debug("Returning batch of size %d", len(new_data))
             yield retval
@@ -58,16 +59,20 @@ class SampleComponents(Batchifier):
                 if len(this_batch) + len(indices) < num_other_entities_per_batch:
                     this_batch += indices
                 if len(this_batch) + len(indices) > num_other_entities_per_batch:
-                    new_data = data.subselect_entities_by_index(this_batch + indices[:num_other_entities_per_batch - len(this_batch)])
+                    with profiling.stage("subselect", batchifier=type(self).__name__):
+                        new_data = data.subselect_entities_by_index(this_batch + indices[:num_other_entities_per_batch - len(this_batch)])
                     this_batch = indices[num_other_entities_per_batch - len(this_batch):]
-                    comps = [new_data.component(i) for i in range(new_data.num_components)]
+                    with profiling.stage("components", batchifier=type(self).__name__):
+                        comps = [new_data.component(i) for i in range(new_data.num_components)]
                     retval = stack_batch(comps, data.schema)
                     #logger.info("Returning batch of size %d", len(new_data))
                     yield retval
         if len(this_batch) > 0:
-            new_data = data.subselect_entities_by_index(this_batch + indices[:num_other_entities_per_batch - len(this_batch)])
+            with profiling.stage("subselect", batchifier=type(self).__name__):
+                new_data = data.subselect_entities_by_index(this_batch + indices[:num_other_entities_per_batch - len(this_batch)])
             this_batch = indices[num_other_entities_per_batch - len(this_batch):]
-            comps = [new_data.component(i) for i in range(new_data.num_components)]
+            with profiling.stage("components", batchifier=type(self).__name__):
+                comps = [new_data.component(i) for i in range(new_data.num_components)]
             retval = stack_batch(comps, data.schema)
             #logger.info("Returning batch of size %d", len(new_data))            
             yield retval
@@ -89,34 +94,101 @@ class SampleSnowflakes(Batchifier):
         other_entities = data.subselect_entities_by_id(other_entities) #[i for i in range(len(data)) if i not in entities_to_duplicate])
         while len(other_entities) > 0:
             if len(other_entities) <= num_other_entities:
-                batch = data.subselect_entities_by_id(list(other_entities.id_to_index.keys()) + entities_to_duplicate)
+                with profiling.stage("subselect", batchifier=type(self).__name__):
+                    batch = data.subselect_entities_by_id(list(other_entities.id_to_index.keys()) + entities_to_duplicate)
                 other_entities = []
             else:
                 batch_entities = [] #[i for i in entities_to_duplicate]
                 other_components = [i for i in range(other_entities.num_components)]
                 random.shuffle(other_components)
                 while len(other_components) > 0:
-                    comp_ids = [data.index_to_id[i] for i in other_entities.component_indices(other_components[0])]
-                    comp_adjs = [x.todense() for x in other_entities.component_adjacencies(other_components[0]).values()]
+                    # hops are over the component's own (local) indices, so they're mapped back to ids through it
+                    comp_ids = [other_entities.index_to_id[i] for i in other_entities.component_indices(other_components[0])]
+                    comp_adjs = [numpy.asarray(x.todense()) for x in other_entities.component_adjacencies(other_components[0]).values()]
                     adjs = functools.reduce(lambda x, y : x | y, [numpy.full((len(comp_ids), len(comp_ids)), False)] + comp_adjs + [x.T for x in comp_adjs])
-                    seed_num = adjs.sum(1).argmax()
+                    seed_num = int(adjs.sum(1).argmax())
                     other_components = other_components[1:]
                     hops = []
                     hops.append([seed_num])
                     for depth in range(3):
-                        poss = numpy.argwhere(adjs[hops[-1]].any(0) == True)[:, 1].tolist()
+                        poss = numpy.argwhere(adjs[hops[-1]].any(0))[:, 0].tolist()
                         random.shuffle(poss)
                         hops.append(poss[:len(poss) // 2])
-                    nonshared_entities = [other_entities.index_to_id[i] for i in set(sum(hops, []))]
+                    nonshared_entities = [comp_ids[i] for i in set(sum(hops, []))]
                     batch_entities += nonshared_entities #[other_entities.index_to_id[i] for i in set(sum(hops, []))]
                 batch_entities = list(set(batch_entities))[0:num_other_entities] + entities_to_duplicate
 
-                batch = data.subselect_entities_by_id(batch_entities)
+                with profiling.stage("subselect", batchifier=type(self).__name__):
+                    batch = data.subselect_entities_by_id(batch_entities)
                 other_entities = other_entities.subselect_entities_by_id(batch_entities, invert=True)
-            comps = [batch.component(i) for i in range(batch.num_components)]
+            with profiling.stage("components", batchifier=type(self).__name__):
+                comps = [batch.component(i) for i in range(batch.num_components)]
             retval = stack_batch(comps, data.schema)                
             yield retval
-        
+
+
+
+class BudgetComponents(Batchifier):
+    """
+Forms batches of whole components to a memory budget, rather than a number of
+entities: each batch takes (shuffled) components for as long as its cost
+model predicts a training step on the batch, plus a "memory_margin" fraction
+for the model's error, stays within "memory_budget" bytes, and it has at most
+batch_size entities.  The cost model, a
+starcoder.memory.CostModel, is fit for a particular model by "calibrate" (or
+assigned to the "cost_model" attribute).  A component that's predicted to
+exceed the budget on its own gets a batch to itself.
+    """
+    arguments = [
+        {"dest" : "shared_entity_types", "nargs" : "*", "default" : [], "help" : "Entity types to be shared across batches"},
+        {"dest" : "memory_budget", "type" : float, "default" : 2**30, "help" : "Target peak memory of a training step, in bytes"},
+        {"dest" : "memory_margin", "type" : float, "default" : 0.1, "help" : "Fraction added to predictions, to allow for the cost model's error"},
+    ]
+    def __init__(self, rest):
+        super(BudgetComponents, self).__init__(rest)
+        self.cost_model = None
+
+    def calibrate(self, model, data, **args):
+        """
+        Fit the cost model by measuring training steps of the model on batches from the data
+        (see CostModel.calibrate for the other arguments).
+        """
+        # the cost model measures training steps, so it (and torch) is only imported when needed
+        from starcoder.memory import CostModel
+        self.cost_model = CostModel.calibrate(model, data, **args)
+        return self.cost_model
+
+    def _batch(self, data, indices):
+        with profiling.stage("subselect", batchifier=type(self).__name__):
+            new_data = data.subselect_entities_by_index(indices)
+        with profiling.stage("components", batchifier=type(self).__name__):
+            comps = [new_data.component(i) for i in range(new_data.num_components)]
+        return stack_batch(comps, data.schema)
+
+    def __call__(self, data, batch_size):
+        if self.cost_model == None:
+            raise Exception("BudgetComponents needs a cost model: call its calibrate method first")
+        entities_to_duplicate = data.get_type_indices(*self.shared_entity_types)
+        shared = set(entities_to_duplicate)
+        shared_summary = self.cost_model.summarize([data[i] for i in entities_to_duplicate])
+        other_entities = data.subselect_entities_by_index([i for i in range(len(data)) if i not in shared])
+        other_components = [i for i in range(other_entities.num_components)]
+        random.shuffle(other_components)
+        this_batch = []
+        summary = shared_summary
+        for component in other_components:
+            indices = [data.id_to_index[other_entities.index_to_id[i]] for i in other_entities.component_indices(component)]
+            component_summary = self.cost_model.summarize([data[i] for i in indices])
+            candidate = self.cost_model.combine(summary, component_summary)
+            if len(this_batch) > 0 and (candidate[0] > batch_size or (1.0 + self.memory_margin) * self.cost_model.predict(candidate) > self.memory_budget):
+                logger.debug("Returning batch of size %d, with predicted memory %d", summary[0], self.cost_model.predict(summary))
+                yield self._batch(data, this_batch + entities_to_duplicate)
+                this_batch = []
+                candidate = self.cost_model.combine(shared_summary, component_summary)
+            this_batch += indices
+            summary = candidate
+        if len(this_batch) > 0:
+            yield self._batch(data, this_batch + entities_to_duplicate)
 
 
 if __name__ == "__main__":
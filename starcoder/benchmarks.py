@@ -0,0 +1,310 @@
+import argparse
+import copy
+import json
+import logging
+import random
+import subprocess
+import sys
+import time
+import torch
+from starcoder.fields import CharacterField
+from starcoder.registry import encoder_classes, batchifier_classes
+from starcoder.schema import Schema
+from starcoder.dataset import Dataset
+from starcoder.ensemble import GraphAutoencoder, GraphAutoencoderEnsemble
+from starcoder.batchifiers import SampleComponents, BudgetComponents
+from starcoder.splitters import SampleComponents as SplitComponents
+from starcoder.trainer import Trainer
+from starcoder.utils import stack_batch
+from starcoder.profiling import time_calls
+from starcoder.synthetic import generate
+
+logger = logging.getLogger(__name__)
+
+
+# a small schema with a field of each common type and a many-to-one relation
+reference_spec = {
+    "meta" : {"id_field" : "id", "entity_type_field" : "entity_type"},
+    "data_fields" : {"name" : {"type" : "text"},
+                     "age" : {"type" : "numeric"},
+                     "role" : {"type" : "categorical"},
+                     "subject" : {"type" : "text"}},
+    "relation_fields" : {"sent_by" : {"source_entity_type" : "email", "target_entity_type" : "person"}},
+    "entity_types" : {"person" : {"data_fields" : ["name", "age", "role"]},
+                      "email" : {"data_fields" : ["subject"]}},
+}
+
+
+def reference_data(people=200, emails_per_person=4, seed=0, field_args={}):
+    """
+    Generate a Schema and Dataset for reference_spec, where each person sends a few emails
+    whose subjects draw on their role's vocabulary, so there's some signal to learn.  The
+    entries of "field_args" are added to the corresponding fields' specifications.
+    """
+    rng = random.Random(seed)
+    roles = {"engineer" : "build fix test deploy", "manager" : "plan meet review budget", "lawyer" : "contract review clause sign"}
+    entities = []
+    for i in range(people):
+        role = rng.choice(sorted(roles.keys()))
+        entities.append({"id" : "person{}".format(i),
+                         "entity_type" : "person",
+                         "name" : "".join([rng.choice("abcdefghij") for _ in range(rng.randint(3, 8))]),
+                         "age" : float(rng.randint(20, 70)),
+                         "role" : role})
+        for j in range(emails_per_person):
+            entities.append({"id" : "email{}_{}".format(i, j),
+                             "entity_type" : "email",
+                             "subject" : " ".join([rng.choice(roles[role].split()) for _ in range(rng.randint(1, 4))]),
+                             "sent_by" : "person{}".format(i)})
+    spec = copy.deepcopy(reference_spec)
+    for field_name, args in field_args.items():
+        spec["data_fields"][field_name].update(args)
+    schema = Schema(spec)
+    for entity in entities:
+        schema.observe_entity(entity)
+    return (schema, Dataset(schema, entities))
+
+
+def benchmark_text_encoders(batch_size=32, batches=3, median_length=400, max_length=4000, vocabulary_size=96, train=True, seed=0):
+    """
+    Compare the throughput of the encoders that can be used for text fields, on batches
+    of character sequences whose lengths follow a log-normal distribution resembling
+    email bodies (by default, a median of 400 characters with a long tail).
+    """
+    rng = random.Random(seed)
+    field = CharacterField("text", type="text")
+    alphabet = [chr(32 + i) for i in range(vocabulary_size)]
+    field.observe_value(alphabet)
+    data = []
+    for _ in range(batches):
+        lengths = [max(1, min(max_length, int(rng.lognormvariate(0.0, 1.0) * median_length))) for _ in range(batch_size)]
+        values = [field.encode([rng.choice(alphabet) for _ in range(l)]) for l in lengths]
+        data.append(torch.tensor([v + [0] * (max(lengths) - len(v)) for v in values]))
+    retval = {}
+    for name, encoder_class in encoder_classes.items():
+        encoder = encoder_class(field, torch.nn.ReLU)
+        encoder.train(train)
+        def run():
+            for x in data:
+                if train:
+                    encoder(x).sum().backward()
+                else:
+                    with torch.no_grad():
+                        encoder(x)
+        seconds = time_calls(run, 1)
+        retval[name] = {"seconds_per_batch" : seconds / batches,
+                        "entities_per_second" : (batches * batch_size) / seconds,
+                        "characters_per_second" : sum([(x != 0).sum().item() for x in data]) / seconds}
+        logger.info("Text encoder '%s': %.1f entities/second", name, retval[name]["entities_per_second"])
+    return retval
+
+
+def benchmark_precision(precisions=["float32", "bfloat16"], embeddings={"plain" : {}, "cutoffs" : {"embedding_cutoffs" : [2, 6]}}, epochs=5, batch_size=64, depth=1, seed=0):
+    """
+    Train identically-initialized models on the reference data at each precision, reporting
+    each one's final dev losses (overall and per field) alongside its training and inference
+    throughput, so the accuracy cost of lower precision can be weighed against its speed.
+    This is repeated for each entry of "embeddings", which is added to the specifications of
+    the fields with vocabularies (e.g. to use tiered embeddings), and results are by embeddings
+    and then precision.
+    """
+    retval = {}
+    for name, embedding_args in embeddings.items():
+        schema, data = reference_data(seed=seed, field_args={k : embedding_args for k in ["name", "role", "subject"]})
+        train_data = data.subselect_entities_by_index([i for i in range(len(data)) if i % 5 != 0])
+        dev_data = data.subselect_entities_by_index([i for i in range(len(data)) if i % 5 == 0])
+        torch.manual_seed(seed)
+        initial = GraphAutoencoder(schema, depth, [32, 16]).state_dict()
+        retval[name] = {}
+        for precision in precisions:
+            random.seed(seed)
+            model = GraphAutoencoder(schema, depth, [32, 16], precision=precision)
+            model.load_state_dict(initial)
+            trainer = Trainer(model, SampleComponents([]), batch_size=batch_size, early_stop=epochs, prefetch=0)
+            history = trainer.fit(train_data, dev_data, epochs)
+            dev_loss, dev_field_losses, dev_stats = trainer.evaluate(dev_data)
+            retval[name][precision] = {"dev_loss" : dev_loss,
+                                       "dev_field_losses" : dev_field_losses,
+                                       "train_entities_per_second" : sum([h["train_stats"]["entities_per_second"] for h in history]) / len(history),
+                                       "inference_entities_per_second" : dev_stats["entities_per_second"]}
+            logger.info("Precision '%s' with '%s' embeddings: dev loss=%.4f, %.1f training entities/second",
+                        precision,
+                        name,
+                        dev_loss,
+                        retval[name][precision]["train_entities_per_second"])
+    return retval
+
+
+def benchmark_pipeline(scales=[500, 1000, 2000], batch_size=128, batches=5, depth=1, seed=0, **generator_args):
+    """
+    Time each step of the pipeline on synthetic data (see starcoder.synthetic.generate, which
+    gets any additional keyword arguments) with each of the given numbers of entities: schema
+    observation, Dataset construction, splitting, a full pass of each batchifier, collating
+    one batch with stack_batch, and training and inference steps on the first few batches.
+    """
+    retval = {}
+    for scale in scales:
+        random.seed(seed)
+        torch.manual_seed(seed)
+        spec, entities = generate(entities=scale, seed=seed, **generator_args)
+        results = {}
+        start = time.perf_counter()
+        schema = Schema(spec)
+        for entity in entities:
+            schema.observe_entity(entity)
+        results["schema_seconds"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        data = Dataset(schema, entities)
+        results["dataset_seconds"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        train_indices, dev_indices = list(SplitComponents(["--proportions", "0.9", "0.1"])(data))
+        train_data = data.subselect_entities_by_index(train_indices)
+        dev_data = data.subselect_entities_by_index(dev_indices)
+        results["split_seconds"] = time.perf_counter() - start
+
+        model = GraphAutoencoder(schema, depth, [32, 16])
+        for name, batchifier_class in batchifier_classes.items():
+            batchifier = batchifier_class([])
+            if isinstance(batchifier, BudgetComponents):
+                batchifier.calibrate(model, train_data)
+            start = time.perf_counter()
+            count = len(list(batchifier(train_data, batch_size)))
+            seconds = time.perf_counter() - start
+            results["batchifier_{}".format(name)] = {"seconds" : seconds, "batches" : count, "entities_per_second" : len(train_data) / seconds}
+
+        components = [train_data.component(i) for i in range(train_data.num_components)]
+        batch_components = []
+        while len(batch_components) < len(components) and sum([len(c) for c, _ in batch_components]) < batch_size:
+            batch_components.append(components[len(batch_components)])
+        results["collate_seconds_per_batch"] = time_calls(lambda : stack_batch(batch_components, schema), 3)
+
+        trainer = Trainer(model, SampleComponents([]), batch_size=batch_size, prefetch=0)
+        train_batches = list(SampleComponents([])(train_data, batch_size))[:batches]
+        dev_batches = list(SampleComponents([])(dev_data, batch_size))[:batches]
+        def train_step():
+            for entities, adjacencies in train_batches:
+                output = model(entities, adjacencies)
+                trainer.loss_policy(trainer.compute_losses(entities, output), {}).backward()
+        def inference():
+            with torch.inference_mode():
+                for entities, adjacencies in dev_batches:
+                    model(entities, adjacencies)
+        for name, function, these_batches in [("train", train_step, train_batches), ("inference", inference, dev_batches)]:
+            seconds = time_calls(function, 1)
+            count = sum([len(e[schema.id_field.name]) for e, _ in these_batches])
+            results[name] = {"seconds_per_batch" : seconds / max(1, len(these_batches)), "entities_per_second" : count / seconds}
+        retval[str(scale)] = results
+        logger.info("Pipeline at %d entities: %s", scale, json.dumps(results))
+    return retval
+
+
+def benchmark_ensemble(members=5, epochs=1, batch_size=64, depth=1, seed=0):
+    """
+    Time training an ensemble of the given number of members on the reference data against
+    training as many separate models one after another, each with its own pass over the data.
+    """
+    schema, data = reference_data(seed=seed)
+    retval = {}
+    random.seed(seed)
+    ensemble = GraphAutoencoderEnsemble(schema, depth, [32, 16], members=members, seed=seed)
+    trainer = Trainer(ensemble, SampleComponents([]), batch_size=batch_size, prefetch=0)
+    stats = [trainer.train_epoch(data)[2] for _ in range(epochs)]
+    retval["ensemble"] = {"seconds" : sum([s["seconds"] for s in stats]), "data_seconds" : sum([s["data"] for s in stats])}
+    stats = []
+    for i in range(members):
+        random.seed(seed)
+        torch.manual_seed(seed + i)
+        trainer = Trainer(GraphAutoencoder(schema, depth, [32, 16]), SampleComponents([]), batch_size=batch_size, prefetch=0)
+        stats += [trainer.train_epoch(data)[2] for _ in range(epochs)]
+    retval["separate"] = {"seconds" : sum([s["seconds"] for s in stats]), "data_seconds" : sum([s["data"] for s in stats])}
+    retval["speedup"] = retval["separate"]["seconds"] / retval["ensemble"]["seconds"]
+    logger.info("Ensemble of %d: %.2fs (%.2fs data), separately: %.2fs (%.2fs data)",
+                members,
+                retval["ensemble"]["seconds"],
+                retval["ensemble"]["data_seconds"],
+                retval["separate"]["seconds"],
+                retval["separate"]["data_seconds"])
+    return retval
+
+
+def benchmark_startup(modules=["starcoder", "starcoder.registry", "starcoder.schema", "starcoder.dataset", "starcoder.ensemble", "starcoder.trainer"], repeats=3):
+    """
+    Time how long a fresh interpreter takes to import each module (the median of several
+    runs, minus that of an interpreter that imports nothing), as every command-line tool
+    and worker process pays this cost before doing anything.
+    """
+    def run(statement):
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, "-c", statement], check=True)
+            times.append(time.perf_counter() - start)
+        return sorted(times)[len(times) // 2]
+    interpreter = run("pass")
+    retval = {"interpreter_seconds" : interpreter}
+    for module in modules:
+        retval[module] = {"import_seconds" : max(0.0, run("import {}".format(module)) - interpreter)}
+        logger.info("Importing %s takes %.3f seconds", module, retval[module]["import_seconds"])
+    return retval
+
+
+def compare(results, baseline, tolerance=0.1, path=()):
+    """
+    Compare benchmark results against a baseline (e.g. the saved results from before a change),
+    returning (path, baseline, current, ratio) for every timing present in both, where the ratio
+    is the current value over the baseline's, along with whether it's a regression of more than
+    the tolerance (i.e. is slower, whether that means more seconds or fewer entities per second).
+    """
+    retval = []
+    if isinstance(results, dict) and isinstance(baseline, dict):
+        for k in results.keys():
+            if k in baseline:
+                retval += compare(results[k], baseline[k], tolerance, path + (k,))
+    elif isinstance(results, (int, float)) and isinstance(baseline, (int, float)) and baseline > 0:
+        name = path[-1]
+        if "seconds" in name or "per_second" in name:
+            ratio = results / baseline
+            slower = ratio < 1.0 - tolerance if "per_second" in name else ratio > 1.0 + tolerance
+            retval.append({"benchmark" : "/".join(path), "baseline" : baseline, "current" : results, "ratio" : ratio, "regression" : slower})
+    return retval
+
+
+benchmarks = {"text_encoders" : benchmark_text_encoders,
+              "precision" : benchmark_precision,
+              "pipeline" : benchmark_pipeline,
+              "startup" : benchmark_startup,
+              "ensemble" : benchmark_ensemble,
+}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmarks", nargs="*", default=list(benchmarks.keys()), help="Benchmarks to run")
+    parser.add_argument("-o", "--output", dest="output", help="Output file")
+    parser.add_argument("--threads", dest="threads", type=int, help="Number of intra-op threads")
+    parser.add_argument("--baseline", dest="baseline", help="Results file from an earlier run to compare against")
+    parser.add_argument("--comparison_output", dest="comparison_output", help="Output file for the comparison against the baseline")
+    parser.add_argument("--tolerance", dest="tolerance", type=float, default=0.1, help="Relative slowdown to report as a regression")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.threads != None:
+        torch.set_num_threads(args.threads)
+    results = {name : benchmarks[name]() for name in args.benchmarks}
+    if args.output:
+        with open(args.output, "wt") as ofd:
+            json.dump(results, ofd, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+    if args.baseline:
+        with open(args.baseline, "rt") as ifd:
+            comparison = compare(results, json.load(ifd), args.tolerance)
+        for item in comparison:
+            if item["regression"]:
+                logger.warning("Regression in %s: %.4g -> %.4g", item["benchmark"], item["baseline"], item["current"])
+        if args.comparison_output:
+            with open(args.comparison_output, "wt") as ofd:
+                json.dump(comparison, ofd, indent=2)
@@ -0,0 +1,129 @@
+import argparse
+import collections
+import logging
+import os
+import weakref
+import numpy
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def batch_bytes(batch):
+    """
+    The number of bytes the tensors and arrays in a batch (or any nesting of dictionaries,
+    lists and tuples of them) take up.
+    """
+    if isinstance(batch, torch.Tensor):
+        return batch.numel() * batch.element_size()
+    elif isinstance(batch, numpy.ndarray):
+        return batch.nbytes
+    elif isinstance(batch, dict):
+        return sum([batch_bytes(v) for v in batch.values()])
+    elif isinstance(batch, (list, tuple)):
+        return sum([batch_bytes(v) for v in batch])
+    return 0
+
+
+class BatchCache(object):
+    """
+A BatchCache keeps the batches prepared for a Dataset the first time it's
+passed over, and replays them on later passes, so e.g. evaluating on the same
+dev set every epoch only costs the forward passes.  Since the first pass's
+batches are replayed as they were, evaluation also sees the same batches every
+epoch, even with a batchifier that samples randomly.
+
+Batches are kept in memory, or if "directory" is given, saved there and loaded
+back as memory-mapped tensors.  With "max_bytes", the least-recently-used
+datasets' batches are evicted to keep the total (in memory or on disk) under
+the bound, and a dataset whose batches alone would exceed it isn't cached at
+all.  Datasets are told apart by identity and batch size, so the cache
+shouldn't outlive a Dataset that's modified in place.
+    """
+    def __init__(self, directory=None, max_bytes=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        # datasets too large to cache, held weakly (they aren't needed, unlike cached entries'
+        # datasets), with each key dropped once its dataset is collected and its id can be reused
+        self._uncacheable = {}
+        self._count = 0
+        if directory != None:
+            os.makedirs(directory, exist_ok=True)
+
+    @property
+    def total_bytes(self):
+        return sum([entry["bytes"] for entry in self._entries.values()])
+
+    def batches(self, data, batch_size, make_batches):
+        """
+        Iterate over the batches for the data: replayed from the cache, or from make_batches()
+        (which are cached along the way, if they fit).
+        """
+        key = (id(data), batch_size)
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._replay(self._entries[key])
+        elif key in self._uncacheable:
+            return make_batches()
+        return self._fill(key, data, make_batches())
+
+    def _replay(self, entry):
+        for batch in entry["batches"]:
+            yield torch.load(batch, mmap=True, weights_only=False) if self.directory != None else batch
+
+    def _fill(self, key, data, batches):
+        # the entry holds a reference to the data, so its id can't be reused while it's cached
+        entry = {"data" : data, "batches" : [], "bytes" : 0}
+        fits = True
+        try:
+            for batch in batches:
+                if fits:
+                    size = batch_bytes(batch)
+                    fits = self.max_bytes == None or entry["bytes"] + size <= self.max_bytes
+                    if fits:
+                        entry["bytes"] += size
+                        entry["batches"].append(self._store(batch))
+                yield batch
+        except BaseException:
+            # an interrupted pass leaves nothing behind
+            self._discard(entry)
+            raise
+        if not fits:
+            logger.info("Not caching batches for %d entities, which would take more than %d bytes", len(data), self.max_bytes)
+            self._discard(entry)
+            self._uncacheable[key] = weakref.ref(data, lambda _ : self._uncacheable.pop(key, None))
+            return
+        while self.max_bytes != None and len(self._entries) > 0 and self.total_bytes + entry["bytes"] > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            logger.info("Evicting cached batches for %d entities", len(evicted["data"]))
+            self._discard(evicted)
+        self._entries[key] = entry
+        logger.info("Cached %d batches (%d bytes) for %d entities", len(entry["batches"]), entry["bytes"], len(data))
+
+    def _store(self, batch):
+        if self.directory == None:
+            return batch
+        path = os.path.join(self.directory, "batch{}.pt".format(self._count))
+        self._count += 1
+        torch.save(batch, path)
+        return path
+
+    def _discard(self, entry):
+        if self.directory != None:
+            for path in entry["batches"]:
+                os.remove(path)
+
+    def clear(self):
+        for entry in self._entries.values():
+            self._discard(entry)
+        self._entries.clear()
+        self._uncacheable.clear()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", dest="input", help="Input file")
+    parser.add_argument("-o", "--output", dest="output", help="Output file")
+    args = parser.parse_args()
@@ -0,0 +1,180 @@
+import argparse
+import importlib
+import json
+import logging
+import os
+import shutil
+import threading
+import torch
+from starcoder.schema import Schema
+from starcoder.ensemble import GraphAutoencoder, GraphAutoencoderEnsemble
+
+logger = logging.getLogger(__name__)
+
+
+# A checkpoint is a directory holding these files, so that the schema and configuration can be
+# read (or edited) without torch, and the weights loaded without unpickling arbitrary objects:
+#
+#   schema.json: the schema's specification and its fields' vocabularies and statistics
+#   model.json: the model's class and constructor arguments, and any metadata (e.g. epoch and dev loss)
+#   model.pt: the model's state_dict
+#
+# The model can be a GraphAutoencoder or a GraphAutoencoderEnsemble (whose configuration is its
+# members', plus their number and seed).
+schema_file = "schema.json"
+config_file = "model.json"
+weights_file = "model.pt"
+
+
+def _to_json(v):
+    if isinstance(v, type):
+        return {"class" : "{}:{}".format(v.__module__, v.__qualname__)}
+    elif isinstance(v, torch.device):
+        return {"device" : str(v)}
+    return v
+
+
+def _from_json(v):
+    if isinstance(v, dict) and "class" in v:
+        module_name, attribute = v["class"].split(":")
+        return getattr(importlib.import_module(module_name), attribute)
+    elif isinstance(v, dict) and "device" in v:
+        return torch.device(v["device"])
+    return v
+
+
+def snapshot(model, **metadata):
+    """
+    Copy everything a checkpoint holds into memory (with the weights moved to the CPU), so
+    that it can be written out while the model continues to change.
+    """
+    return {"schema" : model.schema.state_dict(),
+            "model" : _to_json(type(model)),
+            "config" : {k : _to_json(v) for k, v in model.config.items()},
+            "metadata" : metadata,
+            "state_dict" : {k : v.detach().to(device="cpu", copy=True) for k, v in model.state_dict().items()}}
+
+
+def write_snapshot(path, state):
+    # written to a temporary directory and then moved into place, so an interrupted save never
+    # leaves a partial checkpoint where a complete one used to be
+    temporary = "{}.tmp".format(path)
+    shutil.rmtree(temporary, ignore_errors=True)
+    os.makedirs(temporary)
+    with open(os.path.join(temporary, schema_file), "wt") as ofd:
+        json.dump(state["schema"], ofd)
+    with open(os.path.join(temporary, config_file), "wt") as ofd:
+        json.dump({"model" : state["model"], "config" : state["config"], "metadata" : state["metadata"]}, ofd, indent=2)
+    torch.save(state["state_dict"], os.path.join(temporary, weights_file))
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(temporary, path)
+    logger.info("Saved checkpoint to %s", path)
+
+
+def save_checkpoint(path, model, **metadata):
+    write_snapshot(path, snapshot(model, **metadata))
+
+
+def load_checkpoint(path, mmap=False, device=None):
+    """
+    Rebuild a GraphAutoencoder or GraphAutoencoderEnsemble (and its Schema) from a checkpoint,
+    returning (model, metadata).
+    With mmap, the weights are memory-mapped from the file rather than read into memory.
+    """
+    with open(os.path.join(path, schema_file), "rt") as ifd:
+        schema = Schema.from_state_dict(json.load(ifd))
+    with open(os.path.join(path, config_file), "rt") as ifd:
+        saved = json.load(ifd)
+    model_classes = {_to_json(c)["class"] : c for c in [GraphAutoencoder, GraphAutoencoderEnsemble]}
+    # checkpoints from before ensembles could be saved don't name the class
+    model_class = saved.get("model", _to_json(GraphAutoencoder))["class"]
+    if model_class not in model_classes:
+        raise Exception("Checkpoint has unknown model class '{}'".format(model_class))
+    config = {k : _from_json(v) for k, v in saved["config"].items()}
+    if device != None:
+        config["device"] = torch.device(device)
+    model = model_classes[model_class](schema, **config)
+    state_dict = torch.load(os.path.join(path, weights_file), map_location=config["device"], mmap=mmap, weights_only=True)
+    model.load_state_dict(state_dict)
+    return (model, saved["metadata"])
+
+
+class CheckpointSaver(object):
+    """
+Saves checkpoints of a model in a background thread, so training isn't held up
+by writing to disk: the model is copied into memory when save() is called, and
+written out while training continues.  If several saves are requested while one
+is being written, only the most recent is written next.
+
+Calling a CheckpointSaver with (epoch, dev_loss) saves a checkpoint with that
+metadata, so it can be passed to Trainer.fit as "on_new_best":
+
+  saver = CheckpointSaver(model, "best_model")
+  trainer.fit(train_data, dev_data, max_epochs, on_new_best=saver)
+  saver.wait()
+    """
+    def __init__(self, model, path, background=True):
+        self.model = model
+        self.path = path
+        self.background = background
+        self._pending = None
+        self._condition = threading.Condition()
+        self._thread = None
+        self._writing = False
+        self._error = None
+
+    def __call__(self, epoch, dev_loss):
+        self.save(epoch=epoch, dev_loss=dev_loss)
+
+    def save(self, **metadata):
+        state = snapshot(self.model, **metadata)
+        if not self.background:
+            write_snapshot(self.path, state)
+            return
+        with self._condition:
+            self._pending = state
+            if self._thread == None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._condition.notify_all()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._pending == None:
+                    self._condition.wait()
+                state = self._pending
+                self._pending = None
+                self._writing = True
+            try:
+                write_snapshot(self.path, state)
+            except Exception as e:
+                logger.error("Could not save checkpoint to %s: %s", self.path, e)
+                self._error = e
+            with self._condition:
+                self._writing = False
+                self._condition.notify_all()
+
+    def wait(self):
+        """
+        Block until every requested checkpoint has been written, re-raising any error from writing one.
+        """
+        with self._condition:
+            while self._pending != None or self._writing:
+                self._condition.wait()
+        if self._error != None:
+            error, self._error = self._error, None
+            raise error
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", dest="input", help="Input checkpoint directory")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    model, metadata = load_checkpoint(args.input, mmap=True)
+    print(model.schema)
+    print("{} parameters, metadata: {}".format(model.parameter_count, json.dumps(metadata)))
@@ -1,24 +1,111 @@
-import pickle
-import re
-import sys
-import argparse
-import json
-import gzip
-import functools
-import random
 import logging
 import numpy
-import scipy.sparse
-from sklearn.metrics import f1_score, accuracy_score
-from scipy.sparse.csgraph import connected_components
-import torch
-import math
-import uuid
-from starcoder import fields
-from starcoder.schema import EncodedEntity, DecodedEntity
+from starcoder.schema import DecodedEntity
 
 logger = logging.getLogger(__name__)
 
+
+class EntityColumns(object):
+    """
+Entities stored column by column, as they come from tabular sources: each
+column is a list of values (None where missing), or for numeric fields a numpy
+array (NaN where missing), and columns are added in chunks of rows.  Indexing
+builds a DecodedEntity for one row on demand, so a Dataset can use an
+EntityColumns as its storage directly.  Subselecting rows ("take") and
+concatenating them keep to columns, so batches are assembled and encoded a
+column at a time (see starcoder.utils.stack_batch) without building entities.
+    """
+    def __init__(self):
+        self._chunks = []
+        self._columns = {}
+        self._length = 0
+        self._consolidated_length = 0
+
+    def append(self, chunk):
+        """
+        Add rows, given as a dictionary from field names to equal-length columns.
+        """
+        length = len(next(iter(chunk.values()))) if len(chunk) > 0 else 0
+        self._chunks.append((length, chunk))
+        self._length += length
+
+    def extend(self, other):
+        """
+        Add the rows of another EntityColumns (e.g. read from a table of a different entity type).
+        """
+        self._consolidate()
+        other._consolidate()
+        self.append(other._columns)
+
+    def _consolidate(self):
+        if len(self._chunks) == 0:
+            return
+        chunks = [(self._consolidated_length, self._columns)] + self._chunks
+        names = []
+        for _, chunk in chunks:
+            names += [k for k in chunk.keys() if k not in names]
+        columns = {}
+        for name in names:
+            arrays = [chunk[name] for _, chunk in chunks if name in chunk]
+            if all([isinstance(a, numpy.ndarray) for a in arrays]):
+                columns[name] = numpy.concatenate([chunk[name] if name in chunk else numpy.full((length,), numpy.nan) for length, chunk in chunks])
+            else:
+                columns[name] = [v for length, chunk in chunks for v in (list(chunk[name]) if name in chunk else [None] * length)]
+        self._columns = columns
+        self._chunks = []
+        self._consolidated_length = self._length
+
+    def take(self, indices):
+        """
+        A new EntityColumns with the given rows, in the given order.
+        """
+        self._consolidate()
+        array_indices = numpy.asarray(indices, dtype=numpy.int64)
+        retval = EntityColumns()
+        retval.append({k : column[array_indices] if isinstance(column, numpy.ndarray) else [column[i] for i in indices] for k, column in self._columns.items()})
+        return retval
+
+    @staticmethod
+    def concatenate(parts):
+        """
+        A new EntityColumns with the rows of each of the given ones, in order.
+        """
+        retval = EntityColumns()
+        for part in parts:
+            part._consolidate()
+            retval.append(part._columns)
+        retval._consolidate()
+        return retval
+
+    @property
+    def names(self):
+        self._consolidate()
+        return list(self._columns.keys())
+
+    def column(self, name):
+        self._consolidate()
+        return self._columns.get(name, [None] * len(self))
+
+    def __getitem__(self, index):
+        self._consolidate()
+        retval = DecodedEntity()
+        for k, column in self._columns.items():
+            v = column[index]
+            if isinstance(column, numpy.ndarray):
+                if not numpy.isnan(v):
+                    retval[k] = v.item()
+            elif v != None:
+                retval[k] = v
+        return retval
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
 class Dataset(object):
     """
     The Dataset class is needed mainly for operations that depend on
@@ -32,17 +119,22 @@ class Dataset(object):
         self._entity_fields = {}
         self.id_to_index = {}
         self.index_to_id = {}
+        self._edges = {}
+        if isinstance(entities, EntityColumns):
+            self._from_columns(entities)
+            return
         for idx, entity in enumerate(entities):
             #entity_type = entity[self._spec.entity_type_field]
             #entity_id = entity[self._spec.id_field]
             #assert (entity_id not in self._id_to_index), "The id field ('{}') must be unique".format(self._spec.id_field)
             self.id_to_index[entity[self.schema.id_field.name]] = idx
             self.index_to_id[idx] = entity[self.schema.id_field.name]
+            # the id field assigns each id a global integer code, shared by all Datasets over the same Schema
+            self.schema.id_field.observe_value(entity[self.schema.id_field.name])
             for k in entity.keys():
                 if k not in known_fields:
                     raise Exception("Unknown field: '{}'".format(k))
             self._entities.append(DecodedEntity(entity))            
-        self._edges = {}
         for entity in self._entities:
             entity_type = entity[self.schema.entity_type_field.name]
             if entity_type not in self.schema.entity_types:
@@ -50,18 +142,40 @@ class Dataset(object):
             entity_id = entity[self.schema.id_field.name]
             source_index = self.id_to_index[entity_id]            
             for relation_field in self.schema.entity_types[entity_type].relation_fields:
-                target_ids = entity.get(relation_field, [])
-                for target in target_ids if isinstance(target_ids, list) else [target_ids]:
-                    if target not in self.id_to_index:
-                        logger.debug("Could not find target %s for entity %s relation %s", target, entity_id, relation_field)
-                        continue
-                    target_index = self.id_to_index[target]
-                    self._edges[relation_field] = self._edges.get(relation_field, {})
-                    self._edges[relation_field][source_index] = self._edges[relation_field].get(source_index, [])
-                    self._edges[relation_field][source_index].append(target_index)
+                self._add_edges(relation_field, source_index, entity.get(relation_field, []))
         self._update_components()
 
+    def _from_columns(self, columns):
+        # the columns themselves are the storage, so entities are only built when they're accessed
+        for k in columns.names:
+            if k not in self.schema.all_fields:
+                raise Exception("Unknown field: '{}'".format(k))
+        self._entities = columns
+        for idx, entity_id in enumerate(columns.column(self.schema.id_field.name)):
+            self.id_to_index[entity_id] = idx
+            self.index_to_id[idx] = entity_id
+            self.schema.id_field.observe_value(entity_id)
+        entity_types = columns.column(self.schema.entity_type_field.name)
+        for relation_field, field in self.schema.relation_fields.items():
+            if relation_field in columns.names and field.source_entity_type in self.schema.entity_types:
+                for source_index, (entity_type, target_ids) in enumerate(zip(entity_types, columns.column(relation_field))):
+                    if target_ids != None and entity_type == field.source_entity_type:
+                        self._add_edges(relation_field, source_index, target_ids)
+        self._update_components()
+
+    def _add_edges(self, relation_field, source_index, target_ids):
+        for target in target_ids if isinstance(target_ids, list) else [target_ids]:
+            if target not in self.id_to_index:
+                logger.debug("Could not find target %s for entity %s relation %s", target, self.index_to_id[source_index], relation_field)
+                continue
+            target_index = self.id_to_index[target]
+            self._edges[relation_field] = self._edges.get(relation_field, {})
+            self._edges[relation_field][source_index] = self._edges[relation_field].get(source_index, [])
+            self._edges[relation_field][source_index].append(target_index)
+
     def get_type_indices(self, *type_names):
+        if isinstance(self._entities, EntityColumns):
+            return [i for i, t in enumerate(self._entities.column(self.schema.entity_type_field.name)) if t in type_names]
         retval = []
         for i in range(len(self)):
             if self._entities[i][self.schema.entity_type_field.name] in type_names:
@@ -69,6 +183,12 @@ class Dataset(object):
         return retval
     
     def subselect_entities_by_index(self, indices, invert=False):
+        if isinstance(self._entities, EntityColumns):
+            # columnar storage is subselected by column, without building entities
+            if invert:
+                excluded = set(indices)
+                indices = [i for i in range(len(self)) if i not in excluded]
+            return Dataset(self.schema, self._entities.take(indices))
         if invert:
             data = Dataset(self.schema, [self._entities[i] for i in range(len(self)) if i not in indices])
         else:
@@ -76,6 +196,11 @@ class Dataset(object):
         return data
 
     def subselect_entities_by_id(self, ids, invert=False):
+        if isinstance(self._entities, EntityColumns):
+            if invert:
+                excluded = set(ids)
+                return self.subselect_entities_by_index([i for i in range(len(self)) if self.index_to_id[i] not in excluded])
+            return self.subselect_entities_by_index([self.id_to_index[i] for i in ids])
         if invert:
             data = Dataset(self.schema, [self._entities[i] for i in range(len(self)) if self.index_to_id[i] not in ids])
         else:
@@ -83,6 +208,8 @@ class Dataset(object):
         return data    
 
     def subselect_components(self, indices):
+        if isinstance(self._entities, EntityColumns):
+            return self.subselect_entities_by_index([j for i in indices for j in self._components[i][0]])
         return Dataset(self.schema, [self._entities[j] for j in sum([self._components[i][0] for i in indices], [])])
     
     def encode(self, item):
@@ -92,6 +219,9 @@ class Dataset(object):
         return self.schema.decode(item)
 
     def _update_components(self):
+        # scipy is only needed here, and is slow to import, so it waits until a Dataset is built
+        import scipy.sparse
+        from scipy.sparse.csgraph import connected_components
         # create union adjacency matrix
         rows, cols, vals = [], [], []
         for _, rs in self._edges.items():
@@ -149,7 +279,13 @@ class Dataset(object):
         return self._components[i][1]
     
     def component(self, i):
+        """
+        The component's entities, as a list (or for columnar storage, an EntityColumns), and
+        a dictionary from relation names to its (sparse) adjacency matrices.
+        """
         entity_indices, adjacencies = self._components[i]
+        if isinstance(self._entities, EntityColumns):
+            return (self._entities.take(entity_indices), adjacencies.copy())
         entities = [self[i] for i in entity_indices]
         #assert all([len(entities) == v.shape[0] for v in adjacencies.values()])
         return (entities, adjacencies.copy())
@@ -1,27 +1,93 @@
-import pickle
-import re
-import sys
-import argparse
+import math
 import torch
-import json
-import numpy
-import scipy.sparse
-import gzip
-from torch.utils.data import DataLoader, Dataset
-import functools
-import numpy
-import random
+import torch.utils.checkpoint
 import logging
-from torch.optim import Adam, SGD
-from torch.optim.lr_scheduler import ReduceLROnPlateau
-from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
-import torch.nn.functional as F
-from starcoder.fields import NumericField, DistributionField, CategoricalField, SequentialField, IntegerField, DateField
-from starcoder.models import SingleSummarizer, Autoencoder, MLPProjector
-from starcoder.registry import field_model_classes, summarizer_classes, projector_classes
+from concurrent.futures import ThreadPoolExecutor
+from starcoder.models import SingleSummarizer, Autoencoder, MLPProjector, AdaptiveCategoricalDecoder, summarize_relation
+from starcoder.plan import ForwardPlan
+from starcoder import profiling
+from starcoder.registry import field_model_classes, encoder_classes, decoder_classes
 
 logger = logging.getLogger(__name__)
 
+
+# the data types GraphAutoencoder can run its components in, with None meaning no autocast
+precisions = {"float32" : None,
+              "bfloat16" : torch.bfloat16}
+
+
+class OutputSpec(object):
+    """
+An OutputSpec tells GraphAutoencoder.forward which of its outputs the caller
+actually needs, so the computation for everything else can be skipped:
+
+  fields: names of the data fields to reconstruct (None means all of them)
+  bottlenecks: whether to return the bottleneck representations
+  layer_losses: whether to compute each entity-type autoencoder's own reconstruction
+                loss (which is skipped entirely otherwise)
+  entity_types: names of the entity types to produce outputs for (None means
+                all of them), in which case reconstructions and bottlenecks
+                only have rows for entities of those types, aligned with the
+                id field of the reconstructions
+
+For instance, serving a classifier for one masked categorical field only needs
+OutputSpec(fields=["role"], bottlenecks=False, entity_types=["person"]).
+    """
+    def __init__(self, fields=None, bottlenecks=True, entity_types=None, layer_losses=False):
+        self.fields = fields
+        self.bottlenecks = bottlenecks
+        self.layer_losses = layer_losses
+        self.entity_types = entity_types
+
+
+class ForwardOutput(tuple):
+    """
+The output of GraphAutoencoder.forward: a (reconstructions, bottlenecks,
+layer_losses) tuple that also has those as named attributes, along with
+"field_masks", a dictionary from each data field's name to a boolean tensor of
+which (returned) entities had a value for the field in the input.
+
+The layer losses are a dictionary from (entity type name, depth) to that
+autoencoder's reconstruction loss for the batch, and are empty unless the
+OutputSpec asked for them (entity types with no entities in the batch have no
+entries).  "autoencoder_boundary_pairs" is an older name for them.
+    """
+    def __new__(cls, reconstructions, bottlenecks, layer_losses, field_masks):
+        retval = super(ForwardOutput, cls).__new__(cls, (reconstructions, bottlenecks, layer_losses))
+        retval.field_masks = field_masks
+        return retval
+    @property
+    def reconstructions(self):
+        return self[0]
+    @property
+    def bottlenecks(self):
+        return self[1]
+    @property
+    def layer_losses(self):
+        return self[2]
+    @property
+    def autoencoder_boundary_pairs(self):
+        return self[2]
+
+
+def _thread_pool(workers):
+    # each worker gets an equal share of the intra-op threads
+    threads_per_worker = max(1, torch.get_num_threads() // workers)
+    return ThreadPoolExecutor(max_workers=workers, initializer=torch.set_num_threads, initargs=(threads_per_worker,))
+
+
+def _pool_map(executor, device, function, items):
+    # gradient, inference and autocast modes are thread-local, so carry the caller's into the workers
+    grad_enabled = torch.is_grad_enabled()
+    inference_mode = torch.is_inference_mode_enabled()
+    autocast_enabled = torch.is_autocast_enabled(device.type)
+    autocast_dtype = torch.get_autocast_dtype(device.type)
+    def run(item):
+        with torch.inference_mode(inference_mode), torch.set_grad_enabled(grad_enabled), torch.autocast(device.type, dtype=autocast_dtype, enabled=autocast_enabled):
+            return function(item)
+    return list(executor.map(run, items))
+
+
 class GraphAutoencoder(torch.nn.Module):
     def __init__(self,
                  schema,
@@ -32,10 +98,49 @@ class GraphAutoencoder(torch.nn.Module):
                  activation=torch.nn.ReLU,
                  projected_size=None,
                  base_entity_representation_size=8,
-                 device=torch.device("cpu")):
+                 device=torch.device("cpu"),
+                 parallel_workers=0,
+                 sparse_embeddings=False,
+                 precision="float32",
+                 checkpoint_depths=False):
         """
+        With parallel_workers > 1, computations that are independent within a stage of the
+        forward pass (field encoders, the entity-type autoencoders at each depth, field decoders)
+        are dispatched concurrently to a pool of that many threads, each of which gets an equal
+        share of the intra-op threads.
+
+        With sparse_embeddings, field encoders' embedding tables produce sparse gradients, and
+        should be trained with e.g. starcoder.optimizers.SparseDenseOptimizer.
+
+        With precision "bfloat16", the field encoders, autoencoders, projectors and decoders
+        run under autocast to bfloat16, while the matrices they're assembled into, the returned
+        reconstructions and bottlenecks, and so the losses computed from them, stay float32.
+
+        With checkpoint_depths, each entity type's stage at each depth (relation summaries and
+        autoencoder) keeps only its inputs and outputs for the backward pass, and recomputes
+        its intermediate activations when gradients are needed, trading compute for memory on
+        deep models and large batches.
         """
         super(GraphAutoencoder, self).__init__()
+        # the constructor's arguments besides the schema, so that e.g. starcoder.checkpoint can rebuild the model
+        self.config = {"depth" : depth,
+                       "autoencoder_shapes" : autoencoder_shapes,
+                       "reverse_relations" : reverse_relations,
+                       "summarizers" : summarizers,
+                       "activation" : activation,
+                       "projected_size" : projected_size,
+                       "base_entity_representation_size" : base_entity_representation_size,
+                       "device" : device,
+                       "parallel_workers" : parallel_workers,
+                       "sparse_embeddings" : sparse_embeddings,
+                       "precision" : precision,
+                       "checkpoint_depths" : checkpoint_depths}
+        if precision not in precisions:
+            raise Exception("Unknown precision '{}' (should be one of {})".format(precision, ", ".join(precisions.keys())))
+        self.precision = precision
+        self.checkpoint_depths = checkpoint_depths
+        self.parallel_workers = parallel_workers
+        self._executor = None
         self.reverse_relations = reverse_relations
         self.schema = schema
         self.depth = depth
@@ -47,12 +152,22 @@ class GraphAutoencoder(torch.nn.Module):
         # An encoder for each field that turns its data type into a fixed-size representation
         self.field_encoders = {}
         for field_name, field_object in self.schema.data_fields.items():
-            field_type = type(field_object)
+            field_type = type(field_object).__name__
             if field_type not in field_model_classes:
                 raise Exception("There is no encoder architecture registered for field type '{}'".format(field_type))
-            self.field_encoders[field_name] = field_model_classes[field_type][0](field_object, activation)
+            encoder_class = field_model_classes[field_type][0]
+            if "encoder" in field_object.model_args:
+                if field_object.model_args["encoder"] not in encoder_classes:
+                    raise Exception("There is no encoder architecture registered with name '{}'".format(field_object.model_args["encoder"]))
+                encoder_class = encoder_classes[field_object.model_args["encoder"]]
+            encoder_args = dict(field_object.model_args)
+            encoder_args["sparse_embeddings"] = encoder_args.get("sparse_embeddings", sparse_embeddings)
+            self.field_encoders[field_name] = encoder_class(field_object, activation, **encoder_args)
         self.field_encoders = torch.nn.ModuleDict(self.field_encoders)
 
+        # Everything about the forward pass that doesn't depend on the batch, computed once
+        self._plan = ForwardPlan(self.schema, self.field_encoders, self.base_entity_representation_size, self.reverse_relations)
+
         # The size of an encoded entity is the sum of the base representation size and the encoded sizes of its possible fields        
         self.boundary_sizes = {}
         for entity_type in self.schema.entity_types.values():
@@ -106,10 +221,21 @@ class GraphAutoencoder(torch.nn.Module):
         self._field_decoders = {}
         self.field_losses = {}
         for field_name, field_object in self.schema.data_fields.items():
-            field_type = type(field_object)
+            field_type = type(field_object).__name__
+            if "decoder" in field_object.model_args:
+                if field_object.model_args["decoder"] not in decoder_classes:
+                    raise Exception("There is no decoder architecture registered with name '{}'".format(field_object.model_args["decoder"]))
+                decoder_class, loss_class = decoder_classes[field_object.model_args["decoder"]]
+                self._field_decoders[field_name] = decoder_class(field_object,
+                                                                 self.projected_size,
+                                                                 activation,
+                                                                 **field_object.model_args)
+                self.field_losses[field_name] = loss_class(field_object, self._field_decoders[field_name])
+                continue
             self._field_decoders[field_name] = field_model_classes[field_type][1](field_object,
                                                                                   self.projected_size,
-                                                                                  activation)
+                                                                                  activation,
+                                                                                  **field_object.model_args)
             self.field_losses[field_name] = field_model_classes[field_type][2](field_object)
         self._field_decoders = torch.nn.ModuleDict(self._field_decoders)
 
@@ -120,62 +246,68 @@ class GraphAutoencoder(torch.nn.Module):
     @property
     def parameter_count(self):
         return sum(p.numel() for p in self.parameters() if p.requires_grad)
+
+    def __getstate__(self):
+        # thread pools can't be pickled or copied, and are recreated on demand
+        state = self.__dict__.copy()
+        state["_executor"] = None
+        return state
+
+    def _map(self, function, items):
+        """
+        Apply the function to each item, concurrently if the model has parallel workers, and return the results in order.
+        """
+        if self.parallel_workers < 2 or len(items) < 2:
+            return [function(item) for item in items]
+        if self._executor == None:
+            self._executor = _thread_pool(self.parallel_workers)
+        return _pool_map(self._executor, self.device, function, items)
         
-    def forward(self, entities, adjacencies):
+    def _checkpoint(self, function, *argv):
+        if self.checkpoint_depths and torch.is_grad_enabled():
+            return torch.utils.checkpoint.checkpoint(function, *argv, use_reentrant=False)
+        return function(*argv)
+
+    def _autocast(self):
+        dtype = precisions[self.precision]
+        return torch.autocast(self.device.type, dtype=dtype or torch.float32, enabled=dtype != None)
+
+    def forward(self, entities, adjacencies, outputs=None):
         logger.debug("Starting forward pass")
-        num_entities = len(entities[self.schema.id_field.name])
-        entity_indices = {}
-        entity_masks = {}
-        field_indices = {}
-        field_masks = {}
-        entity_field_indices = {}
-        entity_field_masks = {}
-        autoencoder_boundary_pairs = []
+        with self._autocast():
+            retval = self._forward(entities, adjacencies, outputs)
+        if self.precision != "float32":
+            # losses are computed outside of autocast, so everything they might see is float32
+            retval = ForwardOutput({k : v.float() if v.is_floating_point() else v for k, v in retval.reconstructions.items()},
+                                   retval.bottlenecks,
+                                   retval.layer_losses,
+                                   retval.field_masks)
+        return retval
 
+    def _forward(self, entities, adjacencies, outputs):
+        outputs = OutputSpec() if outputs == None else outputs
+        for field_name in outputs.fields or []:
+            if field_name not in self.schema.data_fields:
+                raise Exception("Cannot reconstruct unknown field '{}'".format(field_name))
+        num_entities = len(entities[self.schema.id_field.name])
+        layer_losses = {}
         rev_adjacencies = {k : v.T for k, v in adjacencies.items()}
-        
-        logger.debug("Assembling entity, field, and (entity, field) indices")        
-        index_space = torch.arange(0, entities[self.schema.entity_type_field.name].shape[0], 1, device=self.device)
-        for field in self.schema.data_fields.values():
-            # FIXME: hack for RNNs            
-            if field.type_name in ["sequential", "text"]:
-                if entities[field.name].shape[1] == 0:
-                    field_masks[field.name] = torch.full((entities[field.name].shape[0],), False, device=self.device, dtype=torch.bool)
-                else:
-                    field_masks[field.name] = entities[field.name][:, 0] != 0
-            else:
-                field_masks[field.name] = ~torch.isnan(torch.reshape(entities[field.name], (entities[field.name].shape[0], -1)).sum(1))
-            field_indices[field.name] = index_space.masked_select(field_masks[field.name])
-            
-        for entity_type in self.schema.entity_types.values():
-            entity_masks[entity_type.name] = torch.tensor((entities[self.schema.entity_type_field.name] == entity_type.name), device=self.device)
-            entity_indices[entity_type.name] = index_space.masked_select(entity_masks[entity_type.name])
-            for field_name in entity_type.data_fields:
-                entity_field_masks[(entity_type.name, field_name)] = entity_masks[entity_type.name] & field_masks[field_name]
-                entity_field_indices[(entity_type.name, field_name)] = index_space.masked_select(entity_field_masks[(entity_type.name, field_name)])
-                
+
+        logger.debug("Assembling entity and field indices")
+        with profiling.stage("indices") as stage:
+            entity_indices = self._entity_indices(entities, num_entities)
+            field_masks, field_indices = self._field_indices(entities, num_entities)
+            stage.record(entity_indices, field_masks, field_indices)
+
         logger.debug("Encoding each input field to a fixed-length representation")
-        field_encodings = {}
-        for field in self.schema.data_fields.values():
-            field_encodings[field.name] = torch.full(size=(num_entities, self.field_encoders[field.name].output_size),
-                                                     fill_value=0.0,
-                                                     device=self.device)
-            indices = field_indices[field.name]
-            if len(indices) > 0:
-                field_values = torch.index_select(entities[field.name], 0, indices)
-                field_encodings[field.name][indices] = self.field_encoders[field.name](field_values).to(device=self.device)
-
-        logger.debug("Constructing entity-autoencoder inputs by concatenating field encodings")
+        encodings = self._encode_fields(entities, field_indices, num_entities)
+
+        logger.debug("Constructing entity-autoencoder inputs by selecting field encodings")
         autoencoder_inputs = {}
-        for entity_type in self.schema.entity_types.values():
-            #
-            # each appended value should have shape (entity_count x encoding_width)
-            #
-            autoencoder_inputs[entity_type.name] = [torch.zeros(size=(entity_indices[entity_type.name].shape[0], 8), dtype=torch.float32, device=self.device)]
-            for field_name in entity_type.data_fields:
-                autoencoder_inputs[entity_type.name].append(torch.index_select(field_encodings[field_name], 0, entity_indices[entity_type.name]))
-            autoencoder_inputs[entity_type.name].append(torch.zeros(size=(entity_indices[entity_type.name].shape[0], 0), dtype=torch.float32, device=self.device))
-            autoencoder_inputs[entity_type.name] = torch.cat(autoencoder_inputs[entity_type.name], 1)
+        with profiling.stage("assemble") as stage:
+            for i, (entity_type_name, _, _) in enumerate(self._plan.entity_types):
+                autoencoder_inputs[entity_type_name] = encodings.index_select(0, entity_indices[entity_type_name]).index_select(1, self._plan.columns(i))
+            stage.record(autoencoder_inputs)
 
         # always holds the most-recent autoencoder reconstructions
         autoencoder_outputs = {}
@@ -186,74 +318,146 @@ class GraphAutoencoder(torch.nn.Module):
         # zero-depth autoencoder
         depth = 0
         logger.debug("Running %d-depth autoencoder", depth)
-        for entity_type in self.schema.entity_types.values():
-            entity_outputs, bns, losses = self._entity_autoencoders[entity_type.name][0](autoencoder_inputs[entity_type.name])
+        entity_type_names = [entity_type_name for entity_type_name, _, _ in self._plan.entity_types]
+        def run(entity_type_name):
+            with profiling.stage("autoencoder", entity_type=entity_type_name, depth=depth) as stage:
+                retval = self._checkpoint(self._entity_autoencoders[entity_type_name][0], autoencoder_inputs[entity_type_name], outputs.layer_losses)
+                stage.record(retval)
+            return retval
+        results = self._map(run, entity_type_names)
+        for entity_type_name, (entity_outputs, bns, loss) in zip(entity_type_names, results):
+            if loss != None and len(entity_indices[entity_type_name]) > 0:
+                layer_losses[(entity_type_name, depth)] = loss
             if entity_outputs != None:
-                autoencoder_outputs[entity_type.name] = entity_outputs
+                autoencoder_outputs[entity_type_name] = entity_outputs
             if bns != None:
-                bottlenecks[entity_indices[entity_type.name]] = bns
+                bottlenecks[entity_indices[entity_type_name]] = bns.to(dtype=bottlenecks.dtype)
 
-        # n-depth autoencoders
-        prev_bottlenecks = bottlenecks.clone()
+        # relations at every depth read the zero-depth bottlenecks, so deeper autoencoders are only
+        # needed for the entity types whose outputs were asked for
+        if outputs.entity_types == None:
+            entity_types = self._plan.entity_types
+        else:
+            entity_types = [et for et in self._plan.entity_types if et[0] in outputs.entity_types]
+
+        # n-depth autoencoders (bottlenecks are detached, so the snapshot is plain data)
+        prev_bottlenecks = bottlenecks.clone() if self.depth > 0 else bottlenecks
         for depth in range(1, self.depth + 1):
             logger.debug("Running %d-depth autoencoder", depth)
-            for entity_type in self.schema.entity_types.values():
-                autoencoder_outputs[entity_type.name] = autoencoder_outputs[entity_type.name].narrow(1, 0, self._entity_autoencoders[entity_type.name][0].output_size)
-                other_reps = []
-                for rel_name in entity_type.relation_fields:
-                    summarize = self.relation_target_summarizers[rel_name]
-                    relation_reps = torch.zeros(size=(len(entity_indices[entity_type.name]), self.bottleneck_size), device=self.device)
-                    for i, index in enumerate(entity_indices[entity_type.name]):
-                        if rel_name not in adjacencies:
-                            continue
-                        related_indices = index_space.masked_select(adjacencies[rel_name][index])
-                        if len(related_indices) > 0:
-                            obns = torch.index_select(prev_bottlenecks, 0, related_indices)
-                            relation_reps[i] = summarize(obns)
-                    other_reps.append(relation_reps)
-                if self.reverse_relations:
-                    for rel_name in entity_type.reverse_relation_fields:
-                        summarize = self.relation_source_summarizers[rel_name]
-                        relation_reps = torch.zeros(size=(len(entity_indices[entity_type.name]), self.bottleneck_size), device=self.device)
-                        for i, index in enumerate(entity_indices[entity_type.name]):
-                            if rel_name not in adjacencies:
-                                continue
-                            related_indices = index_space.masked_select(adjacencies[rel_name][index])
-                            if len(related_indices) > 0:
-                                obns = torch.index_select(prev_bottlenecks, 0, related_indices)
-                                relation_reps[i] = summarize(obns)
-                        other_reps.append(relation_reps)
-                sh = list(autoencoder_outputs[entity_type.name].shape)
-                sh[1] = 0
-                other_reps = torch.cat(other_reps, 1) if len(other_reps) > 0 else torch.zeros(size=tuple(sh), device=self.device)
-                autoencoder_inputs[entity_type.name] = torch.cat([autoencoder_outputs[entity_type.name], other_reps], 1)
-                if depth > len(self._entity_autoencoders[entity_type.name]) - 1:
-                    logger.debug("At depth %d, while the model was trained for depth %d, so reusing final autoencoder",
-                                 depth + 1,
-                                 len(self._entity_autoencoders[entity_type.name]))
-                    entity_outputs, bns, losses = self._entity_autoencoders[entity_type.name][-1](autoencoder_inputs[entity_type.name])
-                else:
-                    entity_outputs, bns, losses = self._entity_autoencoders[entity_type.name][depth](autoencoder_inputs[entity_type.name])
-                autoencoder_outputs[entity_type.name] = entity_outputs
-                if entity_outputs.shape[1] != 0:
-                    bottlenecks[entity_indices[entity_type.name]] = bns
-                    
-                
-        logger.debug("Projecting autoencoder outputs so entities have the same representation size")
-        resized_autoencoder_outputs = torch.zeros(size=(num_entities, self.projected_size), device=self.device)
-        for entity_type_name, ae_output in autoencoder_outputs.items():
-            indices = entity_indices[entity_type_name]
-            resized_autoencoder_outputs[indices] = self._projectors[entity_type_name](ae_output)
-        
-        logger.debug("Reconstructing the input by applying decoders to the autoencoder output")
+            self._run_depth(depth, entity_types, autoencoder_outputs, bottlenecks, prev_bottlenecks, entity_indices, adjacencies, rev_adjacencies, layer_losses if outputs.layer_losses else None)
+
+        # the rows the caller gets back, in batch order
+        if outputs.entity_types == None:
+            selected = None
+        else:
+            selected = torch.sort(torch.cat([entity_indices[name] for name, _, _ in entity_types] + [torch.zeros(size=(0,), dtype=torch.int64, device=self.device)])).values
+        field_names = [field_name for field_name, _, _, _ in self._plan.fields if outputs.fields == None or field_name in outputs.fields]
         reconstructions = {}
-        for field in self.schema.data_fields.values():
-            reconstructions[field.name] = self._field_decoders[field.name](resized_autoencoder_outputs)
-        reconstructions[self.schema.id_field.name] = entities[self.schema.id_field.name]
-        reconstructions[self.schema.entity_type_field.name] = entities[self.schema.entity_type_field.name]
+        if len(field_names) > 0:
+            logger.debug("Projecting autoencoder outputs so entities have the same representation size")
+            resized_autoencoder_outputs = torch.zeros(size=(num_entities, self.projected_size), device=self.device)
+            for entity_type_name, _, _ in entity_types:
+                with profiling.stage("project", entity_type=entity_type_name) as stage:
+                    projected = self._projectors[entity_type_name](autoencoder_outputs[entity_type_name])
+                    resized_autoencoder_outputs[entity_indices[entity_type_name]] = projected.to(dtype=resized_autoencoder_outputs.dtype)
+                    stage.record(projected)
+            if selected != None:
+                resized_autoencoder_outputs = resized_autoencoder_outputs.index_select(0, selected)
+
+            logger.debug("Reconstructing the input by applying decoders to the autoencoder output")
+            def decode(field_name):
+                with profiling.stage("decode", field=field_name) as stage:
+                    retval = self._field_decoders[field_name](resized_autoencoder_outputs)
+                    stage.record(retval)
+                return retval
+            reconstructions = dict(zip(field_names, self._map(decode, field_names)))
+        for field in [self.schema.id_field, self.schema.entity_type_field]:
+            reconstructions[field.name] = entities[field.name] if selected == None else entities[field.name][selected.to(device=entities[field.name].device)]
+        if not outputs.bottlenecks:
+            bottlenecks = None
+        elif selected != None:
+            bottlenecks = bottlenecks.index_select(0, selected)
+        if selected != None:
+            field_masks = {k : v.index_select(0, selected) for k, v in field_masks.items()}
+
+        logger.debug("Returning reconstructions, bottlenecks, and autoencoder layer losses")
+        return ForwardOutput(reconstructions, bottlenecks, layer_losses, field_masks)
+
+    def _entity_indices(self, entities, num_entities):
+        # group entities by integer type code with one sort, rather than comparing against each type name
+        entity_type_codes = entities[self.schema.entity_type_field.name].to(device=self.device)
+        type_order = torch.argsort(entity_type_codes, stable=True)
+        type_counts = torch.bincount(entity_type_codes + 1, minlength=len(self.schema.entity_type_field) + 1)
+        type_groups = torch.split(type_order, type_counts.tolist())
+        return {entity_type_name : type_groups[code + 1] for entity_type_name, code, _ in self._plan.entity_types}
+
+    def _field_indices(self, entities, num_entities):
+        index_space = torch.arange(0, num_entities, 1, device=self.device)
+        field_masks = {}
+        field_indices = {}
+        for field_name, field_object, _, _ in self._plan.fields:
+            field_masks[field_name] = field_object.mask(entities[field_name]).to(device=self.device)
+            field_indices[field_name] = index_space.masked_select(field_masks[field_name])
+        return (field_masks, field_indices)
 
-        logger.debug("Returning reconstructions, bottlenecks, and autoencoder I/O pairs")
-        return (reconstructions, bottlenecks, autoencoder_boundary_pairs)
+    def _encode_fields(self, entities, field_indices, num_entities):
+        # each field's encodings are scattered into its own block of columns, after the (zero) base representation
+        def encode(field):
+            field_name, _, _, width = field
+            with profiling.stage("encode", field=field_name) as stage:
+                block = torch.zeros(size=(num_entities, width), device=self.device)
+                indices = field_indices[field_name]
+                if len(indices) > 0:
+                    field_values = torch.index_select(entities[field_name], 0, indices)
+                    block = block.index_copy(0, indices, self.field_encoders[field_name](field_values).to(device=self.device, dtype=block.dtype))
+                stage.record(block)
+            return block
+        blocks = [torch.zeros(size=(num_entities, self._plan.base_entity_representation_size), device=self.device)]
+        blocks += self._map(encode, self._plan.fields)
+        with profiling.stage("concatenate") as stage:
+            retval = torch.cat(blocks, 1)
+            stage.record(retval)
+        return retval
+
+    def _summarize(self, rel_name, reverse, prev_bottlenecks, indices, adjacencies, rev_adjacencies):
+        if rel_name not in adjacencies:
+            return torch.zeros(size=(indices.shape[0], self.bottleneck_size), device=self.device)
+        summarize = self.relation_source_summarizers[rel_name] if reverse else self.relation_target_summarizers[rel_name]
+        with profiling.stage("summarize", relation=rel_name, reverse=reverse) as stage:
+            adjacency = (rev_adjacencies if reverse else adjacencies)[rel_name].to(device=self.device).index_select(0, indices)
+            retval = summarize_relation(summarize, prev_bottlenecks, adjacency)
+            stage.record(retval)
+        return retval
+
+    def _run_depth(self, depth, entity_types, autoencoder_outputs, bottlenecks, prev_bottlenecks, entity_indices, adjacencies, rev_adjacencies, layer_losses=None):
+        def run(entity_type):
+            entity_type_name, _, relation_slots = entity_type
+            autoencoders = self._entity_autoencoders[entity_type_name]
+            indices = entity_indices[entity_type_name]
+            if depth > len(autoencoders) - 1:
+                logger.debug("At depth %d, while the model was trained for depth %d, so reusing final autoencoder",
+                             depth + 1,
+                             len(autoencoders))
+            # the previous outputs are passed in, rather than read from autoencoder_outputs, since a
+            # checkpointed stage is recomputed after the dictionary has moved on to later depths
+            def run_stage(previous_outputs, prev_bottlenecks):
+                autoencoder_input = [previous_outputs.narrow(1, 0, autoencoders[0].output_size)]
+                for rel_name, reverse in relation_slots:
+                    autoencoder_input.append(self._summarize(rel_name, reverse, prev_bottlenecks, indices, adjacencies, rev_adjacencies))
+                autoencoder_input = torch.cat(autoencoder_input, 1)
+                return autoencoders[min(depth, len(autoencoders) - 1)](autoencoder_input, layer_losses != None)
+            with profiling.stage("autoencoder", entity_type=entity_type_name, depth=depth) as stage:
+                retval = self._checkpoint(run_stage, autoencoder_outputs[entity_type_name], prev_bottlenecks)
+                stage.record(retval)
+            return retval
+        # the autoencoders only read the previous depth's state, so bottlenecks are written after they've all run
+        results = self._map(run, entity_types)
+        for (entity_type_name, _, _), (entity_outputs, bns, loss) in zip(entity_types, results):
+            if loss != None and len(entity_indices[entity_type_name]) > 0:
+                layer_losses[(entity_type_name, depth)] = loss
+            autoencoder_outputs[entity_type_name] = entity_outputs
+            if entity_outputs.shape[1] != 0:
+                bottlenecks[entity_indices[entity_type_name]] = bns.to(dtype=bottlenecks.dtype)
 
     # Recursively initialize model weights
     def init_weights(m):
@@ -261,3 +465,301 @@ class GraphAutoencoder(torch.nn.Module):
             torch.nn.init.xavier_uniform_(m.weight)
             m.bias.data.fill_(0.01)
     
+
+
+# fields whose decoders produce log-probabilities, which are combined by averaging the probabilities
+_distribution_field_types = ["CategoricalField", "SequentialField", "CharacterField", "DistributionField"]
+
+
+class EnsembleOutput(ForwardOutput):
+    """
+The output of GraphAutoencoderEnsemble.forward: a ForwardOutput combining the
+members' outputs, along with:
+
+  members: each member's own ForwardOutput
+  member_bottlenecks: the members' bottlenecks stacked into one
+                      (members x entities x bottleneck size) tensor
+  uncertainty: a dictionary from each reconstructed floating-point field's name
+               to a tensor with a value per entity of how much the members
+               disagree: for fields with distributions over values (e.g.
+               categorical), the mutual information between the prediction and
+               the member (the entropy of the averaged distribution minus the
+               average entropy), and for numeric fields, the variance
+
+The combined reconstructions average the members' probabilities for fields with
+distributions, and their values otherwise, while the bottlenecks are simply the
+members' mean (note that members' bottleneck spaces aren't aligned with each
+other, so for comparing entities, "similarities" is usually more meaningful).
+The layer losses are summed over the members.  Fields in "hidden" are ones
+whose members' outputs aren't values or distributions (an adaptive softmax
+decoder's hidden states, in training mode), so there's nothing to combine,
+and they're left out of the combined reconstructions and the uncertainty
+(the members' own outputs still have them, for their losses).
+    """
+    def __new__(cls, schema, members, hidden=[]):
+        reconstructions = {}
+        uncertainty = {}
+        for field_name, x in members[0].reconstructions.items():
+            if field_name in hidden:
+                continue
+            if not x.is_floating_point():
+                reconstructions[field_name] = x
+                continue
+            xs = torch.stack([m.reconstructions[field_name] for m in members])
+            field = schema.data_fields.get(field_name)
+            if field != None and type(field).__name__ in _distribution_field_types:
+                reconstructions[field_name] = torch.logsumexp(xs, 0) - math.log(len(members))
+                with torch.no_grad():
+                    entropy = -(reconstructions[field_name].exp() * reconstructions[field_name]).nansum(-1)
+                    member_entropy = -(xs.exp() * xs).nansum(-1).mean(0)
+                    uncertainty[field_name] = (entropy - member_entropy).reshape(x.shape[0], -1).mean(1)
+            else:
+                reconstructions[field_name] = xs.mean(0)
+                with torch.no_grad():
+                    uncertainty[field_name] = xs.var(0, unbiased=False).reshape(x.shape[0], -1).mean(1)
+        member_bottlenecks = None if members[0].bottlenecks == None else torch.stack([m.bottlenecks for m in members])
+        layer_losses = {}
+        for m in members:
+            for k, v in m.layer_losses.items():
+                layer_losses[k] = layer_losses[k] + v if k in layer_losses else v
+        retval = super(EnsembleOutput, cls).__new__(cls,
+                                                    reconstructions,
+                                                    None if member_bottlenecks == None else member_bottlenecks.mean(0),
+                                                    layer_losses,
+                                                    members[0].field_masks)
+        retval.members = members
+        retval.member_bottlenecks = member_bottlenecks
+        retval.uncertainty = uncertainty
+        return retval
+
+    def similarities(self):
+        """
+        The mean and standard deviation over members of the cosine similarity between each pair of
+        entities' bottlenecks, as (entities x entities) tensors: ranking by the mean is more stable
+        than by any one member, and the deviation shows how much each similarity can be trusted.
+        """
+        normalized = torch.nn.functional.normalize(self.member_bottlenecks.float(), dim=2)
+        similarities = torch.bmm(normalized, normalized.transpose(1, 2))
+        return (similarities.mean(0), similarities.std(0, unbiased=False))
+
+
+def _vectorizable(module):
+    # recurrent layers have no batching rule for vmap
+    return not any([isinstance(m, torch.nn.RNNBase) for m in module.modules()])
+
+
+def _stacked_call(modules, inputs, *args):
+    """
+    Apply identically-shaped modules, each to its own slice (along the first dimension) of the
+    inputs, as one vmapped call over their stacked parameters and buffers, with the remaining
+    arguments the same for every module.  Stacking is differentiable, so gradients reach each
+    module's own parameters.
+    """
+    named_parameters = [dict(m.named_parameters()) for m in modules]
+    named_buffers = [dict(m.named_buffers()) for m in modules]
+    parameters = {k : torch.stack([p[k] for p in named_parameters]) for k in named_parameters[0]}
+    buffers = {k : torch.stack([b[k] for b in named_buffers]) for k in named_buffers[0]}
+    # vmap can only return tensors, so the positions of None outputs (e.g. an autoencoder's loss
+    # that wasn't asked for) are noted, and they're put back afterwards
+    missing = []
+    def run(parameters, buffers, x):
+        retval = torch.func.functional_call(modules[0], (parameters, buffers), (x,) + args)
+        if not isinstance(retval, tuple):
+            return retval
+        missing[:] = [i for i, v in enumerate(retval) if not isinstance(v, torch.Tensor)]
+        return tuple([v for v in retval if isinstance(v, torch.Tensor)])
+    retval = torch.func.vmap(run)(parameters, buffers, inputs)
+    if isinstance(retval, tuple):
+        retval = list(retval)
+        for i in missing:
+            retval.insert(i, None)
+        retval = tuple(retval)
+    return retval
+
+
+class GraphAutoencoderEnsemble(torch.nn.Module):
+    """
+A GraphAutoencoderEnsemble is "members" GraphAutoencoders of the same shape
+(constructed with the same arguments, and with member i's weights initialized
+from seed + i if a seed is given) that all run on each batch, so training an
+ensemble shares a single data pipeline: batch selection, encoding and
+stack_batch happen once per batch rather than once per member.  The forward
+pass returns an EnsembleOutput, and a Trainer trains each member on its own
+reconstructions (so the reported losses are sums over the members).
+
+The forward pass is shared too: entity and field indices are computed once,
+and the members' activations are stacked along a leading dimension, so that
+each entity type's autoencoders and projector, and each field's decoder, run
+for all the members at once, vmapped over their stacked weights.  Field
+encoders, relation summaries and recurrent decoders, which can't be vmapped,
+run member by member (with member_workers > 1, concurrently in a pool of that
+many threads).  Each member's output matches what it would compute alone.
+    """
+    def __init__(self, schema, depth, autoencoder_shapes, members=5, seed=None, member_workers=0, **args):
+        super(GraphAutoencoderEnsemble, self).__init__()
+        replicas = []
+        for i in range(members):
+            if seed != None:
+                torch.manual_seed(seed + i)
+            replicas.append(GraphAutoencoder(schema, depth, autoencoder_shapes, **args))
+        self.members = torch.nn.ModuleList(replicas)
+        # the members' constructor arguments and the ensemble's own, so that e.g. starcoder.checkpoint can rebuild it
+        self.config = dict(replicas[0].config)
+        self.config.update({"members" : members, "seed" : seed, "member_workers" : member_workers})
+        self.schema = schema
+        self.depth = depth
+        self.member_workers = member_workers
+        self._executor = None
+
+    @property
+    def device(self):
+        return self.members[0].device
+
+    def cuda(self, name="cuda:0"):
+        for member in self.members:
+            member.cuda(name)
+
+    @property
+    def parameter_count(self):
+        return sum(p.numel() for p in self.parameters() if p.requires_grad)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_executor"] = None
+        return state
+
+    def _map(self, function, items):
+        if self.member_workers < 2 or len(items) < 2:
+            return [function(item) for item in items]
+        if self._executor == None:
+            self._executor = _thread_pool(self.member_workers)
+        return _pool_map(self._executor, self.device, function, items)
+
+    def forward(self, entities, adjacencies, outputs=None):
+        first = self.members[0]
+        with first._autocast():
+            members = self._forward(entities, adjacencies, OutputSpec() if outputs == None else outputs)
+        if first.precision != "float32":
+            # as for a single model, losses only see float32
+            members = [ForwardOutput({k : v.float() if v.is_floating_point() else v for k, v in m.reconstructions.items()},
+                                     m.bottlenecks,
+                                     m.layer_losses,
+                                     m.field_masks) for m in members]
+        # in training mode, adaptive softmax decoders output hidden states, for their losses
+        hidden = [k for k, v in first._field_decoders.items() if isinstance(v, AdaptiveCategoricalDecoder) and v.training]
+        return EnsembleOutput(self.schema, members, hidden)
+
+    def _autoencode(self, entity_type_name, depth, x, compute_loss):
+        # returns (members x ...) reconstructions and bottlenecks, and if compute_loss, the members' losses
+        autoencoders = [m._entity_autoencoders[entity_type_name][min(depth, len(m._entity_autoencoders[entity_type_name]) - 1)] for m in self.members]
+        return _stacked_call(autoencoders, x, compute_loss)
+
+    def _run_stage(self, entity_type, depth, compute_loss, indices, adjacencies, rev_adjacencies, previous_outputs, prev_bottlenecks):
+        # everything is passed in, since a checkpointed stage is recomputed after the forward pass has moved on
+        entity_type_name, _, relation_slots = entity_type
+        autoencoder_input = [previous_outputs.narrow(2, 0, self.members[0]._entity_autoencoders[entity_type_name][0].output_size)]
+        for rel_name, reverse in relation_slots:
+            summaries = self._map(lambda i : self.members[i]._summarize(rel_name, reverse, prev_bottlenecks[i], indices, adjacencies, rev_adjacencies), list(range(len(self.members))))
+            autoencoder_input.append(torch.stack(summaries))
+        return self._autoencode(entity_type_name, depth, torch.cat(autoencoder_input, 2), compute_loss)
+
+    def _forward(self, entities, adjacencies, outputs):
+        # mirrors GraphAutoencoder._forward, with each activation having a leading dimension for the members
+        first = self.members[0]
+        plan = first._plan
+        for field_name in outputs.fields or []:
+            if field_name not in self.schema.data_fields:
+                raise Exception("Cannot reconstruct unknown field '{}'".format(field_name))
+        num_members = len(self.members)
+        num_entities = len(entities[self.schema.id_field.name])
+        layer_losses = {}
+        rev_adjacencies = {k : v.T for k, v in adjacencies.items()}
+
+        with profiling.stage("indices") as stage:
+            entity_indices = first._entity_indices(entities, num_entities)
+            field_masks, field_indices = first._field_indices(entities, num_entities)
+            stage.record(entity_indices, field_masks, field_indices)
+
+        encodings = torch.stack(self._map(lambda member : member._encode_fields(entities, field_indices, num_entities), list(self.members)))
+        autoencoder_inputs = {}
+        with profiling.stage("assemble") as stage:
+            for i, (entity_type_name, _, _) in enumerate(plan.entity_types):
+                autoencoder_inputs[entity_type_name] = encodings.index_select(1, entity_indices[entity_type_name]).index_select(2, plan.columns(i))
+            stage.record(autoencoder_inputs)
+
+        autoencoder_outputs = {}
+        bottlenecks = torch.zeros(size=(num_members, num_entities, first.bottleneck_size), device=self.device)
+        for entity_type_name, _, _ in plan.entity_types:
+            with profiling.stage("autoencoder", entity_type=entity_type_name, depth=0) as stage:
+                entity_outputs, bns, loss = first._checkpoint(self._autoencode, entity_type_name, 0, autoencoder_inputs[entity_type_name], outputs.layer_losses)
+                stage.record(entity_outputs, bns)
+            if loss != None and len(entity_indices[entity_type_name]) > 0:
+                layer_losses[(entity_type_name, 0)] = loss
+            autoencoder_outputs[entity_type_name] = entity_outputs
+            bottlenecks[:, entity_indices[entity_type_name]] = bns.to(dtype=bottlenecks.dtype)
+
+        if outputs.entity_types == None:
+            entity_types = plan.entity_types
+        else:
+            entity_types = [et for et in plan.entity_types if et[0] in outputs.entity_types]
+
+        prev_bottlenecks = bottlenecks.clone() if self.depth > 0 else bottlenecks
+        for depth in range(1, self.depth + 1):
+            results = []
+            for entity_type in entity_types:
+                entity_type_name = entity_type[0]
+                with profiling.stage("autoencoder", entity_type=entity_type_name, depth=depth) as stage:
+                    results.append(first._checkpoint(self._run_stage,
+                                                     entity_type,
+                                                     depth,
+                                                     outputs.layer_losses,
+                                                     entity_indices[entity_type_name],
+                                                     adjacencies,
+                                                     rev_adjacencies,
+                                                     autoencoder_outputs[entity_type_name],
+                                                     prev_bottlenecks))
+                    stage.record(results[-1][:2])
+            # as for a single model, bottlenecks are written after every entity type has read the previous depth's
+            for (entity_type_name, _, _), (entity_outputs, bns, loss) in zip(entity_types, results):
+                if loss != None and len(entity_indices[entity_type_name]) > 0:
+                    layer_losses[(entity_type_name, depth)] = loss
+                autoencoder_outputs[entity_type_name] = entity_outputs
+                if entity_outputs.shape[2] != 0:
+                    bottlenecks[:, entity_indices[entity_type_name]] = bns.to(dtype=bottlenecks.dtype)
+
+        if outputs.entity_types == None:
+            selected = None
+        else:
+            selected = torch.sort(torch.cat([entity_indices[name] for name, _, _ in entity_types] + [torch.zeros(size=(0,), dtype=torch.int64, device=self.device)])).values
+        field_names = [field_name for field_name, _, _, _ in plan.fields if outputs.fields == None or field_name in outputs.fields]
+        reconstructions = {}
+        if len(field_names) > 0:
+            resized_autoencoder_outputs = torch.zeros(size=(num_members, num_entities, first.projected_size), device=self.device)
+            for entity_type_name, _, _ in entity_types:
+                with profiling.stage("project", entity_type=entity_type_name) as stage:
+                    projected = _stacked_call([m._projectors[entity_type_name] for m in self.members], autoencoder_outputs[entity_type_name])
+                    resized_autoencoder_outputs[:, entity_indices[entity_type_name]] = projected.to(dtype=resized_autoencoder_outputs.dtype)
+                    stage.record(projected)
+            if selected != None:
+                resized_autoencoder_outputs = resized_autoencoder_outputs.index_select(1, selected)
+            for field_name in field_names:
+                decoders = [m._field_decoders[field_name] for m in self.members]
+                with profiling.stage("decode", field=field_name) as stage:
+                    if _vectorizable(decoders[0]):
+                        reconstructions[field_name] = _stacked_call(decoders, resized_autoencoder_outputs)
+                    else:
+                        reconstructions[field_name] = torch.stack(self._map(lambda i : decoders[i](resized_autoencoder_outputs[i]), list(range(num_members))))
+                    stage.record(reconstructions[field_name])
+        if selected != None:
+            field_masks = {k : v.index_select(0, selected) for k, v in field_masks.items()}
+            bottlenecks = bottlenecks.index_select(1, selected)
+        retval = []
+        for i in range(num_members):
+            member_reconstructions = {k : v[i] for k, v in reconstructions.items()}
+            for field in [self.schema.id_field, self.schema.entity_type_field]:
+                member_reconstructions[field.name] = entities[field.name] if selected == None else entities[field.name][selected.to(device=entities[field.name].device)]
+            retval.append(ForwardOutput(member_reconstructions,
+                                        bottlenecks[i] if outputs.bottlenecks else None,
+                                        {k : v[i] for k, v in layer_losses.items()},
+                                        field_masks))
+        return retval
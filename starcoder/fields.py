@@ -1,15 +1,28 @@
+import collections
 import numpy
 import math
 import time
 import calendar
-import torch
+import sys
+import threading
 import logging
 
 logger = logging.getLogger(__name__)
 
+
+# torch is only imported where tensors are built or masked, so schemas can be built and data split
+# without loading it: a value can only be a tensor if something else has already imported torch
+def _is_tensor(v):
+    torch = sys.modules.get("torch")
+    return torch != None and isinstance(v, torch.Tensor)
+
+
 class Missing(object):
     pass
 
+class Unknown(object):
+    pass
+
 class Padding(object):
     pass
 
@@ -20,7 +33,15 @@ class Field(object):
     """
 Field objects represent a type with particular semantics and its canonical
 representation.
+
+What a field has learned from observing values can be saved with state_dict()
+and restored into a newly-constructed field of the same specification with
+load_state_dict(), without observing the values again.  Vocabularies are saved
+as lists of values in code order (with None for the sentinels, such as Missing,
+that a new field creates for itself), and counts as lists in the same order.
     """
+    # attributes (besides vocabularies) that state_dict and load_state_dict save and restore
+    state_attributes = ["empty"]
     def __init__(self, name, **args):
         self.name = name
         self.type_name = args["type"]
@@ -31,11 +52,46 @@ representation.
         return v
     def decode(self, v):
         return v
+    def encode_values(self, vs):
+        """
+        Encode a column of values (with None for missing values) at once, which subclasses may do faster than one at a time.
+        """
+        return [None if v == None else self.encode(v) for v in vs]
     def observe_value(self, v):        
         self.empty = False
         return self._observe_value(v)
     def _observe_value(self, v):
         return v
+    def observe_values(self, vs):
+        """
+        Observe a column of (non-missing) values at once, which subclasses may do faster than one at a time.
+        """
+        for v in vs:
+            self.observe_value(v)
+    def state_dict(self):
+        retval = {k : getattr(self, k) for k in self.state_attributes}
+        if hasattr(self, "_rlookup"):
+            values = [None] * len(self._rlookup)
+            for i, v in self._rlookup.items():
+                values[i] = None if isinstance(v, (Missing, Unknown)) else v
+            retval["values"] = values
+        if hasattr(self, "_counts"):
+            retval["counts"] = [self._counts.get(i, 0) for i in range(len(self._rlookup))]
+        if hasattr(self, "_pending"):
+            retval["pending"] = [[v, c] for v, c in self._pending.items()]
+        return retval
+    def load_state_dict(self, state):
+        for k in self.state_attributes:
+            setattr(self, k, state[k])
+        if "values" in state:
+            # a new field already has its sentinels (and e.g. declared entity types), which come first
+            for i in range(len(self._rlookup), len(state["values"])):
+                self._lookup[state["values"][i]] = i
+                self._rlookup[i] = state["values"][i]
+        if "counts" in state:
+            self._counts = {i : c for i, c in enumerate(state["counts"])}
+        if "pending" in state:
+            self._pending = {v : c for v, c in state["pending"]}
     
 class MetaField(Field):
     def __init__(self, name, **args):
@@ -47,11 +103,77 @@ class MetaField(Field):
     def _observe_value(self, v):
         pass
         
+def count_observation(field, v):
+    """
+    Count an observation of a value for a field with "_lookup", "_rlookup", "_counts" and
+    "_pending" dictionaries, giving the value the next code once it has been seen "min_count"
+    times.  Until then, its observations are counted toward the field's unknown value.
+    """
+    if v not in field._lookup:
+        count = field._pending.get(v, 0) + 1
+        if count < field.min_count:
+            field._pending[v] = count
+            field._counts[field.unknown_value] = field._counts.get(field.unknown_value, 0) + 1
+            return
+        field._pending.pop(v, None)
+        i = len(field._lookup)
+        field._lookup[v] = i
+        field._rlookup[i] = v
+        if count > 1:
+            field._counts[field.unknown_value] -= count - 1
+        field._counts[i] = count - 1
+    i = field._lookup[v]
+    field._counts[i] = field._counts.get(i, 0) + 1
+
 class DataField(Field):        
     def __init__(self, name, **args):
         super(DataField, self).__init__(name, **args)
+        # the rest of the field's specification (e.g. "encoder" or "hidden_size") configures its models
+        self.model_args = {k : v for k, v in args.items() if k not in ["type", "ignore"]}
+    def mask(self, x):
+        """
+        Given a batch of encoded values, return a boolean tensor indicating which entities have a value for the field.
+        """
+        import torch
+        return ~torch.isnan(torch.reshape(x, (x.shape[0], -1)).sum(1))
     
-class EntityTypeField(MetaField):
+class CodedMetaField(MetaField):
+    """
+A meta field whose values are given integer codes in the order they're first
+observed.  Observation takes a lock, since e.g. a Prefetcher's thread may build
+Datasets (and so observe ids) while others are built on the main thread.
+    """
+    missing_value = -1
+    encoded_type = "int64"
+    def __init__(self, name, **args):
+        super(CodedMetaField, self).__init__(name, **args)
+        self._lookup = {}
+        self._rlookup = {}
+        self._lock = threading.Lock()
+    def __getstate__(self):
+        # locks can't be pickled or copied, and a copy gets its own
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+    def _observe_value(self, v):
+        if v in self._lookup:
+            return
+        with self._lock:
+            i = self._lookup.setdefault(v, len(self._lookup))
+            self._rlookup[i] = v
+    def encode(self, v):
+        return self._lookup.get(v, self.missing_value)
+    def decode(self, v):
+        if _is_tensor(v):
+            v = v.item()
+        return self._rlookup.get(v, None)
+    def __len__(self):
+        return len(self._lookup)
+
+class EntityTypeField(CodedMetaField):
     def __init__(self, name, **args):
         super(EntityTypeField, self).__init__(name, type="entity_type", **args)
 
@@ -63,13 +185,14 @@ class RelationField(MetaField):
     def __str__(self):
         return "{}({}->{})".format(self.name, self.source_entity_type, self.target_entity_type)
     
-class IdField(MetaField):
+class IdField(CodedMetaField):
     def __init__(self, name, **args):
         super(IdField, self).__init__(name, type="id", **args)
 
 class NumericField(DataField):
-    encoded_type = torch.float32
+    encoded_type = "float32"
     missing_value = float("nan")
+    state_attributes = ["empty", "max_val", "min_val"]
     def __init__(self, name, **args):
         super(NumericField, self).__init__(name, **args)
         self.max_val = None
@@ -83,8 +206,14 @@ class NumericField(DataField):
         except Exception as e:
             logger.error("Could not interpret '%s' for NumericField '%s'", v, self.name)
             raise e
+    def observe_values(self, vs):
+        vs = numpy.asarray(vs, dtype=numpy.float64)
+        if len(vs) > 0:
+            self.empty = False
+            self.max_val = vs.max().item() if self.max_val == None else max(self.max_val, vs.max().item())
+            self.min_val = vs.min().item() if self.min_val == None else min(self.min_val, vs.min().item())
     def decode(self, v):
-        if isinstance(v, torch.Tensor):
+        if _is_tensor(v):
             v = v.item()
         return (None if numpy.isnan(v) else v)
     def __str__(self):
@@ -95,7 +224,7 @@ class IntegerField(DataField):
         super(IntegerField, self).__init__(name, **args)
 
     def __decode__(self, v):
-        if isinstance(v, torch.Tensor):
+        if _is_tensor(v):
             v = v.item()
         return v
         
@@ -113,8 +242,9 @@ class DateField(DataField):
         return "{}-{}-{}".format(day, month, year)
     
 class DistributionField(DataField):
-    encoded_type = torch.float32
+    encoded_type = "float32"
     missing_value = float("nan")
+    state_attributes = ["empty", "categories"]
     def __init__(self, name, **args):
         super(DistributionField, self).__init__(name, **args)
         self.categories = []
@@ -150,17 +280,41 @@ class CategoricalField(DataField):
         super(CategoricalField, self).__init__(name, **args)
         self._lookup = {Missing() : self.missing_value}
         self._rlookup = {self.missing_value : Missing()}
+        self._counts = {}
+        # values seen fewer than min_count times share an unknown value, as do values never seen
+        self.min_count = args.get("min_count", 1)
+        self.unknown_value = None
+        self._pending = {}
+        if self.min_count > 1:
+            self.unknown_value = len(self._lookup)
+            self._lookup[Unknown()] = self.unknown_value
+            self._rlookup[self.unknown_value] = Unknown()
          
     def _observe_value(self, v):
-        i = self._lookup.setdefault(v, len(self._lookup))
-        self._rlookup[i] = v
+        count_observation(self, v)
+
+    def observe_values(self, vs):
+        if self.min_count > 1:
+            return super(CategoricalField, self).observe_values(vs)
+        # without a minimum count, tallying the column first gives the same codes and counts
+        for v, c in collections.Counter(vs).items():
+            self.empty = False
+            i = self._lookup.setdefault(v, len(self._lookup))
+            self._rlookup[i] = v
+            self._counts[i] = self._counts.get(i, 0) + c
+
+    def count(self, i):
+        """
+        The number of times the value with the given code has been observed.
+        """
+        return self._counts.get(i, 0)
    
     def encode(self, v):
-        return self._lookup.get(v, None) #self.unknown_value)
+        return self._lookup.get(v, self.unknown_value)
 
     def decode(self, v):
-        if isinstance(v, torch.Tensor):
-            if v.dtype == torch.int64:
+        if _is_tensor(v):
+            if not v.is_floating_point():
                 v = v.item()
             else:
                 v = v.argmax().item()                
@@ -178,6 +332,7 @@ class CategoricalField(DataField):
     
 class SequentialField(DataField):
     missing_value = ()
+    state_attributes = ["empty", "max_length"]
     
     encoded_type = int
     def __init__(self, name, **args):
@@ -210,6 +365,12 @@ class SequentialField(DataField):
     def __str__(self):
         return "{1} field: {0}[{2} values, {3} max length]".format(self.name, self.type_name, len(self._lookup), self.max_length)
 
+    def mask(self, x):
+        import torch
+        if x.shape[1] == 0:
+            return torch.full((x.shape[0],), False, device=x.device, dtype=torch.bool)
+        return x[:, 0] != 0
+
     def encode(self, v):
         retval = [self._lookup[e] for e in v]
         return retval
@@ -252,24 +413,46 @@ class SequentialField(DataField):
 class CharacterField(DataField):
     missing_value = ()    
     encoded_type = int
+    state_attributes = ["empty", "max_observed_length"]
     def __init__(self, name, **args):
         super(CharacterField, self).__init__(name, **args)
         self._lookup = {None : 0}
         self._rlookup = {0 : None}
+        self._counts = {}
         self.max_observed_length = 0
+        # characters seen fewer than min_count times share an unknown value, as do characters never seen
+        self.min_count = args.get("min_count", 1)
+        self.unknown_value = None
+        self._pending = {}
+        if self.min_count > 1:
+            self.unknown_value = len(self._lookup)
+            self._lookup[Unknown()] = self.unknown_value
+            self._rlookup[self.unknown_value] = Unknown()
     def _observe_value(self, vs):
         for v in vs:
-            i = self._lookup.setdefault(v, len(self._lookup))
-            self._rlookup[i] = v
+            count_observation(self, v)
         self.max_observed_length = max(len(vs), self.max_observed_length)
+    def count(self, i):
+        """
+        The number of times the character with the given code has been observed.
+        """
+        return self._counts.get(i, 0)
     def __str__(self):
         return "{1} field: {0}[{2} values, {3} max length]".format(self.name, self.type_name, len(self._lookup), self.max_observed_length)
+    def mask(self, x):
+        import torch
+        if x.shape[1] == 0:
+            return torch.full((x.shape[0],), False, device=x.device, dtype=torch.bool)
+        return x[:, 0] != 0
     def encode(self, v):
-        retval = [self._lookup[e] for e in v]
+        if self.unknown_value == None:
+            retval = [self._lookup[e] for e in v]
+        else:
+            retval = [self._lookup.get(e, self.unknown_value) for e in v]
         return retval
     def decode(self, v):
         try:
-            return "".join([self._rlookup[e] for e in v if e not in [Missing.value, Unknown.value]])
+            return "".join([self._rlookup[e] for e in v if e not in [0, self.unknown_value]])
         except:
             raise Exception("Could not decode values '{0}' (type={2})".format(v, self._rlookup, type(v[0])))
     def __len__(self):
@@ -0,0 +1,168 @@
+import argparse
+import logging
+import random
+import numpy
+import torch
+from starcoder.fields import SequentialField, CharacterField
+from starcoder.models import LossEngine
+from starcoder.cache import batch_bytes
+from starcoder.utils import stack_batch
+
+logger = logging.getLogger(__name__)
+
+
+def measure_batch(model, entities, adjacencies):
+    """
+    The peak memory, in bytes, of a training step (forward and backward) on a batch.  On a CUDA
+    device this is the allocator's peak over what was allocated beforehand, and otherwise, since
+    CPU allocations aren't tracked, the bytes of the batch plus those of the (non-parameter)
+    tensors autograd saves for the backward pass, which dominate a step's memory.
+    """
+    model.train()
+    entities = {k : v.to(model.device) if isinstance(v, torch.Tensor) else v for k, v in entities.items()}
+    adjacencies = {k : v.to(model.device) for k, v in adjacencies.items()}
+    # parameters (which e.g. each step of a recurrent layer saves) are resident anyway, and views
+    # of the same storage are only counted once
+    parameters = set([p.untyped_storage().data_ptr() for p in model.parameters() if p.layout == torch.strided])
+    saved = {}
+    def pack(t):
+        if t.layout != torch.strided:
+            saved[id(t)] = t.numel() * t.element_size()
+        elif t.untyped_storage().data_ptr() not in parameters:
+            saved[t.untyped_storage().data_ptr()] = t.untyped_storage().nbytes()
+        return t
+    cuda = model.device.type == "cuda"
+    if cuda:
+        torch.cuda.synchronize(model.device)
+        torch.cuda.reset_peak_memory_stats(model.device)
+        baseline = torch.cuda.memory_allocated(model.device)
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t : t):
+        output = model(entities, adjacencies)
+        loss, _ = LossEngine(model.field_losses)(entities, output.reconstructions, output.field_masks)
+    loss.backward()
+    model.zero_grad(set_to_none=True)
+    if cuda:
+        torch.cuda.synchronize(model.device)
+        return torch.cuda.max_memory_allocated(model.device) - baseline
+    return sum(saved.values()) + batch_bytes((entities, adjacencies))
+
+
+class CostModel(object):
+    """
+A CostModel predicts the peak memory of a training step on a batch from the
+batch's composition, as a linear function (with non-negative coefficients) of:
+
+  a constant
+  the number of entities of each type (each has its own autoencoders, and
+    field encoders and decoders)
+  for each sequential or text field, the number of entities times the batch's
+    longest value, since stack_batch pads every entity's value to that length
+  the number of entities squared, times the number of relations, for the dense
+    adjacency matrices
+
+Compositions are summarized with "summarize", and summaries of components can
+be combined to get that of a batch made from them, so batchifiers can check
+candidate batches cheaply.  The coefficients are calibrated against measured
+batches of a particular model with "calibrate".
+    """
+    def __init__(self, schema, coefficients=None):
+        self.schema = schema
+        self.entity_types = sorted(schema.entity_types.keys())
+        self.sequential_fields = sorted([k for k, f in schema.data_fields.items() if isinstance(f, (SequentialField, CharacterField))])
+        self.feature_names = ["constant"] + ["entities[{}]".format(t) for t in self.entity_types] + ["padded[{}]".format(f) for f in self.sequential_fields] + ["adjacency"]
+        self.coefficients = numpy.zeros((len(self.feature_names),)) if coefficients == None else numpy.array(coefficients)
+
+    def summarize(self, entities):
+        """
+        Summarize a list of entities as (number of entities, counts by entity type, longest value
+        of each sequential field).
+        """
+        counts = {}
+        lengths = {}
+        for entity in entities:
+            entity_type = entity[self.schema.entity_type_field.name]
+            counts[entity_type] = counts.get(entity_type, 0) + 1
+            for field_name in self.sequential_fields:
+                if field_name in entity:
+                    lengths[field_name] = max(lengths.get(field_name, 0), len(entity[field_name]))
+        return (len(entities), counts, lengths)
+
+    def combine(self, *summaries):
+        counts = {}
+        lengths = {}
+        for _, c, l in summaries:
+            for k, v in c.items():
+                counts[k] = counts.get(k, 0) + v
+            for k, v in l.items():
+                lengths[k] = max(lengths.get(k, 0), v)
+        return (sum([n for n, _, _ in summaries]), counts, lengths)
+
+    def features(self, summary):
+        n, counts, lengths = summary
+        return numpy.array([1.0] +
+                           [counts.get(t, 0) for t in self.entity_types] +
+                           [n * lengths.get(f, 0) for f in self.sequential_fields] +
+                           [n * n * len(self.schema.relation_fields)], dtype=numpy.float64)
+
+    def predict(self, summary):
+        """
+        The predicted peak memory, in bytes, of a batch with the given summary.
+        """
+        return float(self.features(summary) @ self.coefficients)
+
+    def fit(self, summaries, measurements):
+        # scipy is only needed here, and is slow to import
+        from scipy.optimize import nnls
+        features = numpy.array([self.features(s) for s in summaries])
+        # columns are scaled to comparable magnitudes, so the solver treats them evenly
+        scales = numpy.maximum(features.max(0), 1.0)
+        coefficients, _ = nnls(features / scales, numpy.array(measurements, dtype=numpy.float64))
+        self.coefficients = coefficients / scales
+        predictions = features @ self.coefficients
+        error = numpy.abs(predictions - measurements) / numpy.maximum(measurements, 1.0)
+        logger.info("Fit memory cost model to %d batches, with mean relative error %.3f and maximum %.3f", len(measurements), error.mean(), error.max())
+        return error
+
+    def state_dict(self):
+        return {"feature_names" : self.feature_names, "coefficients" : self.coefficients.tolist()}
+
+    def load_state_dict(self, state):
+        if state["feature_names"] != self.feature_names:
+            raise Exception("Cost model features {} don't match the schema's {}".format(state["feature_names"], self.feature_names))
+        self.coefficients = numpy.array(state["coefficients"])
+
+    @staticmethod
+    def calibrate(model, data, batch_sizes=[8, 16, 32, 64, 128, 256], repeats=2, seed=0):
+        """
+        Measure training steps on batches of whole components from the data, of roughly the given
+        numbers of entities, and fit a CostModel for the model to them.  Parameters aren't
+        updated, though the model is left in training mode.
+        """
+        cost_model = CostModel(model.schema)
+        rng = random.Random(seed)
+        components = list(range(data.num_components))
+        summaries = []
+        measurements = []
+        for batch_size in batch_sizes:
+            for _ in range(repeats):
+                rng.shuffle(components)
+                chosen = []
+                total = 0
+                for i in components:
+                    if total >= batch_size:
+                        break
+                    chosen.append(data.component(i))
+                    total += len(chosen[-1][0])
+                entities, adjacencies = stack_batch(chosen, data.schema)
+                summaries.append(cost_model.summarize([e for c, _ in chosen for e in c]))
+                measurements.append(measure_batch(model, entities, adjacencies))
+        cost_model.fit(summaries, measurements)
+        return cost_model
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", dest="input", help="Input file")
+    parser.add_argument("-o", "--output", dest="output", help="Output file")
+    args = parser.parse_args()
@@ -1,22 +1,5 @@
-import pickle
-import re
-import sys
-import argparse
 import torch
-import json
-import numpy
-import scipy.sparse
-import gzip
-from torch.utils.data import DataLoader, Dataset
-import functools
-import numpy
-import random
 import logging
-from torch.optim import Adam, SGD
-from torch.optim.lr_scheduler import ReduceLROnPlateau
-from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
-import torch.nn.functional as F
-from starcoder.fields import NumericField, DistributionField, CategoricalField, SequentialField, IntegerField, DateField #, WordField
 
 logger = logging.getLogger(__name__)
 
@@ -55,14 +38,19 @@ class Autoencoder(torch.nn.Module):
         self._decoding_layers = torch.nn.ModuleList(reversed(self._decoding_layers))
         self._loss = torch.nn.MSELoss()
         self._activation = activation()
-    def forward(self, x):
-        y = x.clone()
+    def forward(self, x, compute_loss=False):
+        """
+        Return the reconstruction, the (detached) bottleneck, and, if compute_loss, the
+        reconstruction's mean squared error against the input (otherwise None).
+        """
+        # no layer modifies its input, so neither the reconstruction target nor the bottleneck need copying
+        y = x
         for layer in self._encoding_layers:
             x = self._activation(layer(x))
-        bottleneck = x.clone().detach()
+        bottleneck = x.detach()
         for layer in self._decoding_layers:
             x = self._activation(layer(x))
-        return (x, bottleneck, self._loss(x, y))
+        return (x, bottleneck, self._loss(x, y) if compute_loss else None)
     @property
     def input_size(self):
         return self._encoding_layers[0].in_features    
@@ -77,9 +65,85 @@ class DummyAutoencoder(torch.nn.Identity):
         self.input_size = 0
         self.output_size = 0
         self.bottleneck_size = sizes[-1]
-    def forward(self, x):
+    def forward(self, x, compute_loss=False):
         return (x, torch.zeros(size=(x.shape[0], self.bottleneck_size)), None)
 
+
+# (... :: Int) -> (... x embedding_dim :: Float)
+#
+# A replacement for torch.nn.Embedding whose size is bounded by configuration rather than by the
+# vocabulary.  With hash_buckets, each value's embedding is the sum of num_hashes rows of a table
+# with that many rows, chosen by independent universal hash functions (so distinct values rarely
+# share all their rows).  Otherwise, with cutoffs, values are ranked by observed frequency and each
+# tier after the first gets embeddings 1/div_value the size of the previous tier's, projected up
+# to embedding_dim.
+class CompressedEmbedding(torch.nn.Module):
+    prime = 2147483647
+    def __init__(self, num_embeddings, embedding_dim, counts=None, hash_buckets=None, num_hashes=2, cutoffs=None, div_value=4.0, sparse=False, seed=0):
+        super(CompressedEmbedding, self).__init__()
+        self.num_embeddings = num_embeddings
+        self.embedding_dim = embedding_dim
+        self.hash_buckets = hash_buckets
+        if hash_buckets != None:
+            generator = torch.Generator().manual_seed(seed)
+            self.register_buffer("_hash_a", torch.randint(1, self.prime, (num_hashes,), generator=generator))
+            self.register_buffer("_hash_b", torch.randint(0, self.prime, (num_hashes,), generator=generator))
+            self._tables = torch.nn.ModuleList([torch.nn.Embedding(num_embeddings=hash_buckets, embedding_dim=embedding_dim, sparse=sparse)])
+            self._projections = torch.nn.ModuleList([torch.nn.Identity()])
+        else:
+            counts = [0 for _ in range(num_embeddings)] if counts == None else counts
+            order = sorted(range(num_embeddings), key=lambda i : -counts[i])
+            bounds = [0] + sorted(set([c for c in (cutoffs or []) if 0 < c < num_embeddings])) + [num_embeddings]
+            tier = [0 for _ in order]
+            row = [0 for _ in order]
+            self._tables = []
+            self._projections = []
+            for t, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+                for r, i in enumerate(order[start:end]):
+                    tier[i] = t
+                    row[i] = r
+                dim = max(1, int(embedding_dim // (div_value ** t)))
+                self._tables.append(torch.nn.Embedding(num_embeddings=end - start, embedding_dim=dim, sparse=sparse))
+                self._projections.append(torch.nn.Identity() if dim == embedding_dim else torch.nn.Linear(dim, embedding_dim, bias=False))
+            self.register_buffer("_tier", torch.tensor(tier, dtype=torch.int64))
+            self.register_buffer("_row", torch.tensor(row, dtype=torch.int64))
+            self._tables = torch.nn.ModuleList(self._tables)
+            self._projections = torch.nn.ModuleList(self._projections)
+    def forward(self, x):
+        if self.hash_buckets != None:
+            buckets = ((x.unsqueeze(-1) * self._hash_a + self._hash_b) % self.prime) % self.hash_buckets
+            return self._tables[0](buckets).sum(-2)
+        if len(self._tables) == 1:
+            return self._tables[0](self._row[x])
+        tiers = self._tier[x]
+        rows = self._row[x]
+        retval = torch.zeros(size=tuple(x.shape) + (self.embedding_dim,), device=x.device)
+        for t, (table, projection) in enumerate(zip(self._tables, self._projections)):
+            mask = tiers == t
+            # under autocast the projections produce e.g. bfloat16, while the result is float32
+            retval[mask] = projection(table(rows[mask])).to(dtype=retval.dtype)
+        return retval
+
+
+def make_embeddings(field, embedding_dim, **args):
+    """
+    Create the embeddings for a field's values: a plain torch.nn.Embedding, unless the field's
+    specification asks for "hash_buckets" or "embedding_cutoffs", in which case a CompressedEmbedding.
+    With "sparse_embeddings", the embedding tables produce sparse gradients (see starcoder.optimizers).
+    """
+    sparse = args.get("sparse_embeddings", False)
+    if args.get("hash_buckets", None) == None and args.get("embedding_cutoffs", None) == None:
+        return torch.nn.Embedding(num_embeddings=len(field), embedding_dim=embedding_dim, sparse=sparse)
+    counts = [field.count(i) for i in range(len(field))] if hasattr(field, "count") else None
+    return CompressedEmbedding(len(field),
+                               embedding_dim,
+                               counts=counts,
+                               hash_buckets=args.get("hash_buckets", None),
+                               num_hashes=args.get("num_hashes", 2),
+                               cutoffs=args.get("embedding_cutoffs", None),
+                               div_value=args.get("embedding_div_value", 4.0),
+                               sparse=sparse)
+
     
 #
 class Projector(torch.nn.Module):
@@ -96,7 +160,7 @@ class Projector(torch.nn.Module):
 class CategoricalEncoder(torch.nn.Module):
     def __init__(self, field, activation, **args):
         super(CategoricalEncoder, self).__init__()
-        self._embeddings = torch.nn.Embedding(num_embeddings=len(field), embedding_dim=args.get("embedding_size", 32))
+        self._embeddings = make_embeddings(field, args.get("embedding_size", 32), **args)
     def forward(self, x):
         retval = self._embeddings(x)
         return(retval)
@@ -137,6 +201,96 @@ class CategoricalLoss(Loss):
         return torch.nn.functional.cross_entropy(guess, gold)
 
 
+# (batch_size x entity_representation_size :: Float) -> (batch_size x (input_size * 2) :: Float), when training
+# (batch_size x entity_representation_size :: Float) -> (batch_size x item_types :: Float), otherwise
+#
+# For categorical fields with very many values: an adaptive softmax (Grave et al. 2017) over the
+# categories ordered by observed frequency, where the most frequent form a "head" and the rest are
+# split into progressively larger, lower-dimensional tail clusters.  During training the decoder
+# output is the hidden representation, so AdaptiveCategoricalLoss only evaluates the clusters of
+# the gold categories; otherwise it is the full log-distribution, and "topk" gives exact top-k
+# predictions while skipping tail clusters that can't contain them.
+class AdaptiveCategoricalDecoder(torch.nn.Module):
+    def __init__(self, field, input_size, activation, **args):
+        super(AdaptiveCategoricalDecoder, self).__init__()
+        self.field = field
+        output_size = len(field)
+        # the missing value goes in the head, since every entity without the field predicts it
+        order = [field.missing_value] + sorted([i for i in range(output_size) if i != field.missing_value], key=lambda i : -field.count(i))
+        rank = [0 for _ in order]
+        for r, i in enumerate(order):
+            rank[i] = r
+        self.register_buffer("_order", torch.tensor(order, dtype=torch.int64))
+        self.register_buffer("_rank", torch.tensor(rank, dtype=torch.int64))
+        cutoffs = args.get("cutoffs", None)
+        if cutoffs == None:
+            # cut where the categories account for increasing proportions of the observations
+            total = max(1, sum([field.count(i) for i in order]))
+            cumulative = 0
+            cutoffs = []
+            thresholds = list(args.get("cutoff_proportions", [0.8, 0.95, 0.99]))
+            for r, i in enumerate(order):
+                cumulative += field.count(i)
+                while len(thresholds) > 0 and cumulative >= thresholds[0] * total:
+                    cutoffs.append(r + 1)
+                    thresholds = thresholds[1:]
+        cutoffs = sorted(set([min(max(1, c), output_size - 1) for c in cutoffs]))
+        self._layer = torch.nn.Linear(input_size, input_size * 2)
+        self._adaptive = torch.nn.AdaptiveLogSoftmaxWithLoss(input_size * 2, output_size, cutoffs, div_value=args.get("div_value", 4.0))
+    def hidden(self, x):
+        return torch.nn.functional.leaky_relu(self._layer(x))
+    def forward(self, x):
+        x = self.hidden(x)
+        if self.training:
+            return x
+        return self._adaptive.log_prob(x).index_select(1, self._rank)
+    def topk(self, x, k):
+        """
+        Return the (log-probabilities, category codes) of the k most likely categories for each row.
+        """
+        h = self.hidden(x)
+        adaptive = self._adaptive
+        k = min(k, adaptive.n_classes)
+        head = torch.nn.functional.log_softmax(adaptive.head(h), dim=1)
+        values = torch.full((h.shape[0], k), float("-inf"), device=h.device, dtype=head.dtype)
+        ranks = torch.zeros((h.shape[0], k), device=h.device, dtype=torch.int64)
+        shortlist = head[:, :adaptive.shortlist_size].topk(min(k, adaptive.shortlist_size), dim=1)
+        values[:, :shortlist.values.shape[1]] = shortlist.values
+        ranks[:, :shortlist.indices.shape[1]] = shortlist.indices
+        for i, cluster in enumerate(adaptive.tail):
+            start, stop = adaptive.cutoffs[i], adaptive.cutoffs[i + 1]
+            cluster_logprob = head[:, adaptive.shortlist_size + i]
+            # no category in a cluster is more likely than the cluster itself
+            rows = (cluster_logprob > values[:, -1]).nonzero().squeeze(1)
+            if rows.shape[0] == 0:
+                continue
+            cluster_values = torch.nn.functional.log_softmax(cluster(h[rows]), dim=1) + cluster_logprob[rows].unsqueeze(1)
+            cluster_ranks = torch.arange(start, stop, device=h.device).unsqueeze(0).expand(rows.shape[0], -1)
+            candidate_values = torch.cat([values[rows], cluster_values], 1)
+            candidate_ranks = torch.cat([ranks[rows], cluster_ranks], 1)
+            top = candidate_values.topk(k, dim=1)
+            values[rows] = top.values
+            ranks[rows] = candidate_ranks.gather(1, top.indices)
+        return (values, self._order[ranks])
+    @property
+    def input_size(self):
+        return self._layer.in_features
+    @property
+    def output_size(self):
+        return self._adaptive.n_classes
+
+
+class AdaptiveCategoricalLoss(Loss):
+    def __init__(self, field, decoder):
+        super(AdaptiveCategoricalLoss, self).__init__(field)
+        self.decoder = decoder
+    def compute(self, guess, gold):
+        gold = gold.to(device=guess.device)
+        if self.decoder.training:
+            return self.decoder._adaptive(guess, self.decoder._rank[gold]).loss
+        return torch.nn.functional.nll_loss(guess, gold)
+
+
 
 # (batch_count :: Float) -> (batch_count :: Float)
 class NumericEncoder(torch.nn.Module):
@@ -231,7 +385,7 @@ class SequentialEncoder(torch.nn.Module):
         hs = args.get("hidden_size", 64)
         rnn_type = args.get("rnn_type", torch.nn.GRU)
         self.max_length = args.get("max_length", 10)
-        self._embeddings = torch.nn.Embedding(num_embeddings=len(field), embedding_dim=es)
+        self._embeddings = make_embeddings(field, es, **args)
         self._rnn = rnn_type(es, hs, batch_first=True, bidirectional=False)
     def forward(self, x):
         logger.debug("Starting forward pass of SequentialEncoder for '%s'", self.field.name)        
@@ -258,6 +412,43 @@ class SequentialEncoder(torch.nn.Module):
         return self._rnn.hidden_size
 
 
+# item_sequences -> hidden_state
+# (batch_count x max_length :: Int) -> (batch_count x entity_representation_size :: Float)
+#
+# An alternative to SequentialEncoder that is parallel over time: a stack of residual dilated 1D
+# convolutions over the item embeddings, followed by max-pooling over the non-padding positions.
+class ConvolutionalEncoder(torch.nn.Module):
+    def __init__(self, field, activation, **args):
+        super(ConvolutionalEncoder, self).__init__()
+        self.field = field
+        es = args.get("embedding_size", 32)
+        hs = args.get("hidden_size", 64)
+        kernel_size = args.get("kernel_size", 3)
+        dilations = args.get("dilations", [1, 2, 4, 8])
+        self._embeddings = make_embeddings(field, es, **args)
+        self._input = torch.nn.Conv1d(es, hs, 1)
+        self._layers = torch.nn.ModuleList([torch.nn.Conv1d(hs, hs, kernel_size, dilation=d) for d in dilations])
+        # each layer's output keeps the sequence length, with an even kernel's extra position of padding on the right
+        self._padding = [((d * (kernel_size - 1)) // 2, d * (kernel_size - 1) - (d * (kernel_size - 1)) // 2) for d in dilations]
+        self._activation = activation()
+    def forward(self, x):
+        logger.debug("Starting forward pass of ConvolutionalEncoder for '%s'", self.field.name)
+        mask = (x != 0).unsqueeze(1)
+        h = self._input(self._embeddings(x).transpose(1, 2)) * mask
+        for layer, padding in zip(self._layers, self._padding):
+            h = (h + self._activation(layer(torch.nn.functional.pad(h, padding)))) * mask
+        retval = h.masked_fill(~mask, float("-inf")).max(2).values
+        retval = retval.masked_fill(~mask.any(2), 0.0)
+        logger.debug("Finished forward pass for ConvolutionalEncoder")
+        return retval
+    @property
+    def input_size(self):
+        return self._embeddings.embedding_dim
+    @property
+    def output_size(self):
+        return self._input.out_channels
+
+
 # representations -> item_distributions
 # (batch_count x entity_representation_size :: Float) -> (batch_count x max_length x item_types :: Float)
 class SequentialDecoder(torch.nn.Module):
@@ -271,12 +462,9 @@ class SequentialDecoder(torch.nn.Module):
         self._classifier = torch.nn.Linear(hs, len(field))
     def forward(self, x):
         logger.debug("Starting forward pass of SequentialDecoder for '%s'", self.field.name)
-        x = torch.stack([x for i in range(self.max_length)], dim=1)
+        x = x.unsqueeze(1).expand(-1, self.max_length, -1)
         output, _ = self._rnn(x)
-        outs = []
-        for i in range(self.max_length):
-            outs.append(torch.nn.functional.log_softmax(self._classifier(output[:, i, :]), dim=1))
-        retval = torch.stack(outs, 1)
+        retval = torch.nn.functional.log_softmax(self._classifier(output), dim=2)
         return retval
     @property
     def input_size(self):
@@ -286,16 +474,102 @@ class SequentialDecoder(torch.nn.Module):
         return self._rnn.hidden_size
 
 
+def sequence_loss(x, target, entity_mask=None):
+    """
+    Given log-probabilities (entities x length x items) and targets (entities x length), the mean
+    over entities (those where entity_mask is true, if it's given) of each sequence's mean loss
+    over its items plus the first padding position (which marks the end of the sequence), so
+    padding beyond that costs no gradient.  This is zero if no entity is selected.
+    """
+    if target.shape[1] == 0:
+        target = torch.zeros(size=x.shape[:-1], device=x.device, dtype=torch.long)
+    length = min(x.shape[1], target.shape[1])
+    target = target[:, :length].to(device=x.device)
+    lengths = (target != 0).sum(1)
+    item_mask = torch.arange(0, length, 1, device=x.device).unsqueeze(0) <= lengths.unsqueeze(1)
+    log_probs = x[:, :length, :].gather(2, target.unsqueeze(2)).squeeze(2).float()
+    sequence_losses = -torch.where(item_mask, log_probs, torch.zeros_like(log_probs)).sum(1) / item_mask.sum(1).clamp(min=1)
+    if entity_mask == None:
+        return sequence_losses.mean()
+    entity_mask = entity_mask.to(device=x.device)
+    return torch.where(entity_mask, sequence_losses, torch.zeros_like(sequence_losses)).sum() / entity_mask.sum().clamp(min=1)
+
+
+# Entities without a value for the field don't count, as with the LossEngine's masks (see sequence_loss).
 class SequentialLoss(Loss):
     def __init__(self, field, reduction="mean"):
         super(SequentialLoss, self).__init__(field)
     def compute(self, x, target):
-        if target.shape[1] == 0:
-            target = torch.zeros(size=x.shape[:-1], device=x.device, dtype=torch.long)
-        losses = []
-        for v in range(min(x.shape[1], target.shape[1])):
-            losses.append(torch.nn.functional.nll_loss(x[:, v, :], target[:, v]))
-        return sum(losses)
+        return sequence_loss(x, target, self.field.mask(target))
+
+
+class LossEngine(object):
+    """
+Computes the losses for all of a model's fields at once, given a dictionary from
+field names to Loss objects.  Rather than each Loss working out its own mask,
+the engine uses the field masks (e.g. from the forward pass, which has already
+computed them for the same entities) and groups fields whose losses have the
+same form, so that e.g. all NumericLoss fields are a single masked squared
+error over stacked tensors, and all CategoricalLoss fields a single stacked
+gather from their log-probabilities.  Sequential fields use sequence_loss, as
+SequentialLoss does, with the field masks.  Other losses are computed
+individually.
+
+Calling the engine returns the total loss and a detached per-field breakdown;
+"field_losses" returns the (undetached) per-field losses, for loss policies
+that weight them.  Fields with no values in the batch have a loss of zero.
+Nothing here synchronizes with the device.
+    """
+    def __init__(self, losses):
+        self.losses = losses
+        self.numeric = [k for k, v in losses.items() if type(v) == NumericLoss]
+        self.categorical = [k for k, v in losses.items() if type(v) == CategoricalLoss]
+        self.sequential = [k for k, v in losses.items() if type(v) == SequentialLoss]
+        grouped = set(self.numeric + self.categorical + self.sequential)
+        self.other = [k for k in losses.keys() if k not in grouped]
+
+    def __call__(self, entities, reconstructions, field_masks=None):
+        losses = self.field_losses(entities, reconstructions, field_masks)
+        total = sum(losses.values()) if len(losses) > 0 else torch.tensor(0.0)
+        return (total, {k : v.detach() for k, v in losses.items()})
+
+    def field_losses(self, entities, reconstructions, field_masks=None):
+        field_masks = {} if field_masks == None else field_masks
+        def present(names):
+            return [k for k in names if k in reconstructions and k in entities]
+        def mask(name, device):
+            if name in field_masks:
+                return field_masks[name].to(device=device)
+            return self.losses[name].field.mask(entities[name]).to(device=device)
+        retval = {}
+
+        names = present(self.numeric)
+        if len(names) > 0:
+            device = reconstructions[names[0]].device
+            guesses = torch.stack([reconstructions[k].flatten().float() for k in names])
+            golds = torch.stack([entities[k].flatten().to(device=device, dtype=guesses.dtype) for k in names])
+            masks = torch.stack([mask(k, device) for k in names])
+            errors = torch.where(masks, (guesses - torch.nan_to_num(golds)) ** 2, torch.zeros_like(guesses))
+            means = errors.sum(1) / masks.sum(1).clamp(min=1)
+            retval.update(zip(names, means.unbind(0)))
+
+        names = present(self.categorical)
+        if len(names) > 0:
+            device = reconstructions[names[0]].device
+            # the decoders produce log-probabilities, so the loss is the negated log-probability of the gold value
+            log_probs = torch.stack([reconstructions[k].gather(1, entities[k].to(device=device).unsqueeze(1)).squeeze(1).float() for k in names])
+            masks = torch.stack([mask(k, device) for k in names])
+            means = -torch.where(masks, log_probs, torch.zeros_like(log_probs)).sum(1) / masks.sum(1).clamp(min=1)
+            retval.update(zip(names, means.unbind(0)))
+
+        names = present(self.sequential)
+        for k in names:
+            device = reconstructions[k].device
+            retval[k] = sequence_loss(reconstructions[k], entities[k].to(device=device), mask(k, device))
+
+        for k in present(self.other):
+            retval[k] = self.losses[k](reconstructions[k], entities[k])
+        return retval
 
 
 # representations -> summary
@@ -309,11 +583,12 @@ class RNNSummarizer(torch.nn.Module):
         return h.squeeze()
 
 
-class MaxPoolSummarizer(torch.nn.MaxPool1d):
+class MaxPoolSummarizer(torch.nn.Module):
     def __init__(self, input_size, activation):
-        super(MaxPoolSummarizer, self).__init__(1)
+        super(MaxPoolSummarizer, self).__init__()
     def forward(self, x):
-        return super(MaxPoolSummarizer, self).forward(x)
+        # the elementwise maximum over the related entities
+        return x.max(0).values
 
     
 class SingleSummarizer(torch.nn.Identity):
@@ -325,6 +600,30 @@ class SingleSummarizer(torch.nn.Identity):
             return torch.zeros(shape=(self._input_size,))
         else:
             return x[0]
+    def summarize_adjacency(self, representations, adjacency):
+        # the first related entity of each row is the position of its first True value
+        first = adjacency.to(dtype=torch.uint8).argmax(1)
+        present = adjacency.any(1).unsqueeze(1)
+        return torch.index_select(representations, 0, first) * present
+
+
+# representations -> adjacency -> summaries
+# (entity_count x bottleneck_size) -> (count x entity_count :: Bool) -> (count x bottleneck_size)
+def summarize_relation(summarizer, representations, adjacency):
+    """
+    Apply a summarizer to the related representations picked out by each row of an
+    adjacency matrix, with all-zero summaries for rows that have no related entities.
+    Summarizers that can process every row at once provide a "summarize_adjacency" method.
+    """
+    if hasattr(summarizer, "summarize_adjacency"):
+        return summarizer.summarize_adjacency(representations, adjacency)
+    retval = torch.zeros(size=(adjacency.shape[0], representations.shape[1]), device=representations.device)
+    index_space = torch.arange(0, adjacency.shape[1], 1, device=representations.device)
+    for i in range(adjacency.shape[0]):
+        related_indices = index_space.masked_select(adjacency[i])
+        if len(related_indices) > 0:
+            retval[i] = summarizer(torch.index_select(representations, 0, related_indices))
+    return retval
 
 
 class MLPProjector(torch.nn.Module):
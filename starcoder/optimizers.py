@@ -0,0 +1,74 @@
+import logging
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def split_parameters(model):
+    """
+    Split a model's trainable parameters into those of embedding tables that produce sparse
+    gradients, and the rest.
+    """
+    sparse = []
+    for module in model.modules():
+        if isinstance(module, torch.nn.Embedding) and module.sparse and module.weight.requires_grad:
+            sparse.append(module.weight)
+    sparse_ids = set([id(p) for p in sparse])
+    dense = [p for p in model.parameters() if p.requires_grad and id(p) not in sparse_ids]
+    return (sparse, dense)
+
+
+class SparseDenseOptimizer(torch.optim.Optimizer):
+    """
+Updates a model's sparse-gradient embedding tables with one optimizer (by default,
+SparseAdam, which only touches the rows each batch used) and its remaining
+parameters with another, while presenting a single optimizer: "param_groups"
+is the concatenation of both optimizers' groups, so e.g. Scheduler can reduce
+the learning rate of everything at once.
+
+Keyword arguments besides "lr" only go to the dense optimizer.
+    """
+    def __init__(self, model, dense_class=torch.optim.Adam, sparse_class=torch.optim.SparseAdam, lr=0.001, **args):
+        # Optimizer.__init__ isn't called: all state lives in the two wrapped optimizers
+        sparse, dense = split_parameters(model)
+        logger.info("Optimizing %d sparse and %d dense parameter tensors", len(sparse), len(dense))
+        self.sparse = sparse_class(sparse, lr=lr) if len(sparse) > 0 else None
+        self.dense = dense_class(dense, lr=lr, **args) if len(dense) > 0 else None
+        self.defaults = dict(lr=lr, **args)
+
+    @property
+    def optimizers(self):
+        return [o for o in [self.sparse, self.dense] if o != None]
+
+    @property
+    def param_groups(self):
+        return sum([o.param_groups for o in self.optimizers], [])
+
+    @property
+    def state(self):
+        retval = {}
+        for o in self.optimizers:
+            retval.update(o.state)
+        return retval
+
+    def zero_grad(self, set_to_none=True):
+        for o in self.optimizers:
+            o.zero_grad(set_to_none=set_to_none)
+
+    def step(self, closure=None):
+        loss = None if closure == None else closure()
+        for o in self.optimizers:
+            o.step()
+        return loss
+
+    def state_dict(self):
+        return {"sparse" : None if self.sparse == None else self.sparse.state_dict(),
+                "dense" : None if self.dense == None else self.dense.state_dict()}
+
+    def load_state_dict(self, state_dict):
+        for name in ["sparse", "dense"]:
+            if getattr(self, name) != None:
+                getattr(self, name).load_state_dict(state_dict[name])
+
+    def __repr__(self):
+        return "SparseDenseOptimizer(sparse={}, dense={})".format(self.sparse, self.dense)
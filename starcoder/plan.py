@@ -0,0 +1,59 @@
+import logging
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+class ForwardPlan(torch.nn.Module):
+    """
+A ForwardPlan is computed once, when a GraphAutoencoder is constructed, and
+records everything about the forward pass that depends only on the Schema and
+the sizes of the model's components, rather than on a particular batch:
+
+  fields: (field name, field object, offset, width) for each data field, where
+          offset and width locate the field's encoding in the (entity_count x
+          encoding_size) matrix of concatenated field encodings, which starts
+          with a base representation of zeros
+  entity_types: (entity type name, entity type code, relation slots) for each
+                entity type, where the relation slots are the (relation name,
+                is_reverse) pairs whose summaries are appended to the entity
+                type's autoencoder inputs at depths greater than zero
+
+It also holds, for each entity type, a tensor of the columns of the encoding
+matrix that make up the entity type's autoencoder input (see "columns").  These
+are stored as non-persistent buffers, so they follow the model across devices
+but aren't saved with its parameters.
+    """
+    def __init__(self, schema, field_encoders, base_entity_representation_size, reverse_relations):
+        super(ForwardPlan, self).__init__()
+        self.base_entity_representation_size = base_entity_representation_size
+        self.fields = []
+        offsets = {}
+        offset = base_entity_representation_size
+        for field_name, field_object in schema.data_fields.items():
+            width = field_encoders[field_name].output_size
+            self.fields.append((field_name, field_object, offset, width))
+            offsets[field_name] = offset
+            offset += width
+        self.encoding_size = offset
+
+        self.entity_types = []
+        for i, entity_type in enumerate(schema.entity_types.values()):
+            columns = list(range(base_entity_representation_size))
+            for field_name in entity_type.data_fields:
+                columns += list(range(offsets[field_name], offsets[field_name] + field_encoders[field_name].output_size))
+            self.register_buffer("columns_{}".format(i), torch.tensor(columns, dtype=torch.int64), persistent=False)
+            relation_slots = [(rel_name, False) for rel_name in entity_type.relation_fields]
+            if reverse_relations:
+                relation_slots += [(rel_name, True) for rel_name in entity_type.reverse_relation_fields]
+            self.entity_types.append((entity_type.name, schema.entity_type_field.encode(entity_type.name), relation_slots))
+        logger.debug("Created forward plan with encoding size %d for %d entity types", self.encoding_size, len(self.entity_types))
+
+    def columns(self, i):
+        """
+        The columns of the encoding matrix that make up the autoencoder input for the i-th entity type.
+        """
+        return getattr(self, "columns_{}".format(i))
+
+    def forward(self, *argv):
+        raise Exception("A ForwardPlan is not callable: it is consulted by GraphAutoencoder.forward")
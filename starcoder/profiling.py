@@ -0,0 +1,169 @@
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Profiler(object):
+    """
+A Profiler records, for each stage of the batch pipeline and forward pass, the
+number of calls, wall-clock seconds, and bytes of the tensors the stage
+produced.  Stages are named, and optionally labeled with e.g. the field, entity
+type or depth they're working on, so each (name, labels) combination is
+aggregated separately:
+
+  with Profiler() as profiler:
+      for epoch in ...:
+          trainer.train_epoch(data)
+  profiler.save_json("profile.json")
+  profiler.save_chrome_trace("trace.json")
+
+While a profiler is active (inside its "with" block), the code instrumented
+with starcoder.profiling.stage reports to it.  Otherwise, stage() returns a
+shared object that does nothing, so instrumentation costs one global lookup.
+Besides the aggregates, up to "max_events" individual timings are kept, for
+Chrome's trace viewer (chrome://tracing or https://ui.perfetto.dev).
+    """
+    def __init__(self, max_events=100000):
+        self.max_events = max_events
+        self.stages = {}
+        self.events = []
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self._previous = None
+
+    def __enter__(self):
+        global _current
+        self._previous = _current
+        _current = self
+        return self
+
+    def __exit__(self, *argv):
+        global _current
+        _current = self._previous
+
+    def stage(self, name, **labels):
+        return _Stage(self, name, labels)
+
+    def _add(self, name, labels, start, seconds, size):
+        key = name if len(labels) == 0 else "{}[{}]".format(name, ",".join(["{}={}".format(k, v) for k, v in sorted(labels.items())]))
+        with self._lock:
+            stats = self.stages.setdefault(key, {"stage" : name, "labels" : labels, "calls" : 0, "seconds" : 0.0, "bytes" : 0})
+            stats["calls"] += 1
+            stats["seconds"] += seconds
+            stats["bytes"] += size
+            if len(self.events) < self.max_events:
+                self.events.append((key, labels, threading.get_ident(), start - self._start, seconds, size))
+
+    def summary(self):
+        """
+        The aggregate statistics for each (stage, labels) combination, most time-consuming first.
+        """
+        return sorted(self.stages.values(), key=lambda x : x["seconds"], reverse=True)
+
+    def totals(self, label):
+        """
+        Aggregate the statistics by the value of one label, e.g. "field" or "entity_type".
+        """
+        retval = {}
+        for stats in self.stages.values():
+            if label in stats["labels"]:
+                total = retval.setdefault(stats["labels"][label], {"calls" : 0, "seconds" : 0.0, "bytes" : 0})
+                for k in ["calls", "seconds", "bytes"]:
+                    total[k] += stats[k]
+        return retval
+
+    def save_json(self, path):
+        with open(path, "wt") as ofd:
+            json.dump({"stages" : self.summary(),
+                       "fields" : self.totals("field"),
+                       "entity_types" : self.totals("entity_type")}, ofd, indent=2)
+
+    def save_chrome_trace(self, path):
+        events = []
+        for key, labels, thread, start, seconds, size in self.events:
+            args = dict(labels)
+            args["bytes"] = size
+            events.append({"name" : key, "ph" : "X", "pid" : os.getpid(), "tid" : thread, "ts" : start * 1e6, "dur" : seconds * 1e6, "args" : args})
+        with open(path, "wt") as ofd:
+            json.dump({"traceEvents" : events, "displayTimeUnit" : "ms"}, ofd)
+
+
+class _Stage(object):
+    def __init__(self, profiler, name, labels):
+        self.profiler = profiler
+        self.name = name
+        self.labels = labels
+        self.bytes = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *argv):
+        self.profiler._add(self.name, self.labels, self.start, time.perf_counter() - self.start, self.bytes)
+
+    def record(self, *tensors):
+        """
+        Count the given tensors (or lists, tuples, or dictionaries of tensors) as produced by the stage.
+        """
+        import torch
+        for t in tensors:
+            if isinstance(t, torch.Tensor):
+                self.bytes += t.numel() * t.element_size()
+            elif isinstance(t, dict):
+                self.record(*t.values())
+            elif isinstance(t, (list, tuple)):
+                self.record(*t)
+
+
+class _NullStage(object):
+    def __enter__(self):
+        return self
+    def __exit__(self, *argv):
+        pass
+    def record(self, *tensors):
+        pass
+
+
+_null_stage = _NullStage()
+_current = None
+
+
+def stage(name, **labels):
+    """
+    A context manager timing the named stage with the active Profiler, if any, whose
+    "record" method counts the bytes of tensors the stage produced.
+    """
+    if _current == None:
+        return _null_stage
+    return _current.stage(name, **labels)
+
+
+def time_calls(function, repeats, warmup=1):
+    """
+    Return the mean wall-clock seconds per call of a function that takes no arguments.
+    """
+    for _ in range(warmup):
+        function()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        function()
+    return (time.perf_counter() - start) / repeats
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", dest="input", help="Input file (as written by Profiler.save_json)")
+    parser.add_argument("-n", "--top", dest="top", type=int, default=20, help="Number of stages to show")
+    args = parser.parse_args()
+
+    with open(args.input, "rt") as ifd:
+        profile = json.load(ifd)
+    for stats in profile["stages"][:args.top]:
+        print("{:>10.3f}s {:>8} calls {:>14} bytes  {} {}".format(stats["seconds"], stats["calls"], stats["bytes"], stats["stage"], stats["labels"]))
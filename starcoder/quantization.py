@@ -0,0 +1,121 @@
+import argparse
+import copy
+import io
+import json
+import logging
+import pickle
+import torch
+from torch.ao.quantization import quantize_dynamic
+from starcoder.profiling import time_calls
+
+logger = logging.getLogger(__name__)
+
+
+# the module types whose weights are quantized by default: together they hold most of a model's
+# parameters and time (autoencoders, projectors, decoders, and recurrent encoders/decoders)
+default_module_types = {torch.nn.Linear, torch.nn.GRU}
+
+
+def quantize(model, module_types=default_module_types, dtype=torch.qint8):
+    """
+    Return an inference-only copy of a GraphAutoencoder whose modules of the given types
+    have dynamically-quantized weights (activations are quantized on the fly, per batch).
+    The original model is left untouched.
+    """
+    quantized = copy.deepcopy(model).cpu()
+    quantized.device = torch.device("cpu")
+    quantized.precision = "float32"
+    quantized.eval()
+    quantized = quantize_dynamic(quantized, set(module_types), dtype=dtype)
+    logger.info("Quantized %s to %s", ", ".join(sorted([t.__name__ for t in module_types])), dtype)
+    return quantized
+
+
+def model_size(model):
+    """
+    The number of bytes a model's serialized parameters and buffers take up.
+    """
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def save_quantized(model, path):
+    # quantized modules have different structure than the originals, so the whole model is pickled
+    torch.save(model, path)
+
+
+def load_quantized(path):
+    return torch.load(path, weights_only=False)
+
+
+def drift(float_output, quantized_output):
+    """
+    Compare the outputs of a float model and its quantized copy on the same batch: for the
+    bottlenecks and each reconstructed field, the largest absolute difference and the norm
+    of the difference relative to the float output's, and for fields with a distribution
+    over values (e.g. categorical log-probabilities), how often the most-likely values agree.
+    """
+    def compare(x, y, distribution):
+        x = x.float()
+        y = y.float()
+        retval = {"max_absolute_difference" : (x - y).abs().max().item() if x.numel() > 0 else 0.0,
+                  "relative_difference" : ((x - y).norm() / x.norm().clamp(min=1e-12)).item()}
+        if distribution and x.dim() > 1 and x.shape[-1] > 1 and x.numel() > 0:
+            retval["argmax_agreement"] = (x.argmax(-1) == y.argmax(-1)).float().mean().item()
+        return retval
+    retval = {"fields" : {}}
+    for field_name, x in float_output.reconstructions.items():
+        if x.is_floating_point():
+            retval["fields"][field_name] = compare(x, quantized_output.reconstructions[field_name], True)
+    if float_output.bottlenecks != None:
+        retval["bottlenecks"] = compare(float_output.bottlenecks, quantized_output.bottlenecks, False)
+    return retval
+
+
+def quantization_report(model, quantized, entities, adjacencies, repeats=5):
+    """
+    Run a float model and its quantized copy on a held-out batch, and report the quantized
+    model's output drift, along with both models' sizes and per-batch latencies.
+    """
+    float_model = copy.deepcopy(model).cpu()
+    float_model.device = torch.device("cpu")
+    float_model.eval()
+    with torch.inference_mode():
+        float_output = float_model(entities, adjacencies)
+        quantized_output = quantized(entities, adjacencies)
+        float_seconds = time_calls(lambda : float_model(entities, adjacencies), repeats)
+        quantized_seconds = time_calls(lambda : quantized(entities, adjacencies), repeats)
+    retval = {"drift" : drift(float_output, quantized_output),
+              "float_bytes" : model_size(float_model),
+              "quantized_bytes" : model_size(quantized),
+              "float_seconds_per_batch" : float_seconds,
+              "quantized_seconds_per_batch" : quantized_seconds}
+    retval["size_reduction"] = retval["float_bytes"] / retval["quantized_bytes"]
+    retval["speedup"] = float_seconds / quantized_seconds
+    logger.info("Quantized model is %.2fx smaller and %.2fx faster", retval["size_reduction"], retval["speedup"])
+    return retval
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--model", dest="model", help="Input model file (a pickled GraphAutoencoder)")
+    parser.add_argument("-d", "--data", dest="data", help="Held-out batch file (a pickled (entities, adjacencies) pair, as from a Batchifier)")
+    parser.add_argument("-o", "--output", dest="output", help="Output file for the quantized model")
+    parser.add_argument("-r", "--report", dest="report", help="Output file for the drift, size, and latency report")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    model = torch.load(args.model, weights_only=False)
+    quantized = quantize(model)
+    save_quantized(quantized, args.output)
+    if args.data:
+        with open(args.data, "rb") as ifd:
+            entities, adjacencies = pickle.load(ifd)
+        report = quantization_report(model, quantized, entities, adjacencies)
+        if args.report:
+            with open(args.report, "wt") as ofd:
+                json.dump(report, ofd, indent=2)
+        else:
+            print(json.dumps(report, indent=2))
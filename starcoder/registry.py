@@ -1,52 +1,140 @@
-from starcoder.fields import NumericField, DistributionField, CategoricalField, SequentialField, IntegerField, RelationField, DateField, IdField, EntityTypeField
-
-from starcoder.models import NumericEncoder, NumericDecoder, NumericLoss, DistributionEncoder, DistributionDecoder, DistributionLoss, CategoricalEncoder, CategoricalDecoder, CategoricalLoss, SequentialEncoder, SequentialDecoder, SequentialLoss
-
-from starcoder.schedulers import Scheduler
-from starcoder import batchifiers
-from starcoder import splitters
-from starcoder import fields
-# import RandomEntities, RandomComponents, DuplicateEntityTypes
-
-field_model_classes = {
-    NumericField : (NumericEncoder, NumericDecoder, NumericLoss),
-    DistributionField : (DistributionEncoder, DistributionDecoder, DistributionLoss),
-    IntegerField : (NumericEncoder, NumericDecoder, NumericLoss),
-    CategoricalField : (CategoricalEncoder, CategoricalDecoder, CategoricalLoss),
-    SequentialField : (SequentialEncoder, SequentialDecoder, SequentialLoss),
-    #WordField : (SequentialEncoder, SequentialDecoder, SequentialLoss),
-    DateField : (NumericEncoder, NumericDecoder, NumericLoss),
-    fields.CharacterField : (SequentialEncoder, SequentialDecoder, SequentialLoss),
-}
-
-summarizer_classes = {}
-
-projector_classes = {}
-
-batchifier_classes = {"sample_entities" : batchifiers.SampleEntities,
-                      "sample_snowflakes" : batchifiers.SampleSnowflakes,
-                      "sample_components" : batchifiers.SampleComponents,
-}
-
-scheduler_classes = {"default" : Scheduler}
-
-splitter_classes = {"sample_entities" : splitters.SampleEntities,
-                    "sample_components" : splitters.SampleComponents,
-}
-
-field_classes = {"numeric" : NumericField,
-                 "categorical" : CategoricalField,
-                 "boolean" : CategoricalField,                 
-                 "sequential" : SequentialField,
-                 "integer" : IntegerField,
-                 "keyword" : CategoricalField,
-                 "text" : fields.CharacterField,
-                 "relation" : RelationField,
-                 "distribution" : DistributionField,
-                 "date" : DateField,
-                 "id" : IdField,
-                 "entity_type" : EntityTypeField,
-}
+import collections.abc
+import importlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def _resolve(entry):
+    if isinstance(entry, tuple):
+        return tuple([_resolve(e) for e in entry])
+    elif isinstance(entry, str):
+        module_name, attribute = entry.split(":")
+        return getattr(importlib.import_module(module_name), attribute)
+    elif hasattr(entry, "load"):
+        # an entry point
+        return entry.load()
+    return entry
+
+
+class Registry(collections.abc.Mapping):
+    """
+A Registry maps names to classes (or tuples of classes, such as an encoder,
+decoder and loss), but only imports a class the first time it's looked up, so
+that e.g. parsing a schema doesn't pull in every model architecture.  Entries
+are "module:attribute" strings (or tuples of them), or objects that are already
+loaded.
+
+Other packages can add entries without changing StarCoder, by declaring entry
+points in the Registry's group, e.g. in their setup.py:
+
+  entry_points={"starcoder.batchifiers" : ["my_batchifier = my_package.batchifiers:MyBatchifier"]}
+
+A name declared by an entry point replaces a built-in entry with the same name.
+    """
+    def __init__(self, group, entries):
+        self.group = group
+        self._entries = dict(entries)
+        self._resolved = {}
+        self._plugins_loaded = False
+
+    def _load_plugins(self):
+        if not self._plugins_loaded:
+            self._plugins_loaded = True
+            # importlib.metadata itself takes a noticeable fraction of a second to import
+            import importlib.metadata
+            for entry_point in importlib.metadata.entry_points(group=self.group):
+                logger.debug("Registering '%s' from %s in %s", entry_point.name, entry_point.value, self.group)
+                self._entries[entry_point.name] = entry_point
+
+    def register(self, name, entry):
+        self._load_plugins()
+        self._entries[name] = entry
+        self._resolved.pop(name, None)
+
+    def __getitem__(self, name):
+        self._load_plugins()
+        if name not in self._resolved:
+            self._resolved[name] = _resolve(self._entries[name])
+        return self._resolved[name]
+
+    def __contains__(self, name):
+        self._load_plugins()
+        return name in self._entries
+
+    def __iter__(self):
+        self._load_plugins()
+        return iter(list(self._entries.keys()))
+
+    def __len__(self):
+        self._load_plugins()
+        return len(self._entries)
+
+
+# The encoder, decoder and loss for each field class, by the class's name
+field_model_classes = Registry("starcoder.field_models", {
+    "NumericField" : ("starcoder.models:NumericEncoder", "starcoder.models:NumericDecoder", "starcoder.models:NumericLoss"),
+    "DistributionField" : ("starcoder.models:DistributionEncoder", "starcoder.models:DistributionDecoder", "starcoder.models:DistributionLoss"),
+    "IntegerField" : ("starcoder.models:NumericEncoder", "starcoder.models:NumericDecoder", "starcoder.models:NumericLoss"),
+    "CategoricalField" : ("starcoder.models:CategoricalEncoder", "starcoder.models:CategoricalDecoder", "starcoder.models:CategoricalLoss"),
+    "SequentialField" : ("starcoder.models:SequentialEncoder", "starcoder.models:SequentialDecoder", "starcoder.models:SequentialLoss"),
+    #"WordField" : ("starcoder.models:SequentialEncoder", "starcoder.models:SequentialDecoder", "starcoder.models:SequentialLoss"),
+    "DateField" : ("starcoder.models:NumericEncoder", "starcoder.models:NumericDecoder", "starcoder.models:NumericLoss"),
+    "CharacterField" : ("starcoder.models:SequentialEncoder", "starcoder.models:SequentialDecoder", "starcoder.models:SequentialLoss"),
+})
+
+# Alternative encoders, chosen for a particular field by its "encoder" entry in the schema
+encoder_classes = Registry("starcoder.encoders", {
+    "rnn" : "starcoder.models:SequentialEncoder",
+    "convolutional" : "starcoder.models:ConvolutionalEncoder",
+})
+
+# Alternative decoders, chosen for a particular field by its "decoder" entry in the schema, along
+# with the losses that go with them (which are constructed with the field and the decoder)
+decoder_classes = Registry("starcoder.decoders", {
+    "adaptive" : ("starcoder.models:AdaptiveCategoricalDecoder", "starcoder.models:AdaptiveCategoricalLoss"),
+})
+
+# Summarizers reduce the representations of an entity's related entities to one (see GraphAutoencoder's "summarizers")
+summarizer_classes = Registry("starcoder.summarizers", {
+    "single" : "starcoder.models:SingleSummarizer",
+    "rnn" : "starcoder.models:RNNSummarizer",
+    "max_pool" : "starcoder.models:MaxPoolSummarizer",
+})
+
+projector_classes = Registry("starcoder.projectors", {})
+
+batchifier_classes = Registry("starcoder.batchifiers", {
+    "sample_entities" : "starcoder.batchifiers:SampleEntities",
+    "sample_snowflakes" : "starcoder.batchifiers:SampleSnowflakes",
+    "sample_components" : "starcoder.batchifiers:SampleComponents",
+    "budget_components" : "starcoder.batchifiers:BudgetComponents",
+})
+
+scheduler_classes = Registry("starcoder.schedulers", {
+    "default" : "starcoder.schedulers:Scheduler",
+})
+
+splitter_classes = Registry("starcoder.splitters", {
+    "sample_entities" : "starcoder.splitters:SampleEntities",
+    "sample_components" : "starcoder.splitters:SampleComponents",
+    "hash_components" : "starcoder.splitters:HashComponents",
+})
+
+field_classes = Registry("starcoder.fields", {
+    "numeric" : "starcoder.fields:NumericField",
+    "categorical" : "starcoder.fields:CategoricalField",
+    "boolean" : "starcoder.fields:CategoricalField",
+    "sequential" : "starcoder.fields:SequentialField",
+    "integer" : "starcoder.fields:IntegerField",
+    "keyword" : "starcoder.fields:CategoricalField",
+    "text" : "starcoder.fields:CharacterField",
+    "relation" : "starcoder.fields:RelationField",
+    "distribution" : "starcoder.fields:DistributionField",
+    "date" : "starcoder.fields:DateField",
+    "id" : "starcoder.fields:IdField",
+    "entity_type" : "starcoder.fields:EntityTypeField",
+})
 
 
 import argparse
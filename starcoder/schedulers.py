@@ -22,7 +22,9 @@ class Scheduler(torch.optim.lr_scheduler.ReduceLROnPlateau):
             warnings.warn(EPOCH_DEPRECATION_WARNING, UserWarning)
         self.last_epoch = epoch
 
-        if self.is_better(current, self.best):
+        # ReduceLROnPlateau.is_better became private in later versions of PyTorch
+        is_better = self.is_better if hasattr(self, "is_better") else self._is_better
+        if is_better(current, self.best):
             self.best = current
             is_new_best = True
             self.num_bad_epochs = 0
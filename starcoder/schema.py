@@ -1,6 +1,7 @@
 from starcoder.registry import field_classes
 from starcoder.fields import Missing
 import logging
+import numpy
 
 logger = logging.getLogger(__name__)
 
@@ -61,15 +62,24 @@ constructed from in the "json" property.
                                                             data_fields,
                                                             rel_fields,
                                                             rev_rel_fields)
+        # entity types are integer-coded in the order they are declared
+        for entity_type in self.entity_types.keys():
+            self.entity_type_field.observe_value(entity_type)
 
     def encode(self, entity: DecodedEntity) -> EncodedEntity:
         assert isinstance(entity, DecodedEntity)
         retval = EncodedEntity({k : self.data_fields[k].encode(v) if k in self.data_fields else v for k, v in entity.items()})
+        for field in [self.id_field, self.entity_type_field]:
+            if field.name in retval:
+                retval[field.name] = field.encode(retval[field.name])
         return retval
 
     def decode(self, entity: EncodedEntity) -> DecodedEntity:
         assert isinstance(entity, EncodedEntity)
         retval = DecodedEntity({k : self.data_fields[k].decode(v) if k in self.data_fields else v for k, v in entity.items()})
+        for field in [self.id_field, self.entity_type_field]:
+            if field.name in retval:
+                retval[field.name] = field.decode(retval[field.name])
         retval = {k : v for k, v in retval.items() if not isinstance(v, Missing)}
         return retval
 
@@ -82,6 +92,38 @@ constructed from in the "json" property.
             if k in self.data_fields:
                 self.data_fields[k].observe_value(v)
 
+    def observe_columns(self, columns):
+        """
+        Observe values a column at a time, given a dictionary from field names to lists (with
+        None for missing values) or numpy arrays (with NaN for missing values).
+        """
+        for k, column in columns.items():
+            if k in self.data_fields:
+                if isinstance(column, numpy.ndarray) and column.dtype.kind == "f":
+                    self.data_fields[k].observe_values(column[~numpy.isnan(column)])
+                else:
+                    self.data_fields[k].observe_values([v for v in column if v != None])
+
+    def state_dict(self):
+        """
+        The schema's specification and what each of its fields has learned from observed values.
+        The id field is left out: its codes are for every id of every Dataset built over the
+        schema, and a Dataset built over the restored schema observes its own.
+        """
+        return {"spec" : self.json,
+                "fields" : {field.name : field.state_dict() for field in [self.entity_type_field] + list(self.data_fields.values())}}
+
+    @staticmethod
+    def from_state_dict(state):
+        """
+        Rebuild a Schema from the output of state_dict, without observing any entities.
+        """
+        schema = Schema(state["spec"])
+        for field in [schema.id_field, schema.entity_type_field] + list(schema.data_fields.values()):
+            if field.name in state["fields"]:
+                field.load_state_dict(state["fields"][field.name])
+        return schema
+
     def verify(self):
         for name, field in self.data_fields.items():
             if field.empty == True:
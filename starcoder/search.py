@@ -0,0 +1,323 @@
+import argparse
+import json
+import logging
+import math
+import multiprocessing
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+logger = logging.getLogger(__name__)
+
+
+# search space keys that are passed to GraphAutoencoder, rather than to the Trainer or batchifier
+model_keys = ["depth", "autoencoder_shapes", "reverse_relations", "summarizers", "activation", "projected_size", "base_entity_representation_size"]
+
+# search space keys that configure training
+training_keys = ["batchifier", "batch_size", "learning_rate"]
+
+
+def validate_space(space):
+    """
+    Check that a search space only has known keys, each with a non-empty list of choices, and
+    that every summarizer, activation and batchifier it names exists, so a bad space fails when
+    the search is set up rather than in every trial.
+    """
+    from starcoder.registry import summarizer_classes, batchifier_classes
+    for name, choices in space.items():
+        if name not in model_keys + training_keys:
+            raise Exception("Unknown search space key '{}' (should be one of {})".format(name, ", ".join(model_keys + training_keys)))
+        if not isinstance(choices, list) or len(choices) == 0:
+            raise Exception("Search space key '{}' should have a non-empty list of choices".format(name))
+    for name, registry in [("summarizers", summarizer_classes), ("batchifier", batchifier_classes)]:
+        for choice in space.get(name, []):
+            if choice not in registry:
+                raise Exception("Unknown {} '{}' (should be one of {})".format(name, choice, ", ".join(registry)))
+            # resolved here, so e.g. a plugin that can't be imported fails now
+            registry[choice]
+    if "activation" in space:
+        import torch
+        for choice in space["activation"]:
+            if not isinstance(getattr(torch.nn, choice, None), type):
+                raise Exception("Unknown activation '{}' (should be the name of a torch.nn class)".format(choice))
+
+
+def _initialize_worker(threads):
+    import torch
+    torch.set_num_threads(threads)
+
+
+# each worker process builds the schema and datasets once, and reuses them for every trial it runs
+_data = {}
+
+
+def _load_data(directory):
+    if directory not in _data:
+        from starcoder.schema import Schema
+        from starcoder.dataset import Dataset
+        with open(os.path.join(directory, "data.json"), "rt") as ifd:
+            data = json.load(ifd)
+        schema = Schema(data["spec"])
+        for entity in data["train"] + data["dev"]:
+            schema.observe_entity(entity)
+        _data[directory] = (schema, Dataset(schema, data["train"]), Dataset(schema, data["dev"]))
+    return _data[directory]
+
+
+def run_trial(directory, trial_id, config, start_epoch, end_epoch, settings):
+    """
+    Train a trial's model from start_epoch (resuming from its checkpoint, if that's not 0) to
+    end_epoch, and save its checkpoint and optimizer state.  Returns the dev loss of each epoch,
+    and whether the scheduler signaled an early stop.  This runs in a worker process.
+    """
+    import torch
+    from starcoder.ensemble import GraphAutoencoder
+    from starcoder.trainer import Trainer
+    from starcoder.checkpoint import save_checkpoint, load_checkpoint
+    from starcoder.registry import batchifier_classes, summarizer_classes
+    schema, train_data, dev_data = _load_data(directory)
+    trial_directory = os.path.join(directory, "trials", trial_id)
+    checkpoint_path = os.path.join(trial_directory, "checkpoint")
+    trainer_path = os.path.join(trial_directory, "trainer.pt")
+    random.seed(settings["seed"] + start_epoch)
+    torch.manual_seed(settings["seed"] + start_epoch)
+    if start_epoch == 0:
+        model_args = {k : v for k, v in config.items() if k in model_keys}
+        if "summarizers" in model_args:
+            model_args["summarizers"] = summarizer_classes[model_args["summarizers"]]
+        if "activation" in model_args:
+            model_args["activation"] = getattr(torch.nn, model_args["activation"])
+        model = GraphAutoencoder(schema, **model_args)
+    else:
+        model, _ = load_checkpoint(checkpoint_path)
+    batchifier = batchifier_classes[config.get("batchifier", "sample_components")]([])
+    if hasattr(batchifier, "calibrate"):
+        # e.g. BudgetComponents fits its cost model to the trial's model
+        batchifier.calibrate(model, train_data)
+    trainer = Trainer(model,
+                      batchifier,
+                      batch_size=config.get("batch_size", settings["batch_size"]),
+                      learning_rate=config.get("learning_rate", settings["learning_rate"]),
+                      patience=settings["patience"],
+                      early_stop=settings["early_stop"],
+                      prefetch=0)
+    if start_epoch > 0:
+        state = torch.load(trainer_path, weights_only=False)
+        trainer.optimizer.load_state_dict(state["optimizer"])
+        trainer.scheduler.load_state_dict(state["scheduler"])
+    history = trainer.fit(train_data, dev_data, end_epoch - start_epoch)
+    save_checkpoint(checkpoint_path, model, epoch=start_epoch + len(history))
+    torch.save({"optimizer" : trainer.optimizer.state_dict(), "scheduler" : trainer.scheduler.state_dict()}, trainer_path)
+    return {"losses" : [h["dev_loss"] for h in history], "stopped" : len(history) > 0 and history[-1]["early_stop"]}
+
+
+class Search(object):
+    """
+A Search compares configurations of GraphAutoencoder and its training under a
+fixed compute budget, using asynchronous successive halving (ASHA): trials are
+trained for "min_epochs", and whenever a worker is free, a trial among the best
+1/reduction_factor of those that finished a rung is promoted to train for
+reduction_factor times as many epochs (up to "max_epochs"), or if none can be,
+a new trial starts.  Trials whose Scheduler signals an early stop aren't
+promoted.  Nothing starts once the epochs run or committed reach "budget".
+
+The search space is a dictionary from names to lists of choices, where names
+are GraphAutoencoder arguments (with "summarizers" a name from
+summarizer_classes and "activation" a torch.nn class name), "batchifier" (a
+name from batchifier_classes, calibrated for each trial if it needs to be),
+"batch_size" or "learning_rate", e.g.:
+
+  {"depth" : [0, 1, 2], "summarizers" : ["single", "rnn"], "learning_rate" : [0.001, 0.0001]}
+
+The space is checked (see validate_space) when the Search is created.
+
+Trials run in a pool of "workers" processes, each limited to
+"threads_per_trial" intra-op threads.  Everything is kept in "directory": the
+data, the search's state (updated as each trial reports), and each trial's
+checkpoint and optimizer state, so running the same Search again resumes where
+an interrupted one stopped.
+    """
+    def __init__(self,
+                 directory,
+                 space,
+                 min_epochs=1,
+                 max_epochs=27,
+                 reduction_factor=3,
+                 max_trials=20,
+                 budget=None,
+                 workers=2,
+                 threads_per_trial=1,
+                 batch_size=128,
+                 learning_rate=0.001,
+                 patience=5,
+                 early_stop=10,
+                 seed=0):
+        validate_space(space)
+        self.directory = directory
+        self.space = space
+        self.reduction_factor = reduction_factor
+        self.max_trials = max_trials
+        self.budget = budget
+        self.workers = workers
+        self.threads_per_trial = threads_per_trial
+        self.settings = {"batch_size" : batch_size, "learning_rate" : learning_rate, "patience" : patience, "early_stop" : early_stop, "seed" : seed}
+        self.seed = seed
+        self.rungs = []
+        epochs = min_epochs
+        while epochs < max_epochs:
+            self.rungs.append(epochs)
+            epochs = epochs * reduction_factor
+        self.rungs.append(max_epochs)
+        self.state_path = os.path.join(directory, "search.json")
+        if os.path.exists(self.state_path):
+            with open(self.state_path, "rt") as ifd:
+                self.trials = json.load(ifd)["trials"]
+            # trials that were running when the search was interrupted continue from their last report
+            for trial in self.trials.values():
+                if trial["status"] == "running":
+                    trial["status"] = "interrupted"
+            logger.info("Resuming search with %d trials", len(self.trials))
+        else:
+            self.trials = {}
+
+    def prepare(self, spec, train_entities, dev_entities):
+        """
+        Store the schema specification and data the trials train and evaluate on (unless an
+        earlier run of the search already has).
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, "data.json")
+        if not os.path.exists(path):
+            with open(path, "wt") as ofd:
+                json.dump({"spec" : spec, "train" : train_entities, "dev" : dev_entities}, ofd)
+
+    def _save(self):
+        temporary = "{}.tmp".format(self.state_path)
+        with open(temporary, "wt") as ofd:
+            json.dump({"rungs" : self.rungs, "trials" : self.trials}, ofd, indent=2)
+        os.replace(temporary, self.state_path)
+
+    def _sample(self, index):
+        rng = random.Random("{}-{}".format(self.seed, index))
+        return {k : rng.choice(v) for k, v in sorted(self.space.items())}
+
+    def _loss_at(self, trial, epochs):
+        return min(trial["losses"][:epochs])
+
+    def _epochs_committed(self):
+        return sum([t["target"] if t["status"] in ["running", "interrupted"] else t["epochs"] for t in self.trials.values()])
+
+    def _next_job(self):
+        for trial in self.trials.values():
+            if trial["status"] == "interrupted":
+                return (trial, trial["target"])
+        # promote a trial from the highest rung possible, if one is among the best of those that finished it
+        for k in reversed(range(len(self.rungs) - 1)):
+            finished = [t for t in self.trials.values() if t["epochs"] >= self.rungs[k] and len(t["losses"]) >= self.rungs[k]]
+            finished.sort(key=lambda t : self._loss_at(t, self.rungs[k]))
+            for trial in finished[:len(finished) // self.reduction_factor]:
+                if trial["status"] == "paused" and trial["rung"] == k:
+                    return (trial, self.rungs[k + 1])
+        if len(self.trials) < self.max_trials:
+            trial_id = "trial{}".format(len(self.trials))
+            trial = {"id" : trial_id, "config" : self._sample(len(self.trials)), "epochs" : 0, "losses" : [], "rung" : -1, "status" : "paused"}
+            return (trial, self.rungs[0])
+        return None
+
+    def run(self):
+        """
+        Run trials until none can be promoted or started, and return the best trial.
+        """
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=context, initializer=_initialize_worker, initargs=(self.threads_per_trial,)) as executor:
+            running = {}
+            while True:
+                while len(running) < self.workers:
+                    job = self._next_job()
+                    if job == None:
+                        break
+                    trial, target = job
+                    if self.budget != None and self._epochs_committed() + target - trial["epochs"] > self.budget:
+                        logger.info("Not starting more work, as the budget of %d epochs is committed", self.budget)
+                        break
+                    self.trials[trial["id"]] = trial
+                    trial["status"] = "running"
+                    trial["target"] = target
+                    logger.info("Training %s (%s) from epoch %d to %d", trial["id"], json.dumps(trial["config"]), trial["epochs"], target)
+                    future = executor.submit(run_trial, self.directory, trial["id"], trial["config"], trial["epochs"], target, self.settings)
+                    running[future] = trial
+                    self._save()
+                if len(running) == 0:
+                    break
+                done, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+                for future in done:
+                    trial = running.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        logger.error("Trial %s failed: %s", trial["id"], e)
+                        trial["status"] = "failed"
+                        continue
+                    trial["losses"] += result["losses"]
+                    trial["epochs"] = len(trial["losses"])
+                    trial["rung"] = max([-1] + [k for k, r in enumerate(self.rungs) if r <= trial["epochs"]])
+                    if result["stopped"]:
+                        trial["status"] = "stopped"
+                    elif trial["epochs"] >= self.rungs[-1]:
+                        trial["status"] = "done"
+                    else:
+                        trial["status"] = "paused"
+                    logger.info("Trial %s reached epoch %d with dev loss %.4f", trial["id"], trial["epochs"], min(trial["losses"] or [math.inf]))
+                self._save()
+        return self.best()
+
+    def best(self):
+        trials = [t for t in self.trials.values() if len(t["losses"]) > 0]
+        return None if len(trials) == 0 else min(trials, key=lambda t : min(t["losses"]))
+
+
+def _read_entities(path):
+    with open(path, "rt") as ifd:
+        text = ifd.read()
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        return [json.loads(line) for line in text.split("\n") if line.strip() != ""]
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--schema", dest="schema", help="Schema specification file")
+    parser.add_argument("--train", dest="train", help="Training entities (a JSON list, or one JSON object per line)")
+    parser.add_argument("--dev", dest="dev", help="Dev entities (a JSON list, or one JSON object per line)")
+    parser.add_argument("--space", dest="space", help="Search space file (a JSON dictionary from names to lists of choices)")
+    parser.add_argument("-o", "--output", dest="output", help="Search directory (an existing one is resumed)")
+    parser.add_argument("--min_epochs", dest="min_epochs", type=int, default=1)
+    parser.add_argument("--max_epochs", dest="max_epochs", type=int, default=27)
+    parser.add_argument("--reduction_factor", dest="reduction_factor", type=int, default=3)
+    parser.add_argument("--max_trials", dest="max_trials", type=int, default=20)
+    parser.add_argument("--budget", dest="budget", type=int, help="Total epochs across all trials")
+    parser.add_argument("--workers", dest="workers", type=int, default=2)
+    parser.add_argument("--threads_per_trial", dest="threads_per_trial", type=int, default=1)
+    parser.add_argument("--seed", dest="seed", type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    with open(args.space, "rt") as ifd:
+        space = json.load(ifd)
+    search = Search(args.output,
+                    space,
+                    min_epochs=args.min_epochs,
+                    max_epochs=args.max_epochs,
+                    reduction_factor=args.reduction_factor,
+                    max_trials=args.max_trials,
+                    budget=args.budget,
+                    workers=args.workers,
+                    threads_per_trial=args.threads_per_trial,
+                    seed=args.seed)
+    if args.schema:
+        with open(args.schema, "rt") as ifd:
+            search.prepare(json.load(ifd), _read_entities(args.train), _read_entities(args.dev))
+    best = search.run()
+    print(json.dumps(best, indent=2))
@@ -1,6 +1,9 @@
 import random
 import argparse
+import hashlib
+import json
 import logging
+import os
 from starcoder.utils import Configurable
 
 
@@ -8,10 +11,13 @@ logger = logging.getLogger(__name__)
 
 
 class Splitter(Configurable):
+    # whether proportions are rescaled to sum to one (otherwise, only if they sum to more)
+    normalize_proportions = True
     def __init__(self, rest):
         super(Splitter, self).__init__(rest)        
         total = sum(self.proportions)
-        self.proportions = [p / total for p in self.proportions]
+        if self.normalize_proportions or total > 1.0:
+            self.proportions = [p / total for p in self.proportions]
     def __call__(self, data):
         raise UnimplementedException()
 
@@ -50,14 +56,163 @@ class SampleComponents(Splitter):
         random.shuffle(component_indices)
         num_indices = len(component_indices)
         for num in [int(p * num_indices) for p in self.proportions]:
-            other_indices = sum([without_shared.component_indices(ci) for ci in component_indices[:num]], [])
+            other_indices = [i for ci in component_indices[:num] for i in without_shared.component_indices(ci)]
             component_indices = component_indices[num:]
             yield [data.id_to_index[without_shared.index_to_id[i]] for i in other_indices] + shared_entities
 
 
+def _find(parent, x):
+    while parent[x] != x:
+        parent[x] = parent[parent[x]]
+        x = parent[x]
+    return x
+
+
+def read_entities(paths):
+    """
+    Stream entities from files with one JSON object per line.
+    """
+    for path in paths:
+        with open(path, "rt") as ifd:
+            for line in ifd:
+                if line.strip() != "":
+                    yield json.loads(line)
+
+
+class _ShardWriter(object):
+    def __init__(self, directory, name, shard_size):
+        self.directory = directory
+        self.name = name
+        self.shard_size = shard_size
+        self.paths = []
+        self._count = 0
+        self._ofd = None
+
+    def write(self, entity):
+        if self._ofd == None or self._count == self.shard_size:
+            self.close()
+            self.paths.append(os.path.join(self.directory, "{}-{:05d}.jsonl".format(self.name, len(self.paths))))
+            self._ofd = open(self.paths[-1], "wt")
+            self._count = 0
+        self._ofd.write(json.dumps(entity) + "\n")
+        self._count += 1
+
+    def close(self):
+        if self._ofd != None:
+            self._ofd.close()
+            self._ofd = None
+
+
+class HashComponents(Splitter):
+    """
+Assigns each connected component (ignoring shared entity types, as for
+SampleComponents) to a split by hashing its key, the smallest entity id it
+contains, so the same data is always split the same way, regardless of entity
+order, machine, or Python's hash randomization ("salt" draws a different, but
+equally reproducible, split).  Components are found with a union-find over
+entity ids, so besides splitting a Dataset, split_files can stream entities
+from disk twice (once to find components, once to write them out) into
+sharded JSON-lines files for each split, without ever holding the corpus.
+
+Proportions that sum to less than one leave the remaining components out of
+every split (while those that sum to more are rescaled).
+    """
+    normalize_proportions = False
+    arguments = [
+        {"dest" : "proportions", "nargs" : "*", "default" : [], "type" : float, "help" : "List of data proportions"},
+        {"dest" : "shared_entity_types", "nargs" : "*", "default" : [], "help" : "Entity types to be shared across splits"},
+        {"dest" : "split_names", "nargs" : "*", "default" : ["train", "dev", "test"], "help" : "Names of the splits, for output files"},
+        {"dest" : "salt", "default" : "", "help" : "String hashed along with component keys"},
+        {"dest" : "shard_size", "type" : int, "default" : 100000, "help" : "Maximum entities per output file"},
+    ]
+    def __init__(self, rest):
+        super(HashComponents, self).__init__(rest)
+        if len(self.split_names) < len(self.proportions):
+            raise Exception("There are {} proportions but only {} split names".format(len(self.proportions), len(self.split_names)))
+
+    def _split(self, key):
+        digest = hashlib.sha1("{}{}".format(self.salt, key).encode("utf-8")).digest()
+        position = int.from_bytes(digest[:8], "big") / 2**64
+        total = 0.0
+        for i, p in enumerate(self.proportions):
+            total += p
+            if position < total:
+                return i
+        # proportions that sum to one (up to rounding) cover every position
+        return len(self.proportions) - 1 if total > 1.0 - 1e-9 else None
+
+    def assign(self, schema, entities):
+        """
+        Return a dictionary from the id of each entity (as a string) that isn't of a shared type,
+        to the index of its split (or None, if its component is in none of them).
+        """
+        parent = {}
+        edges = []
+        for entity in entities:
+            entity_type = entity[schema.entity_type_field.name]
+            if entity_type in self.shared_entity_types:
+                continue
+            entity_id = str(entity[schema.id_field.name])
+            parent[entity_id] = entity_id
+            for relation_field in schema.entity_types[entity_type].relation_fields if entity_type in schema.entity_types else []:
+                targets = entity.get(relation_field, [])
+                for target in targets if isinstance(targets, list) else [targets]:
+                    edges.append((entity_id, str(target)))
+        for source, target in edges:
+            # like Dataset, relations to entities that aren't there don't connect anything
+            if target in parent:
+                a, b = _find(parent, source), _find(parent, target)
+                if a != b:
+                    parent[max(a, b)] = min(a, b)
+        logger.info("Assigning %d entities to splits", len(parent))
+        return {entity_id : self._split(_find(parent, entity_id)) for entity_id in parent.keys()}
+
+    def __call__(self, data):
+        assignment = self.assign(data.schema, data)
+        shared_entities = data.get_type_indices(*self.shared_entity_types)
+        logger.info("Always including %d entities", len(shared_entities))
+        splits = [[] for _ in self.proportions]
+        for i in range(len(data)):
+            split = assignment.get(str(data.index_to_id[i]))
+            if split != None:
+                splits[split].append(i)
+        for indices in splits:
+            yield indices + shared_entities
+
+    def split_files(self, schema, paths, output_directory):
+        """
+        Split the entities in the given JSON-lines files, writing each split to files named
+        "<split name>-<shard number>.jsonl" in the output directory, with entities of shared types
+        in every split.  Returns a dictionary from split names to their files.
+        """
+        assignment = self.assign(schema, read_entities(paths))
+        os.makedirs(output_directory, exist_ok=True)
+        writers = [_ShardWriter(output_directory, name, self.shard_size) for name in self.split_names[:len(self.proportions)]]
+        for entity in read_entities(paths):
+            if entity[schema.entity_type_field.name] in self.shared_entity_types:
+                for writer in writers:
+                    writer.write(entity)
+            else:
+                split = assignment[str(entity[schema.id_field.name])]
+                if split != None:
+                    writers[split].write(entity)
+        for writer in writers:
+            writer.close()
+        return {writer.name : writer.paths for writer in writers}
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("-i", "--input", dest="input", help="Input file")
-    parser.add_argument("-o", "--output", dest="output", help="Output file")
-    args = parser.parse_args()
+    parser.add_argument("--schema", dest="schema", help="Schema specification file")
+    parser.add_argument("-i", "--inputs", dest="inputs", nargs="+", help="Input files (one JSON object per line)")
+    parser.add_argument("-o", "--output", dest="output", help="Output directory")
+    args, rest = parser.parse_known_args()
+
+    logging.basicConfig(level=logging.INFO)
+    from starcoder.schema import Schema
+    with open(args.schema, "rt") as ifd:
+        schema = Schema(json.load(ifd))
+    splitter = HashComponents(rest)
+    for name, paths in splitter.split_files(schema, args.inputs, args.output).items():
+        logger.info("Wrote %s to %s", name, ", ".join(paths))
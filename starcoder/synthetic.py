@@ -0,0 +1,141 @@
+import argparse
+import json
+import logging
+import math
+import random
+
+logger = logging.getLogger(__name__)
+
+
+def _zipf_choice(rng, values, skew):
+    # picks values[i] with probability proportional to 1 / (i + 1)^skew (uniformly when skew is 0)
+    weights = [1.0 / math.pow(i + 1, skew) for i in range(len(values))]
+    return rng.choices(values, weights=weights)[0]
+
+
+def generate_spec(entity_types=2, field_types={"numeric" : 1, "categorical" : 1, "text" : 1}):
+    """
+    Create a schema spec in the usual JSON layout with the given number of entity types, each
+    with its own data fields of the given types and counts, where each entity type after the
+    first has a (many-to-one) relation to the one before it.
+    """
+    spec = {"meta" : {"id_field" : "id", "entity_type_field" : "entity_type"},
+            "data_fields" : {},
+            "relation_fields" : {},
+            "entity_types" : {}}
+    for t in range(entity_types):
+        entity_type = "type{}".format(t)
+        spec["entity_types"][entity_type] = {"data_fields" : []}
+        for field_type, count in sorted(field_types.items()):
+            for i in range(count):
+                field_name = "{}_{}{}".format(entity_type, field_type, i)
+                spec["data_fields"][field_name] = {"type" : field_type}
+                spec["entity_types"][entity_type]["data_fields"].append(field_name)
+        if t > 0:
+            spec["relation_fields"]["{}_to_type{}".format(entity_type, t - 1)] = {"source_entity_type" : entity_type,
+                                                                                  "target_entity_type" : "type{}".format(t - 1)}
+    return spec
+
+
+def generate(entities=1000,
+             entity_types=2,
+             field_types={"numeric" : 1, "categorical" : 1, "text" : 1},
+             categories=20,
+             category_skew=1.0,
+             text_length=50,
+             text_length_sigma=1.0,
+             max_text_length=2000,
+             vocabulary="abcdefghijklmnopqrstuvwxyz ",
+             missing_rate=0.1,
+             relation_rate=0.9,
+             degree_skew=1.0,
+             component_size=20,
+             component_skew=0.0,
+             seed=0):
+    """
+    Generate a random entity-relationship data set, returning (spec, entities), where the spec
+    is as from generate_spec and the entities are JSON-style dictionaries:
+
+      categorical values are drawn from "categories" values with a Zipfian skew
+      text lengths are log-normal with median "text_length"
+      each data field is missing with probability "missing_rate"
+      each relation is present with probability "relation_rate", and points to an entity
+        of the target type in the same group, chosen with a Zipfian skew so that
+        some entities have many incoming relations and most have few
+      the entities are split into groups whose sizes are Pareto-distributed around
+        "component_size" when "component_skew" is positive (larger is more skewed), and all
+        equal otherwise, and since relations stay within groups, these bound the sizes of
+        the connected components
+    """
+    rng = random.Random(seed)
+    spec = generate_spec(entity_types, field_types)
+    type_names = list(spec["entity_types"].keys())
+    relations = {v["source_entity_type"] : k for k, v in spec["relation_fields"].items()}
+    category_values = ["value{}".format(i) for i in range(categories)]
+
+    def value(field_type):
+        if field_type == "numeric":
+            return rng.gauss(0.0, 1.0)
+        elif field_type == "integer":
+            return rng.randint(0, 100)
+        elif field_type in ["categorical", "keyword", "boolean"]:
+            return _zipf_choice(rng, category_values, category_skew)
+        elif field_type == "text":
+            length = max(1, min(max_text_length, int(rng.lognormvariate(0.0, text_length_sigma) * text_length)))
+            return "".join(rng.choices(vocabulary, k=length))
+        raise Exception("Cannot generate values for field type '{}'".format(field_type))
+
+    retval = []
+    component = 0
+    while len(retval) < entities:
+        size = component_size if component_skew <= 0 else int(component_size * rng.paretovariate(1.0 + 1.0 / component_skew) / (1.0 + component_skew))
+        size = max(1, min(entities - len(retval), size))
+        members = {t : [] for t in type_names}
+        for i in range(size):
+            entity_type = type_names[i % len(type_names)]
+            entity = {"id" : "c{}_e{}".format(component, i), "entity_type" : entity_type}
+            for field_name in spec["entity_types"][entity_type]["data_fields"]:
+                if rng.random() >= missing_rate:
+                    entity[field_name] = value(spec["data_fields"][field_name]["type"])
+            members[entity_type].append(entity["id"])
+            retval.append(entity)
+        for entity in retval[-size:]:
+            relation = relations.get(entity["entity_type"])
+            if relation != None and rng.random() < relation_rate:
+                targets = members[spec["relation_fields"][relation]["target_entity_type"]]
+                if len(targets) > 0:
+                    entity[relation] = _zipf_choice(rng, targets, degree_skew)
+        component += 1
+    logger.info("Generated %d entities in %d groups", len(retval), component)
+    return (spec, retval)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--schema_output", dest="schema_output", help="Output file for the schema")
+    parser.add_argument("--data_output", dest="data_output", help="Output file for the entities (one JSON object per line)")
+    parser.add_argument("--entities", dest="entities", type=int, default=1000, help="Number of entities")
+    parser.add_argument("--entity_types", dest="entity_types", type=int, default=2, help="Number of entity types")
+    parser.add_argument("--field_types", dest="field_types", default='{"numeric" : 1, "categorical" : 1, "text" : 1}', help="JSON dictionary from field types to how many of each every entity type has")
+    parser.add_argument("--text_length", dest="text_length", type=int, default=50, help="Median text length")
+    parser.add_argument("--degree_skew", dest="degree_skew", type=float, default=1.0, help="Skew of relation in-degrees")
+    parser.add_argument("--component_size", dest="component_size", type=int, default=20, help="Typical component size")
+    parser.add_argument("--component_skew", dest="component_skew", type=float, default=0.0, help="Skew of component sizes")
+    parser.add_argument("--seed", dest="seed", type=int, default=0, help="Random seed")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    spec, entities = generate(entities=args.entities,
+                              entity_types=args.entity_types,
+                              field_types=json.loads(args.field_types),
+                              text_length=args.text_length,
+                              degree_skew=args.degree_skew,
+                              component_size=args.component_size,
+                              component_skew=args.component_skew,
+                              seed=args.seed)
+    with open(args.schema_output, "wt") as ofd:
+        json.dump(spec, ofd, indent=2)
+    with open(args.data_output, "wt") as ofd:
+        for entity in entities:
+            ofd.write(json.dumps(entity) + "\n")
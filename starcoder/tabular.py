@@ -0,0 +1,85 @@
+import argparse
+import csv
+import itertools
+import json
+import logging
+import numpy
+from starcoder.dataset import EntityColumns
+from starcoder.fields import NumericField, DistributionField
+
+logger = logging.getLogger(__name__)
+
+
+def convert_column(field, values):
+    """
+    Convert a column of strings from a table (with empty strings for missing values) to the form
+    EntityColumns holds for the field: a float array for numeric fields, otherwise a list.
+    """
+    if isinstance(field, NumericField):
+        values = numpy.array(values)
+        missing = values == ""
+        retval = numpy.full(values.shape, numpy.nan)
+        retval[~missing] = values[~missing].astype(numpy.float64)
+        return retval
+    elif isinstance(field, DistributionField):
+        raise Exception("Distribution field '{}' can't be read from a table".format(field.name))
+    return [None if v == "" else v for v in values]
+
+
+def read_csv(schema, path, entity_type=None, columns={}, chunk_size=10000, observe=True, **reader_args):
+    """
+    Read a CSV file with a header row into EntityColumns, "chunk_size" rows at a time, without
+    creating a dictionary per row.  Columns are renamed to fields by "columns" (others keep their
+    names), and those that aren't in the schema are skipped: a foreign-key column becomes a
+    relation by naming the relation field, whose target is then the id of the row it refers to.
+    If the file is a table of one entity type, rather than having a column for it, give
+    "entity_type".  When "observe" is true, the schema's fields observe each chunk's values.
+    Other arguments are passed to csv.reader (e.g. "delimiter").
+    """
+    table = EntityColumns()
+    with open(path, "rt", newline="") as ifd:
+        reader = csv.reader(ifd, **reader_args)
+        names = [columns.get(c, c) for c in next(reader)]
+        for name in names:
+            if name not in schema.all_fields:
+                logger.warning("Skipping column '%s' of %s, which isn't a field in the schema", name, path)
+        keep = [(i, name) for i, name in enumerate(names) if name in schema.all_fields]
+        if schema.id_field.name not in names:
+            raise Exception("{} has no column for the id field '{}'".format(path, schema.id_field.name))
+        if entity_type == None and schema.entity_type_field.name not in names:
+            raise Exception("{} has no column for the entity type field '{}', and no entity type was given".format(path, schema.entity_type_field.name))
+        while True:
+            rows = list(itertools.islice(reader, chunk_size))
+            if len(rows) == 0:
+                break
+            chunk = {}
+            for i, name in keep:
+                values = [row[i] if i < len(row) else "" for row in rows]
+                chunk[name] = convert_column(schema.data_fields[name], values) if name in schema.data_fields else [None if v == "" else v for v in values]
+            if entity_type != None:
+                chunk[schema.entity_type_field.name] = [entity_type] * len(rows)
+            if observe:
+                schema.observe_columns(chunk)
+            table.append(chunk)
+    logger.info("Read %d rows from %s", len(table), path)
+    return table
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--schema", dest="schema", help="Schema specification file")
+    parser.add_argument("-i", "--input", dest="input", help="Input CSV file")
+    parser.add_argument("--entity_type", dest="entity_type", help="Entity type of every row (if there's no column for it)")
+    parser.add_argument("--columns", dest="columns", default="{}", help="JSON dictionary from column names to field names")
+    parser.add_argument("-o", "--output", dest="output", help="Output file for the entities (one JSON object per line)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    from starcoder.schema import Schema
+    with open(args.schema, "rt") as ifd:
+        schema = Schema(json.load(ifd))
+    table = read_csv(schema, args.input, entity_type=args.entity_type, columns=json.loads(args.columns), observe=False)
+    with open(args.output, "wt") as ofd:
+        for entity in table:
+            ofd.write(json.dumps(entity) + "\n")
@@ -0,0 +1,273 @@
+import logging
+import queue
+import threading
+import time
+import torch
+from starcoder.schedulers import Scheduler
+from starcoder.optimizers import SparseDenseOptimizer, split_parameters
+from starcoder.models import LossEngine
+from starcoder.ensemble import OutputSpec, EnsembleOutput, GraphAutoencoderEnsemble
+
+logger = logging.getLogger(__name__)
+
+
+def sum_losses(losses_by_field, autoencoder_losses):
+    """
+    The default loss policy: the unweighted sum of the field losses and (already-weighted)
+    autoencoder layer losses.
+    """
+    return sum(losses_by_field.values()) + sum(autoencoder_losses.values())
+
+
+class Prefetcher(object):
+    """
+Iterates over the batches a Batchifier produces, while a background thread
+prepares up to "size" batches ahead (subselection, component extraction,
+encoding and stack_batch all happen off the training thread).  Exceptions
+raised while preparing batches are re-raised by the iterator.  If iteration
+stops early (an exception in the training loop, a break, or the iterator being
+discarded), or close() is called, the thread stops at its next batch rather
+than waiting forever for room in the queue.
+    """
+    _finished = object()
+
+    def __init__(self, batchifier, data, batch_size, size=2, poll_seconds=0.1):
+        self._queue = queue.Queue(maxsize=max(1, size))
+        self._stop = threading.Event()
+        self._poll_seconds = poll_seconds
+        self._thread = threading.Thread(target=self._run, args=(batchifier, data, batch_size), daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=self._poll_seconds)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(self, batchifier, data, batch_size):
+        try:
+            for batch in batchifier(data, batch_size):
+                if not self._put(batch):
+                    return
+            self._put(self._finished)
+        except Exception as e:
+            self._put(e)
+
+    def close(self):
+        """
+        Stop preparing batches, and drop any that are waiting.
+        """
+        self._stop.set()
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+
+    def __iter__(self):
+        try:
+            while True:
+                item = self._queue.get()
+                if item is self._finished:
+                    return
+                elif isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            self.close()
+
+
+class Trainer(object):
+    """
+A Trainer runs the training loop for a GraphAutoencoder over batches from a
+Batchifier:
+
+  fit(train_data, dev_data, max_epochs) trains until max_epochs or until the
+  scheduler signals early stopping, reducing the learning rate whenever the
+  scheduler says to, and returns a list with each epoch's statistics
+
+  train_epoch(data) and evaluate(data) each make one pass over a Dataset,
+  returning (total loss, per-field mean losses, statistics), where the
+  statistics include wall-clock seconds per phase (data, forward, backward,
+  optimizer) and entities per second
+
+Batches are prepared "prefetch" batches ahead in a background thread, and the
+optimizer steps every "gradient_accumulation" batches.  Evaluation runs under
+torch.inference_mode() and does no optimizer work.  Field losses are computed
+together by a LossEngine, reusing the forward pass's field masks, and the loss
+for each batch is loss_policy(losses_by_field, autoencoder_losses), by default
+their sum.  The autoencoder losses are a dictionary from (entity type name,
+depth) to that autoencoder's own reconstruction loss, scaled by
+"autoencoder_loss": when that is zero (the default) they're empty, and the
+model doesn't compute them at all.  The optimizer defaults to Adam, or a
+SparseDenseOptimizer if the model has sparse-gradient embeddings, and the
+scheduler to a Scheduler over it.  Given a BatchCache as "batch_cache",
+evaluation replays the batches prepared on its first pass over each dataset.
+For a GraphAutoencoderEnsemble, each member's field losses are computed from
+its own reconstructions, and summed over the members.
+    """
+    def __init__(self,
+                 model,
+                 batchifier,
+                 batch_size=128,
+                 optimizer=None,
+                 scheduler=None,
+                 learning_rate=0.001,
+                 patience=5,
+                 early_stop=10,
+                 gradient_accumulation=1,
+                 prefetch=2,
+                 loss_policy=sum_losses,
+                 autoencoder_loss=0.0,
+                 batch_cache=None):
+        self.model = model
+        self.batchifier = batchifier
+        self.batch_size = batch_size
+        self.gradient_accumulation = gradient_accumulation
+        self.prefetch = prefetch
+        self.loss_policy = loss_policy
+        self.autoencoder_loss = autoencoder_loss
+        self.batch_cache = batch_cache
+        self.outputs = OutputSpec(layer_losses=autoencoder_loss > 0)
+        # an ensemble's members each have their own losses (which may have parameters, e.g. adaptive softmaxes)
+        self.loss_engines = [LossEngine(m.field_losses) for m in model.members] if isinstance(model, GraphAutoencoderEnsemble) else [LossEngine(model.field_losses)]
+        self.loss_engine = self.loss_engines[0]
+        if optimizer == None:
+            sparse, dense = split_parameters(model)
+            optimizer = SparseDenseOptimizer(model, lr=learning_rate) if len(sparse) > 0 else torch.optim.Adam(dense, lr=learning_rate)
+        self.optimizer = optimizer
+        self.scheduler = Scheduler(early_stop, self.optimizer, patience=patience) if scheduler == None else scheduler
+
+    def batches(self, data):
+        if self.prefetch > 0:
+            return Prefetcher(self.batchifier, data, self.batch_size, self.prefetch)
+        return self.batchifier(data, self.batch_size)
+
+    def compute_losses(self, entities, output):
+        """
+        Return a dictionary from field names to the field's loss for the batch, given the model's output.
+        """
+        if isinstance(output, EnsembleOutput):
+            losses = {}
+            for loss_engine, member in zip(self.loss_engines, output.members):
+                for field_name, loss in loss_engine.field_losses(entities, member.reconstructions, member.field_masks).items():
+                    losses[field_name] = losses[field_name] + loss if field_name in losses else loss
+            return losses
+        return self.loss_engine.field_losses(entities, output.reconstructions, output.field_masks)
+
+    def _run(self, data, train):
+        stats = {"data" : 0.0, "forward" : 0.0, "backward" : 0.0, "optimizer" : 0.0, "batches" : 0, "entities" : 0}
+        device = self.model.device
+        total_loss = torch.tensor(0.0, device=device)
+        field_loss_totals = {}
+        self.model.train(train)
+        if train:
+            self.optimizer.zero_grad()
+        start = time.perf_counter()
+        last = start
+        if train or self.batch_cache == None:
+            batches = self.batches(data)
+        else:
+            batches = self.batch_cache.batches(data, self.batch_size, lambda : self.batches(data))
+        for batch_num, (entities, adjacencies) in enumerate(batches):
+            logger.debug("Processing batch #%d", batch_num)
+            entities = {k : v.to(device) if isinstance(v, torch.Tensor) else v for k, v in entities.items()}
+            adjacencies = {k : v.to(device) for k, v in adjacencies.items()}
+            now = time.perf_counter()
+            stats["data"] += now - last
+            last = now
+
+            output = self.model(entities, adjacencies, self.outputs)
+            losses = self.compute_losses(entities, output)
+            layer_losses = {k : self.autoencoder_loss * v for k, v in output.layer_losses.items()}
+            loss = self.loss_policy(losses, layer_losses)
+            now = time.perf_counter()
+            stats["forward"] += now - last
+            last = now
+
+            if train:
+                (loss / self.gradient_accumulation).backward()
+                now = time.perf_counter()
+                stats["backward"] += now - last
+                last = now
+                if (batch_num + 1) % self.gradient_accumulation == 0:
+                    self.optimizer.step()
+                    self.optimizer.zero_grad()
+                    now = time.perf_counter()
+                    stats["optimizer"] += now - last
+                    last = now
+
+            # accumulated as detached tensors, so there's no device synchronization until the end of the pass
+            total_loss += loss.detach()
+            for field_name, field_loss in losses.items():
+                field_loss_totals[field_name] = field_loss_totals.get(field_name, 0.0) + field_loss.detach()
+            stats["batches"] += 1
+            stats["entities"] += len(entities[self.model.schema.id_field.name])
+        if train and stats["batches"] % self.gradient_accumulation != 0:
+            # the last group is short, but its losses were still divided by gradient_accumulation,
+            # so its gradients are rescaled to the group's mean before the step
+            scale = self.gradient_accumulation / (stats["batches"] % self.gradient_accumulation)
+            for group in self.optimizer.param_groups:
+                for p in group["params"]:
+                    if p.grad != None:
+                        p.grad.mul_(scale)
+            self.optimizer.step()
+            self.optimizer.zero_grad()
+            stats["optimizer"] += time.perf_counter() - last
+        stats["seconds"] = time.perf_counter() - start
+        stats["entities_per_second"] = stats["entities"] / stats["seconds"] if stats["seconds"] > 0 else 0.0
+        field_losses = {k : float(v) / stats["batches"] for k, v in field_loss_totals.items()}
+        return (float(total_loss), field_losses, stats)
+
+    def train_epoch(self, data):
+        return self._run(data, True)
+
+    def evaluate(self, data):
+        old_mode = self.model.training
+        with torch.inference_mode():
+            retval = self._run(data, False)
+        self.model.train(old_mode)
+        return retval
+
+    def fit(self, train_data, dev_data, max_epochs, on_new_best=None):
+        """
+        Train for up to max_epochs epochs, calling on_new_best(epoch, dev_loss), if given, whenever
+        the dev loss improves.
+        """
+        history = []
+        for epoch in range(1, max_epochs + 1):
+            train_loss, train_field_losses, train_stats = self.train_epoch(train_data)
+            dev_loss, dev_field_losses, dev_stats = self.evaluate(dev_data)
+            reduce_rate, early_stop, new_best = self.scheduler.step(dev_loss)
+            logger.info("Epoch %d: train loss=%.4f (%.1f entities/second), dev loss=%.4f (%.1f entities/second)",
+                        epoch,
+                        train_loss,
+                        train_stats["entities_per_second"],
+                        dev_loss,
+                        dev_stats["entities_per_second"])
+            logger.debug("Train phase seconds: data=%.3f forward=%.3f backward=%.3f optimizer=%.3f",
+                         train_stats["data"],
+                         train_stats["forward"],
+                         train_stats["backward"],
+                         train_stats["optimizer"])
+            history.append({"epoch" : epoch,
+                            "train_loss" : train_loss,
+                            "train_field_losses" : train_field_losses,
+                            "train_stats" : train_stats,
+                            "dev_loss" : dev_loss,
+                            "dev_field_losses" : dev_field_losses,
+                            "dev_stats" : dev_stats,
+                            "reduced_rate" : reduce_rate,
+                            "new_best" : new_best,
+                            "early_stop" : early_stop})
+            if reduce_rate:
+                logger.info("Reducing learning rate")
+            if new_best and on_new_best != None:
+                on_new_best(epoch, dev_loss)
+            if early_stop:
+                logger.info("Stopping early after epoch %d", epoch)
+                break
+        return history
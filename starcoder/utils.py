@@ -1,14 +1,11 @@
-import pickle
 import re
-import gzip
-import sys
 import argparse
-import json
 import random
 import logging
 import warnings
 import numpy
-import torch
+from starcoder import profiling
+from starcoder.dataset import EntityColumns
 
 logger = logging.getLogger(__name__)
 
@@ -37,95 +34,6 @@ class Configurable(object):
             setattr(self, k, v)
 
 
-# def compute_losses(entities, reconstructions, schema):
-#     """
-#     Gather and return all the field losses as a nested dictionary where the first
-#     level of keys are field types, and the second level are field names.
-#     """
-#     losses = {}
-#     for field_name, field_values in entities.items():
-#         if field_name in schema.data_fields:
-#             logger.debug("Computing losses for field %s", field_name)
-#             #mask = entity_values > 0
-#             field_type = type(schema.data_fields[field_name])
-#             reconstruction_values = reconstructions[field_name]
-#             #print(field_name, entity_values.shape, reconstruction_values.shape)
-#             #recon = torch.reshape(reconstruction_values, (reconstruction_values.shape[0], -1)).sum(1)
-#             #selector = torch.masked_select(torch.arange(0, entity_values.shape[0]),
-#             #                               ~torch.isnan(entity_values) & ~torch.isnan(recon))
-#             losses[field_type] = losses.get(field_type, {})
-#             #masked_entity_values = torch.index_select(entity_values, 0, selector) #~torch.isnan(entity_values))
-#             #print(field_values, reconstruction_values)
-#             #print(field_name, field_values.shape, reconstruction_values.shape)
-#             #masked_reconstruction_values = torch.index_select(reconstruction_values, 0, selector) #~torch.isnan(entity_values))
-#             #masked_field_losses =
-#             field_losses = field_model_classes[field_type][2](reconstruction_values, field_values)
-#             losses[field_type][field_name] = field_losses
-#     return losses
-
-
-
-# def run_over_components(model, batchifier, optim, loss_policy, data, batch_size, gpu, train, subselect=False, strict=True, mask_tests=[]):
-#     old_mode = model.training
-#     model.train(train)
-#     loss_by_field = {}
-#     loss = 0.0
-#     for batch_num, ((full_entities, full_adjacencies), (masked_entities, masked_adjacencies)) in enumerate(batchifier(data, batch_size)):
-#         logger.debug("Processing batch #%d", batch_num)
-#         batch_loss_by_field = {}
-#         if gpu:
-#             entities = {k : v.cuda() for k, v in entities.items()}
-#             adjacencies = {k : v.cuda() for k, v in adjacencies.items()}
-#         optim.zero_grad()
-#         reconstructions, bottlenecks, ae_pairs = model(masked_entities, masked_adjacencies)
-#         for field_type, fields in compute_losses(full_entities, reconstructions, data.schema).items():
-#             for field_name, losses in fields.items():
-#                 batch_loss_by_field[(field_name, field_type)] = losses        
-#         batch_loss = loss_policy(batch_loss_by_field, ae_pairs)
-#         loss += batch_loss
-#         if train:            
-#             batch_loss.backward()
-#             optim.step()
-#         for k, v in batch_loss_by_field.items():
-#             loss_by_field[k] = loss_by_field.get(k, [])
-#             loss_by_field[k].append(v.clone().detach())
-#     model.train(old_mode)
-#     return (loss, loss_by_field)
-
-
-# def run_epoch(model, batchifier, optimizer, loss_policy, train_data, dev_data, batch_size, gpu, mask_tests=[], subselect=False):
-#     model.train(True)
-#     logger.debug("Running over training data")
-#     train_loss, train_loss_by_field = run_over_components(model,
-#                                                           batchifier,
-#                                                           optimizer, 
-#                                                           loss_policy,
-#                                                           train_data, 
-#                                                           batch_size, 
-#                                                           gpu,
-#                                                           subselect=subselect,
-#                                                           train=True,
-#                                                           mask_tests=mask_tests,
-#     )
-#     logger.debug("Running over dev data")
-#     model.train(False)
-#     dev_loss, dev_loss_by_field = run_over_components(model,
-#                                                       batchifier,
-#                                                       optimizer, 
-#                                                       loss_policy,
-#                                                       dev_data, 
-#                                                       batch_size, 
-#                                                       gpu,
-#                                                       subselect=subselect,
-#                                                       train=False,
-#                                                       mask_tests=mask_tests,
-#     )
-
-#     return (train_loss.clone().detach().cpu(), 
-#             {k : [v.clone().detach().cpu() for v in vv] for k, vv in train_loss_by_field.items()},
-#             dev_loss.clone().detach().cpu(),
-#             {k : [v.clone().detach().cpu() for v in vv] for k, vv in dev_loss_by_field.items()})
-
 def batch_to_list(batch):
     """
     Take a batch, which represents data in the R/pandas style of a dictionary where keys are field names
@@ -142,6 +50,8 @@ def batch_to_list(batch):
 
 
 def tensorize(vals, field_obj):
+    # torch is imported here rather than with the module, so e.g. splitting data doesn't load it
+    import torch
     if any([isinstance(v, list) for v in vals]):
         max_length = max([len(v) for v in vals if isinstance(v, list)])
         vals = [(v + ([0] * (max_length - len(v)))) if v != None else [0] * max_length for v in vals]
@@ -149,10 +59,23 @@ def tensorize(vals, field_obj):
         return numpy.array(vals)
     else:
         vals = [(field_obj.missing_value if v == None else v) for v in vals]    
-    retval = torch.tensor(vals, dtype=field_obj.encoded_type)
+    dtype = getattr(torch, field_obj.encoded_type) if isinstance(field_obj.encoded_type, str) else field_obj.encoded_type
+    retval = torch.tensor(vals, dtype=dtype)
     return retval
 
 
+def tensorize_column(column, field_obj):
+    """
+    Encode a column of values (as EntityColumns holds them) for a field and tensorize it, giving
+    the same tensor as encoding each value and passing them to tensorize.
+    """
+    import torch
+    if isinstance(column, numpy.ndarray) and column.dtype.kind == "f" and field_obj.encoded_type == "float32":
+        # numeric columns are already float arrays, with NaN for missing values
+        return torch.from_numpy(column.astype(numpy.float32))
+    return tensorize(field_obj.encode_values(column), field_obj)
+
+
 def split_batch(entities, adjacencies, count):
     """
 Naively split a batch in two.
@@ -175,24 +98,46 @@ Naively split a batch in two.
 
 
 def stack_batch(components, schema):
+    with profiling.stage("stack_batch") as stage:
+        retval = _stack_batch(components, schema)
+        stage.record(retval)
+    return retval
+
+
+def _stack_batch(components, schema):
+    import torch
     lengths = [len(x) for x, _ in components]
-    entities = sum([x for x, _ in components], [])
+    total = sum(lengths)
     adjacencies = [x for _, x in components]
     full_adjacencies = {}
     start = 0
     for l, adjs in zip(lengths, adjacencies):
         for name, adj in adjs.items():
-            full_adjacencies[name] = full_adjacencies.get(name, numpy.full((len(entities), len(entities)), False))
+            full_adjacencies[name] = full_adjacencies.get(name, numpy.full((total, total), False))
             full_adjacencies[name][start:start + l, start:start + l] = adj.todense()
         start += l
+    # ids and entity types have integer codes, so they travel as int64 tensors like the data fields
+    tensor_fields = dict(schema.data_fields)
+    tensor_fields[schema.id_field.name] = schema.id_field
+    tensor_fields[schema.entity_type_field.name] = schema.entity_type_field
+    if len(components) > 0 and all([isinstance(x, EntityColumns) for x, _ in components]):
+        # components of columnar storage are stacked and encoded a column at a time, without building entities
+        columns = EntityColumns.concatenate([x for x, _ in components])
+        full_entities = {}
+        for k in set(columns.names + list(schema.data_fields.keys())):
+            with profiling.stage("tensorize", field=k) as stage:
+                full_entities[k] = numpy.array(columns.column(k)) if k not in tensor_fields else tensorize_column(columns.column(k), tensor_fields[k])
+                stage.record(full_entities[k])
+        return (full_entities, {k : torch.tensor(v) for k, v in full_adjacencies.items()})
+    entities = sum([list(x) for x, _ in components], [])
     field_names = set(sum([[k for k in e.keys()] for e in entities], list(schema.data_fields.keys())))
     full_entities = {k : [] for k in field_names}
     for entity in entities:
         enc_entity = schema.encode(entity)
         for field_name in field_names:
             full_entities[field_name].append(enc_entity.get(field_name, None))
-    full_entities = {k : numpy.array(v) if k not in schema.data_fields else tensorize(v, schema.data_fields[k]) for k, v in full_entities.items()}
-    ne = len(entities)
-    for k, v in full_adjacencies.items():
-        a, b = v.shape
+    for k, v in list(full_entities.items()):
+        with profiling.stage("tensorize", field=k) as stage:
+            full_entities[k] = numpy.array(v) if k not in tensor_fields else tensorize(v, tensor_fields[k])
+            stage.record(full_entities[k])
     return (full_entities, {k : torch.tensor(v) for k, v in full_adjacencies.items()})
@@ -0,0 +1,25 @@
+import pytest
+import torch
+from starcoder.schema import Schema
+from starcoder.dataset import Dataset
+from starcoder.synthetic import generate
+
+
+def build_data(entities=120, field_args={}, seed=0, **generator_args):
+    """
+    A Schema and Dataset of synthetic entities, where "field_args" adds entries to fields'
+    specifications (e.g. {"type1_text0" : {"encoder" : "convolutional"}}).
+    """
+    spec, data = generate(entities=entities, component_size=6, text_length=8, seed=seed, **generator_args)
+    for field_name, args in field_args.items():
+        spec["data_fields"][field_name].update(args)
+    schema = Schema(spec)
+    for entity in data:
+        schema.observe_entity(entity)
+    return (schema, Dataset(schema, data))
+
+
+@pytest.fixture
+def build():
+    torch.manual_seed(0)
+    return build_data
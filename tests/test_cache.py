@@ -0,0 +1,77 @@
+import gc
+import random
+import torch
+from starcoder.ensemble import GraphAutoencoder
+from starcoder.batchifiers import SampleComponents
+from starcoder.cache import BatchCache, batch_bytes
+from starcoder.trainer import Trainer
+
+
+def batches_equal(first, second):
+    if len(first) != len(second):
+        return False
+    for (e1, a1), (e2, a2) in zip(first, second):
+        if e1.keys() != e2.keys() or a1.keys() != a2.keys():
+            return False
+        for k in e1:
+            # missing numeric values are NaN, which never equals itself
+            if isinstance(e1[k], torch.Tensor) and not torch.equal(torch.nan_to_num(e1[k]), torch.nan_to_num(e2[k])):
+                return False
+        for k in a1:
+            if not torch.equal(a1[k], a2[k]):
+                return False
+    return True
+
+
+def test_replays_first_pass(build, tmp_path):
+    _, data = build()
+    for directory in [None, str(tmp_path)]:
+        cache = BatchCache(directory=directory)
+        made = []
+        def make_batches():
+            made.append(True)
+            return SampleComponents([])(data, 32)
+        first = list(cache.batches(data, 32, make_batches))
+        second = list(cache.batches(data, 32, make_batches))
+        assert len(made) == 1
+        # the batchifier shuffles, so only replaying gives the same batches
+        assert batches_equal(first, second)
+        assert cache.total_bytes == sum([batch_bytes(b) for b in first])
+        cache.clear()
+        assert cache.total_bytes == 0
+
+
+def test_max_bytes(build):
+    _, data = build()
+    _, other = build(seed=1)
+    batches = list(SampleComponents([])(data, 32))
+    other_batches = list(SampleComponents([])(other, 32))
+    size = sum([batch_bytes(b) for b in batches])
+    cache = BatchCache(max_bytes=size // 2)
+    list(cache.batches(data, 32, lambda : iter(batches)))
+    assert cache.total_bytes == 0
+    # a dataset that doesn't fit is passed through from then on
+    made = []
+    list(cache.batches(data, 32, lambda : made.append(True) or iter(batches)))
+    assert len(made) == 1
+    # until it's collected, when its id could be reused by a new dataset
+    _, doomed = build(seed=2)
+    list(cache.batches(doomed, 32, lambda : iter(batches)))
+    assert (id(doomed), 32) in cache._uncacheable
+    del doomed
+    gc.collect()
+    assert list(cache._uncacheable.keys()) == [(id(data), 32)]
+    cache = BatchCache(max_bytes=size + sum([batch_bytes(b) for b in other_batches]) - 1)
+    list(cache.batches(data, 32, lambda : iter(batches)))
+    list(cache.batches(other, 32, lambda : iter(other_batches)))
+    # the least-recently-used dataset was evicted
+    assert list(cache._entries.keys()) == [(id(other), 32)]
+
+
+def test_trainer_evaluates_cached_batches(build):
+    schema, data = build()
+    trainer = Trainer(GraphAutoencoder(schema, 1, [16, 8]), SampleComponents([]), batch_size=32, batch_cache=BatchCache())
+    random.seed(0)
+    first = trainer.evaluate(data)[0]
+    random.seed(1)
+    assert trainer.evaluate(data)[0] == first
@@ -0,0 +1,71 @@
+import json
+import os
+import torch
+from starcoder.ensemble import GraphAutoencoder, GraphAutoencoderEnsemble
+from starcoder.batchifiers import SampleComponents
+from starcoder.trainer import Trainer
+from starcoder.dataset import Dataset
+from starcoder.checkpoint import save_checkpoint, load_checkpoint, CheckpointSaver, schema_file
+from starcoder.utils import stack_batch
+
+
+def outputs(model, data):
+    model.eval()
+    entities, adjacencies = stack_batch([data.component(i) for i in range(data.num_components)], data.schema)
+    with torch.no_grad():
+        return model(entities, adjacencies)
+
+
+def test_round_trip(build, tmp_path):
+    schema, data = build()
+    model = GraphAutoencoder(schema, 1, [16, 8], reverse_relations=True)
+    path = os.path.join(tmp_path, "checkpoint")
+    save_checkpoint(path, model, epoch=3)
+    loaded, metadata = load_checkpoint(path)
+    assert metadata == {"epoch" : 3}
+    assert loaded.config["reverse_relations"]
+    # the restored schema has no ids until a Dataset is built over it
+    loaded_data = Dataset(loaded.schema, [data[i] for i in range(len(data))])
+    expected = outputs(model, data)
+    actual = outputs(loaded, loaded_data)
+    assert torch.equal(expected.bottlenecks, actual.bottlenecks)
+    for field_name in schema.data_fields:
+        assert torch.equal(expected.reconstructions[field_name], actual.reconstructions[field_name])
+
+
+def test_schema_leaves_out_ids(build, tmp_path):
+    schema, data = build()
+    path = os.path.join(tmp_path, "checkpoint")
+    save_checkpoint(path, GraphAutoencoder(schema, 1, [16, 8]))
+    with open(os.path.join(path, schema_file), "rt") as ifd:
+        state = json.load(ifd)
+    assert schema.id_field.name not in state["fields"]
+    assert data[0]["id"] not in json.dumps(state)
+
+
+def test_checkpoint_saver(build, tmp_path):
+    schema, data = build()
+    model = GraphAutoencoder(schema, 1, [16, 8])
+    path = os.path.join(tmp_path, "best")
+    saver = CheckpointSaver(model, path)
+    Trainer(model, SampleComponents([]), batch_size=32).fit(data, data, 2, on_new_best=saver)
+    saver.wait()
+    _, metadata = load_checkpoint(path)
+    assert metadata["epoch"] in [1, 2]
+
+
+def test_ensemble_round_trip(build, tmp_path):
+    schema, data = build()
+    model = GraphAutoencoderEnsemble(schema, 1, [16, 8], members=3, seed=1)
+    path = os.path.join(tmp_path, "checkpoint")
+    saver = CheckpointSaver(model, path, background=False)
+    saver.save(epoch=1)
+    loaded, metadata = load_checkpoint(path)
+    assert isinstance(loaded, GraphAutoencoderEnsemble)
+    assert len(loaded.members) == 3 and loaded.config["seed"] == 1
+    loaded_data = Dataset(loaded.schema, [data[i] for i in range(len(data))])
+    expected = outputs(model, data)
+    actual = outputs(loaded, loaded_data)
+    assert torch.equal(expected.member_bottlenecks, actual.member_bottlenecks)
+    for field_name in schema.data_fields:
+        assert torch.equal(expected.reconstructions[field_name], actual.reconstructions[field_name])
@@ -0,0 +1,85 @@
+import pytest
+import torch
+from starcoder.ensemble import GraphAutoencoderEnsemble, OutputSpec
+from starcoder.batchifiers import SampleComponents
+from starcoder.models import LossEngine
+from starcoder.registry import summarizer_classes
+from starcoder.trainer import Trainer
+
+
+cases = [({}, {}, None),
+         ({}, {"reverse_relations" : True, "summarizers" : summarizer_classes["rnn"]}, None),
+         ({"type1_text0" : {"encoder" : "convolutional"}}, {"checkpoint_depths" : True}, OutputSpec(layer_losses=True)),
+         ({}, {}, OutputSpec(fields=["type0_numeric0"], entity_types=["type0"], bottlenecks=False))]
+
+
+@pytest.mark.parametrize("field_args, model_args, outputs", cases)
+@pytest.mark.parametrize("train", [True, False])
+def test_members_match_alone(build, field_args, model_args, outputs, train):
+    schema, data = build(field_args=field_args)
+    ensemble = GraphAutoencoderEnsemble(schema, 2, [16, 8], members=3, seed=0, **model_args)
+    ensemble.train(train)
+    entities, adjacencies = next(iter(SampleComponents([])(data, 32)))
+    output = ensemble(entities, adjacencies, outputs)
+    for member, member_output in zip(ensemble.members, output.members):
+        alone = member(entities, adjacencies, outputs)
+        assert alone.reconstructions.keys() == member_output.reconstructions.keys()
+        for k, v in alone.reconstructions.items():
+            assert torch.allclose(v, member_output.reconstructions[k], atol=1e-5), k
+        assert (alone.bottlenecks == None) == (member_output.bottlenecks == None)
+        if alone.bottlenecks != None:
+            assert torch.allclose(alone.bottlenecks, member_output.bottlenecks, atol=1e-5)
+        assert alone.layer_losses.keys() == member_output.layer_losses.keys()
+        for k, v in alone.layer_losses.items():
+            assert torch.allclose(v, member_output.layer_losses[k], atol=1e-5)
+
+
+def test_gradients_match_alone(build):
+    schema, data = build()
+    ensemble = GraphAutoencoderEnsemble(schema, 1, [16, 8], members=2, seed=0)
+    entities, adjacencies = next(iter(SampleComponents([])(data, 32)))
+    output = ensemble(entities, adjacencies, OutputSpec(layer_losses=True))
+    loss = 0.0
+    for member, member_output in zip(ensemble.members, output.members):
+        loss = loss + LossEngine(member.field_losses)(entities, member_output.reconstructions, member_output.field_masks)[0] + sum(member_output.layer_losses.values())
+    loss.backward()
+    ensemble_gradients = [[None if p.grad == None else p.grad.clone() for p in member.parameters()] for member in ensemble.members]
+    ensemble.zero_grad(set_to_none=True)
+    for member, gradients in zip(ensemble.members, ensemble_gradients):
+        alone = member(entities, adjacencies, OutputSpec(layer_losses=True))
+        loss = LossEngine(member.field_losses)(entities, alone.reconstructions, alone.field_masks)[0] + sum(alone.layer_losses.values())
+        loss.backward()
+        for p, g in zip(member.parameters(), gradients):
+            assert (p.grad == None) == (g == None)
+            if g != None:
+                assert torch.allclose(p.grad, g, atol=1e-5)
+
+
+def test_ensemble_training(build):
+    schema, data = build()
+    ensemble = GraphAutoencoderEnsemble(schema, 1, [16, 8], members=3, seed=0, member_workers=2)
+    before = [[p.detach().clone() for p in member.parameters()] for member in ensemble.members]
+    history = Trainer(ensemble, SampleComponents([]), batch_size=32).fit(data, data, 1)
+    assert torch.isfinite(torch.tensor(history[0]["dev_loss"]))
+    for member, parameters in zip(ensemble.members, before):
+        assert any([not torch.equal(b, p) for b, p in zip(parameters, member.parameters())])
+
+
+def test_adaptive_decoder_outputs(build):
+    schema, data = build(field_args={"type0_categorical0" : {"decoder" : "adaptive", "cutoffs" : [2]}})
+    ensemble = GraphAutoencoderEnsemble(schema, 1, [16, 8], members=3, seed=0)
+    entities, adjacencies = next(iter(SampleComponents([])(data, 32)))
+    # in training, members output hidden states, which are only for their losses
+    ensemble.train()
+    output = ensemble(entities, adjacencies)
+    assert "type0_categorical0" not in output.reconstructions
+    assert "type0_categorical0" not in output.uncertainty
+    assert all(["type0_categorical0" in m.reconstructions for m in output.members])
+    ensemble.eval()
+    with torch.no_grad():
+        output = ensemble(entities, adjacencies)
+    probabilities = output.reconstructions["type0_categorical0"].exp().sum(1)
+    assert torch.allclose(probabilities, torch.ones_like(probabilities), atol=1e-4)
+    assert (output.uncertainty["type0_categorical0"] >= -1e-5).all()
+    history = Trainer(ensemble, SampleComponents([]), batch_size=32).fit(data, data, 1)
+    assert torch.isfinite(torch.tensor(history[0]["dev_loss"]))
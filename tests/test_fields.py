@@ -0,0 +1,46 @@
+import copy
+import threading
+from starcoder.schema import EncodedEntity
+from starcoder.fields import IdField, EntityTypeField
+from starcoder.utils import stack_batch
+
+
+def test_ids_and_entity_types_are_integer_coded(build):
+    schema, data = build()
+    entities, _ = stack_batch([data.component(i) for i in range(3)], schema)
+    assert str(entities["id"].dtype) == "torch.int64"
+    assert str(entities["entity_type"].dtype) == "torch.int64"
+    decoded = schema.decode(EncodedEntity({"id" : entities["id"][0].item(), "entity_type" : entities["entity_type"][0].item()}))
+    assert decoded["id"] == data.component(0)[0][0]["id"]
+    assert decoded["entity_type"] == data.component(0)[0][0]["entity_type"]
+
+
+def test_coded_fields_share_behavior():
+    for field in [IdField("id"), EntityTypeField("entity_type")]:
+        for v in ["a", "b", "a"]:
+            field.observe_value(v)
+        assert len(field) == 2
+        assert [field.encode(v) for v in ["a", "b", "c"]] == [0, 1, field.missing_value]
+        assert field.decode(1) == "b"
+
+
+def test_concurrent_id_observation_gives_distinct_codes():
+    field = IdField("id")
+    def observe(offset):
+        for i in range(2000):
+            field.observe_value("{}-{}".format(offset, i))
+    threads = [threading.Thread(target=observe, args=(t,)) for t in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(field) == 8000
+    assert sorted(field._lookup.values()) == list(range(8000))
+
+
+def test_coded_fields_can_be_copied(build):
+    schema, _ = build()
+    copied = copy.deepcopy(schema)
+    copied.id_field.observe_value("new")
+    assert copied.id_field.encode("new") == len(schema.id_field)
+    assert schema.id_field.encode("new") == schema.id_field.missing_value
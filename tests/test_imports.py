@@ -0,0 +1,25 @@
+import subprocess
+import sys
+import pytest
+
+
+def imported(statement):
+    return subprocess.check_output([sys.executable, "-c", "{}; import sys; print(sorted(sys.modules))".format(statement)], text=True)
+
+
+@pytest.mark.parametrize("module", ["starcoder", "starcoder.registry", "starcoder.schema", "starcoder.dataset", "starcoder.splitters", "starcoder.tabular", "starcoder.batchifiers"])
+def test_data_modules_do_not_import_torch(module):
+    assert "'torch'" not in imported("import {}".format(module))
+
+
+def test_schema_and_splitting_do_not_import_torch():
+    statement = "; ".join(["from starcoder.synthetic import generate",
+                           "from starcoder.schema import Schema",
+                           "from starcoder.dataset import Dataset",
+                           "from starcoder.splitters import HashComponents",
+                           "spec, entities = generate(entities=50)",
+                           "schema = Schema(spec)",
+                           "[schema.observe_entity(e) for e in entities]",
+                           "data = Dataset(schema, entities)",
+                           "splits = list(HashComponents(['--proportions', '0.8', '0.2'])(data))"])
+    assert "'torch'" not in imported(statement)
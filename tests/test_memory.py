@@ -0,0 +1,41 @@
+import json
+import pytest
+from starcoder.ensemble import GraphAutoencoder
+from starcoder.batchifiers import BudgetComponents
+from starcoder.memory import CostModel, measure_batch
+from starcoder.utils import stack_batch
+
+
+def test_cost_model_fits_measurements(build):
+    schema, data = build()
+    model = GraphAutoencoder(schema, 1, [16, 8])
+    cost_model = CostModel.calibrate(model, data, batch_sizes=[8, 16, 32, 64], repeats=2)
+    assert (cost_model.coefficients >= 0).all()
+    entities, adjacencies = stack_batch([data.component(i) for i in range(10)], schema)
+    summary = cost_model.summarize([e for i in range(10) for e in data.component(i)[0]])
+    predicted = cost_model.predict(summary)
+    measured = measure_batch(model, entities, adjacencies)
+    assert abs(predicted - measured) / measured < 0.5
+    restored = CostModel(schema)
+    restored.load_state_dict(json.loads(json.dumps(cost_model.state_dict())))
+    assert restored.predict(summary) == predicted
+
+
+def test_budget_components(build):
+    schema, data = build()
+    model = GraphAutoencoder(schema, 1, [16, 8])
+    batchifier = BudgetComponents([])
+    with pytest.raises(Exception):
+        next(iter(batchifier(data, 64)))
+    cost_model = batchifier.calibrate(model, data, batch_sizes=[8, 16, 32], repeats=1)
+    budget = cost_model.predict(cost_model.summarize([data[i] for i in range(20)]))
+    batchifier.memory_budget = budget
+    batchifier.memory_margin = 0.0
+    ids = []
+    for entities, _ in batchifier(data, 64):
+        batch = [data[data.id_to_index[schema.id_field.decode(i)]] for i in entities[schema.id_field.name]]
+        assert len(batch) <= 64
+        # a batch only goes over budget if it's a single component
+        assert cost_model.predict(cost_model.summarize(batch)) <= budget or data.subselect_entities_by_id([e["id"] for e in batch]).num_components == 1
+        ids += [e["id"] for e in batch]
+    assert sorted(ids) == sorted(data.id_to_index.keys())
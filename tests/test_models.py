@@ -0,0 +1,160 @@
+import random
+import pytest
+import torch
+from starcoder.ensemble import GraphAutoencoder, OutputSpec
+from starcoder.batchifiers import SampleComponents
+from starcoder.models import LossEngine, sequence_loss
+from starcoder.registry import summarizer_classes
+from starcoder.trainer import Trainer
+
+
+def train_step(model, data, batch_size=32):
+    """
+    Run a forward and backward pass on one batch, returning the loss.
+    """
+    entities, adjacencies = next(iter(SampleComponents([])(data, batch_size)))
+    output = model(entities, adjacencies)
+    loss, _ = LossEngine(model.field_losses)(entities, output.reconstructions, output.field_masks)
+    loss.backward()
+    assert torch.isfinite(loss)
+    assert any([p.grad != None for p in model.parameters()])
+    return loss
+
+
+@pytest.mark.parametrize("kernel_size", [2, 3, 4])
+def test_convolutional_encoder(build, kernel_size):
+    schema, data = build(field_args={"type1_text0" : {"encoder" : "convolutional", "kernel_size" : kernel_size, "dilations" : [1, 2]}})
+    model = GraphAutoencoder(schema, 1, [16, 8])
+    train_step(model, data)
+    encoder = model.field_encoders["type1_text0"]
+    x = torch.tensor([[1, 2, 3, 4, 5, 0], [0, 0, 0, 0, 0, 0]])
+    y = encoder(x)
+    assert y.shape == (2, encoder.output_size)
+    assert (y[1] == 0).all()
+
+
+def test_loss_engine_matches_field_losses(build):
+    schema, data = build()
+    model = GraphAutoencoder(schema, 1, [16, 8])
+    entities, adjacencies = next(iter(SampleComponents([])(data, 32)))
+    output = model(entities, adjacencies)
+    _, losses = LossEngine(model.field_losses)(entities, output.reconstructions, output.field_masks)
+    for field_name, loss in model.field_losses.items():
+        if type(loss).__name__ in ["NumericLoss", "SequentialLoss"]:
+            assert torch.allclose(losses[field_name], loss(output.reconstructions[field_name], entities[field_name]))
+
+
+def test_sequence_loss_masks():
+    x = torch.log_softmax(torch.randn(3, 5, 4), dim=2)
+    target = torch.tensor([[1, 2, 0, 0, 0], [3, 0, 0, 0, 0], [0, 0, 0, 0, 0]])
+    # what the model predicts after the first padding position doesn't matter
+    y = x.clone()
+    y[0, 3:] = 0.0
+    y[1, 2:] = 0.0
+    assert torch.allclose(sequence_loss(x, target), sequence_loss(y, target))
+    # nor does anything for an entity the mask leaves out
+    mask = torch.tensor([True, True, False])
+    y[2] = 0.0
+    assert torch.allclose(sequence_loss(x, target, mask), sequence_loss(y, target, mask))
+    assert sequence_loss(x, target, torch.tensor([False, False, False])) == 0.0
+
+
+@pytest.mark.parametrize("precision", ["float32", "bfloat16"])
+@pytest.mark.parametrize("embedding_args", [{}, {"embedding_cutoffs" : [2, 6]}, {"hash_buckets" : 8}])
+def test_precision_with_embeddings(build, precision, embedding_args):
+    schema, data = build(field_args={"type0_categorical0" : embedding_args, "type1_text0" : embedding_args})
+    model = GraphAutoencoder(schema, 1, [16, 8], precision=precision)
+    train_step(model, data)
+
+
+@pytest.mark.parametrize("summarizer", list(summarizer_classes))
+def test_summarizers(build, summarizer):
+    schema, data = build()
+    model = GraphAutoencoder(schema, 2, [16, 8], reverse_relations=True, summarizers=summarizer_classes[summarizer])
+    train_step(model, data)
+
+
+def test_parallel_workers_match_serial(build):
+    schema, data = build()
+    serial = GraphAutoencoder(schema, 2, [16, 8], reverse_relations=True)
+    parallel = GraphAutoencoder(schema, 2, [16, 8], reverse_relations=True, parallel_workers=3)
+    parallel.load_state_dict(serial.state_dict())
+    entities, adjacencies = next(iter(SampleComponents([])(data, 32)))
+    expected = serial(entities, adjacencies)
+    actual = parallel(entities, adjacencies)
+    assert torch.allclose(expected.bottlenecks, actual.bottlenecks)
+    for field_name in schema.data_fields:
+        assert torch.allclose(expected.reconstructions[field_name], actual.reconstructions[field_name])
+    train_step(parallel, data)
+
+
+def test_output_spec_selects_rows_and_fields(build):
+    schema, data = build()
+    model = GraphAutoencoder(schema, 1, [16, 8])
+    model.eval()
+    entities, adjacencies = next(iter(SampleComponents([])(data, 32)))
+    with torch.no_grad():
+        full = model(entities, adjacencies)
+        selected = model(entities, adjacencies, OutputSpec(fields=["type0_numeric0"], bottlenecks=False, entity_types=["type0"]))
+    rows = entities[schema.entity_type_field.name] == schema.entity_type_field.encode("type0")
+    assert set(selected.reconstructions.keys()) == set(["type0_numeric0", schema.id_field.name, schema.entity_type_field.name])
+    assert selected.bottlenecks == None
+    assert torch.equal(selected.reconstructions[schema.id_field.name], entities[schema.id_field.name][rows])
+    assert torch.allclose(selected.reconstructions["type0_numeric0"], full.reconstructions["type0_numeric0"][rows])
+    assert torch.equal(selected.field_masks["type0_numeric0"], full.field_masks["type0_numeric0"][rows])
+    with pytest.raises(Exception):
+        model(entities, adjacencies, OutputSpec(fields=["unknown"]))
+
+
+def test_adaptive_decoder(build):
+    schema, data = build(field_args={"type0_categorical0" : {"decoder" : "adaptive", "cutoffs" : [2, 4]}})
+    model = GraphAutoencoder(schema, 1, [16, 8])
+    train_step(model, data)
+    decoder = model._field_decoders["type0_categorical0"]
+    decoder.eval()
+    x = torch.randn(10, decoder.input_size)
+    with torch.no_grad():
+        log_probs = decoder(x)
+        values, codes = decoder.topk(x, 3)
+    assert torch.allclose(log_probs.exp().sum(1), torch.ones(10), atol=1e-5)
+    expected = log_probs.topk(3, dim=1)
+    assert torch.allclose(values, expected.values, atol=1e-5)
+    assert torch.equal(log_probs.gather(1, codes), values)
+
+
+def test_checkpoint_depths_match_gradients(build):
+    schema, data = build()
+    plain = GraphAutoencoder(schema, 2, [16, 8], reverse_relations=True)
+    checkpointed = GraphAutoencoder(schema, 2, [16, 8], reverse_relations=True, checkpoint_depths=True)
+    checkpointed.load_state_dict(plain.state_dict())
+    random.seed(1)
+    expected = train_step(plain, data)
+    random.seed(1)
+    actual = train_step(checkpointed, data)
+    assert torch.allclose(expected, actual)
+    for p, q in zip(plain.parameters(), checkpointed.parameters()):
+        assert (p.grad == None) == (q.grad == None)
+        if p.grad != None:
+            assert torch.allclose(p.grad, q.grad, atol=1e-6)
+
+
+def test_layer_losses_are_opt_in(build):
+    schema, data = build()
+    model = GraphAutoencoder(schema, 1, [16, 8])
+    entities, adjacencies = next(iter(SampleComponents([])(data, 32)))
+    assert model(entities, adjacencies).layer_losses == {}
+    layer_losses = model(entities, adjacencies, OutputSpec(layer_losses=True)).layer_losses
+    assert set(layer_losses.keys()) == set([(t, d) for t in schema.entity_types for d in [0, 1]])
+    sum(layer_losses.values()).backward()
+    assert any([p.grad != None for p in model._entity_autoencoders.parameters()])
+
+
+def test_trainer_autoencoder_loss(build):
+    schema, data = build()
+    model = GraphAutoencoder(schema, 1, [16, 8])
+    random.seed(0)
+    without = Trainer(model, SampleComponents([]), batch_size=32, optimizer=torch.optim.SGD(model.parameters(), lr=0.0)).evaluate(data)[0]
+    random.seed(0)
+    trainer = Trainer(model, SampleComponents([]), batch_size=32, optimizer=torch.optim.SGD(model.parameters(), lr=0.0), autoencoder_loss=1.0)
+    assert trainer.outputs.layer_losses
+    assert trainer.evaluate(data)[0] > without
@@ -0,0 +1,36 @@
+import torch
+from starcoder.ensemble import GraphAutoencoder
+from starcoder.batchifiers import SampleComponents
+from starcoder.models import LossEngine
+from starcoder.optimizers import SparseDenseOptimizer, split_parameters
+from starcoder.trainer import Trainer
+
+
+def test_sparse_embeddings(build):
+    schema, data = build()
+    model = GraphAutoencoder(schema, 1, [16, 8], sparse_embeddings=True)
+    sparse, dense = split_parameters(model)
+    assert len(sparse) > 0 and len(dense) > 0
+    optimizer = SparseDenseOptimizer(model, lr=0.01)
+    assert len(optimizer.param_groups) == 2
+    before = [p.detach().clone() for p in sparse]
+    entities, adjacencies = next(iter(SampleComponents([])(data, 32)))
+    output = model(entities, adjacencies)
+    loss, _ = LossEngine(model.field_losses)(entities, output.reconstructions, output.field_masks)
+    loss.backward()
+    assert all([p.grad.is_sparse for p in sparse if p.grad != None])
+    optimizer.step()
+    # only the embedding rows the batch used are updated
+    changed = [(b != p).any(1) for b, p in zip(before, sparse)]
+    assert any([c.any() for c in changed])
+    assert not all([c.all() for c in changed])
+    optimizer.zero_grad()
+    assert all([p.grad == None for p in sparse + dense])
+
+
+def test_trainer_picks_sparse_dense_optimizer(build):
+    schema, data = build()
+    trainer = Trainer(GraphAutoencoder(schema, 1, [16, 8], sparse_embeddings=True), SampleComponents([]), batch_size=32)
+    assert isinstance(trainer.optimizer, SparseDenseOptimizer)
+    history = trainer.fit(data, data, 1)
+    assert history[0]["dev_loss"] > 0
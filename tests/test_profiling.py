@@ -0,0 +1,27 @@
+import json
+import os
+from starcoder.ensemble import GraphAutoencoder
+from starcoder.batchifiers import SampleComponents
+from starcoder.models import LossEngine
+from starcoder import profiling
+
+
+def test_profiler_records_stages(build, tmp_path):
+    schema, data = build()
+    model = GraphAutoencoder(schema, 1, [16, 8])
+    with profiling.Profiler() as profiler:
+        entities, adjacencies = next(iter(SampleComponents([])(data, 32)))
+        output = model(entities, adjacencies)
+        LossEngine(model.field_losses)(entities, output.reconstructions, output.field_masks)[0].backward()
+    stages = set([s["stage"] for s in profiler.summary()])
+    assert set(["subselect", "components", "stack_batch", "tensorize", "indices", "encode", "autoencoder", "project", "decode"]) <= stages
+    assert set(profiler.totals("field").keys()) >= set(schema.data_fields.keys())
+    assert all([s["bytes"] > 0 for s in profiler.summary() if s["stage"] == "decode"])
+    profiler.save_json(os.path.join(tmp_path, "profile.json"))
+    profiler.save_chrome_trace(os.path.join(tmp_path, "trace.json"))
+    with open(os.path.join(tmp_path, "trace.json"), "rt") as ifd:
+        assert len(json.load(ifd)["traceEvents"]) == len(profiler.events)
+    # outside of the profiler, stages cost nothing and record nothing
+    calls = sum([s["calls"] for s in profiler.summary()])
+    model(entities, adjacencies)
+    assert sum([s["calls"] for s in profiler.summary()]) == calls
@@ -0,0 +1,21 @@
+import subprocess
+import sys
+from starcoder.ensemble import GraphAutoencoder
+from starcoder.batchifiers import SampleComponents
+from starcoder.quantization import quantize, quantization_report
+
+
+def test_quantize(build):
+    schema, data = build()
+    model = GraphAutoencoder(schema, 1, [16, 8])
+    quantized = quantize(model)
+    entities, adjacencies = next(iter(SampleComponents([])(data, 32)))
+    report = quantization_report(model, quantized, entities, adjacencies, repeats=1)
+    assert report["quantized_bytes"] < report["float_bytes"]
+    assert report["drift"]["bottlenecks"]["relative_difference"] < 0.5
+
+
+def test_quantization_does_not_import_benchmarks():
+    modules = subprocess.check_output([sys.executable, "-c", "import sys, starcoder.quantization; print(sorted(sys.modules))"], text=True)
+    assert "starcoder.benchmarks" not in modules
+    assert "starcoder.trainer" not in modules
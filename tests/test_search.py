@@ -0,0 +1,38 @@
+import json
+import os
+import pytest
+from starcoder.search import Search
+from starcoder.synthetic import generate
+
+
+def make_search(directory, space, **args):
+    search = Search(directory, space, min_epochs=1, max_epochs=3, reduction_factor=3, max_trials=3, workers=1, batch_size=32, **args)
+    spec, entities = generate(entities=60, component_size=6, text_length=6)
+    search.prepare(spec, entities[:40], entities[40:])
+    return search
+
+
+def test_search_and_resume(tmp_path):
+    directory = os.path.join(tmp_path, "search")
+    space = {"summarizers" : ["single", "rnn"], "depth" : [1], "autoencoder_shapes" : [[8, 4]]}
+    best = make_search(directory, space).run()
+    with open(os.path.join(directory, "search.json"), "rt") as ifd:
+        trials = json.load(ifd)["trials"]
+    assert len(trials) == 3
+    assert all([t["status"] != "failed" for t in trials.values()])
+    assert best["epochs"] == 3
+    assert os.path.exists(os.path.join(directory, "trials", best["id"], "checkpoint", "model.pt"))
+    # a finished search has nothing left to do when it's run again
+    resumed = make_search(directory, space)
+    assert resumed.run() == best
+    assert resumed.trials == trials
+
+
+@pytest.mark.parametrize("space", [{"summarizers" : ["nonexistent"]},
+                                   {"activation" : ["NotAnActivation"]},
+                                   {"batchifier" : ["nonexistent"]},
+                                   {"depth" : []},
+                                   {"unknown" : [1]}])
+def test_bad_spaces_fail_at_setup(tmp_path, space):
+    with pytest.raises(Exception):
+        Search(os.path.join(tmp_path, "search"), space)
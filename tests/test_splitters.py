@@ -0,0 +1,46 @@
+import json
+import os
+import random
+from starcoder.splitters import HashComponents, SampleComponents, read_entities
+from starcoder.dataset import Dataset
+
+
+def test_hash_components_are_order_independent(build):
+    schema, data = build(entities=300)
+    splitter = HashComponents(["--proportions", "0.8", "0.1", "0.1"])
+    splits = [set([data.index_to_id[i] for i in indices]) for indices in splitter(data)]
+    entities = [data[i] for i in range(len(data))]
+    random.Random(0).shuffle(entities)
+    shuffled = Dataset(schema, entities)
+    assert splits == [set([shuffled.index_to_id[i] for i in indices]) for indices in splitter(shuffled)]
+    assert sum([len(s) for s in splits]) == len(data)
+    # components aren't divided between splits
+    for c in range(data.num_components):
+        ids = set([data.index_to_id[i] for i in data.component_indices(c)])
+        assert sum([len(ids & s) > 0 for s in splits]) == 1
+
+
+def test_hash_components_leave_out_the_remainder(build):
+    schema, data = build(entities=1200)
+    splits = list(HashComponents(["--proportions", "0.5", "0.1"])(data))
+    assert abs(len(splits[0]) / len(data) - 0.5) < 0.1
+    assert abs(len(splits[1]) / len(data) - 0.1) < 0.05
+    # proportions summing to more than one are rescaled, as for other splitters
+    assert HashComponents(["--proportions", "2", "1", "1"]).proportions == [0.5, 0.25, 0.25]
+    assert SampleComponents(["--proportions", "0.5", "0.1"]).proportions[0] > 0.8
+
+
+def test_split_files(build, tmp_path):
+    schema, data = build(entities=300)
+    path = os.path.join(tmp_path, "entities.jsonl")
+    with open(path, "wt") as ofd:
+        for i in range(len(data)):
+            ofd.write(json.dumps(data[i]) + "\n")
+    splitter = HashComponents(["--proportions", "0.5", "0.2", "--shard_size", "50"])
+    files = splitter.split_files(schema, [path], os.path.join(tmp_path, "splits"))
+    assert sorted(files.keys()) == ["dev", "train"]
+    expected = list(splitter(data))
+    for name, indices in zip(["train", "dev"], expected):
+        ids = [e["id"] for e in read_entities(files[name])]
+        assert sorted(ids) == sorted([data.index_to_id[i] for i in indices])
+        assert all([len(list(read_entities([p]))) <= 50 for p in files[name]])
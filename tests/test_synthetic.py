@@ -0,0 +1,29 @@
+from starcoder.schema import Schema
+from starcoder.dataset import Dataset
+from starcoder.synthetic import generate
+from starcoder.benchmarks import benchmark_pipeline, compare
+
+
+def test_generate_is_deterministic():
+    spec, entities = generate(entities=50, component_size=5, text_length=8, seed=3)
+    assert (spec, entities) == generate(entities=50, component_size=5, text_length=8, seed=3)
+    assert entities != generate(entities=50, component_size=5, text_length=8, seed=4)[1]
+
+
+def test_components_are_bounded():
+    spec, entities = generate(entities=60, component_size=6, text_length=8)
+    schema = Schema(spec)
+    for entity in entities:
+        schema.observe_entity(entity)
+    data = Dataset(schema, entities)
+    assert len(data) == 60
+    assert max([len(data.component_indices(i)) for i in range(data.num_components)]) <= 6
+
+
+def test_benchmark_pipeline_and_compare():
+    results = benchmark_pipeline(scales=[60], batch_size=16, batches=1, component_size=6, text_length=8)
+    assert results["60"]["schema_seconds"] >= 0
+    slower = {"60" : {k : v * 2 if "seconds" in k else v for k, v in results["60"].items() if isinstance(v, (int, float))}}
+    regressions = [r for r in compare(slower, results) if r["regression"]]
+    assert len(regressions) > 0
+    assert not any([r["regression"] for r in compare(results, results)])
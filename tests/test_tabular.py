@@ -0,0 +1,83 @@
+import csv
+import os
+import pytest
+import torch
+from starcoder.schema import Schema
+from starcoder.dataset import Dataset, EntityColumns
+from starcoder.tabular import read_csv
+from starcoder.batchifiers import SampleComponents, SampleEntities, SampleSnowflakes
+from starcoder.synthetic import generate
+from starcoder.utils import stack_batch
+
+
+@pytest.fixture
+def tables(tmp_path):
+    """
+    The same synthetic entities as a JSON-style Dataset and, read from a CSV file per entity
+    type, a columnar one.
+    """
+    spec, entities = generate(entities=200, component_size=6, text_length=8)
+    json_schema = Schema(spec)
+    for entity in entities:
+        json_schema.observe_entity(entity)
+    json_data = Dataset(json_schema, entities)
+    csv_schema = Schema(spec)
+    table = EntityColumns()
+    for entity_type, entity_spec in spec["entity_types"].items():
+        columns = ["id"] + entity_spec["data_fields"] + [k for k, v in spec["relation_fields"].items() if v["source_entity_type"] == entity_type]
+        path = os.path.join(tmp_path, "{}.csv".format(entity_type))
+        with open(path, "wt", newline="") as ofd:
+            writer = csv.writer(ofd)
+            writer.writerow(columns)
+            for entity in entities:
+                if entity["entity_type"] == entity_type:
+                    writer.writerow([repr(entity[c]) if isinstance(entity.get(c), float) else entity.get(c, "") for c in columns])
+        table.extend(read_csv(csv_schema, path, entity_type=entity_type, chunk_size=32))
+    return (json_data, Dataset(csv_schema, table))
+
+
+def test_csv_matches_json(tables):
+    json_data, csv_data = tables
+    json_state = json_data.schema.state_dict()["fields"]
+    csv_state = csv_data.schema.state_dict()["fields"]
+    assert json_state == csv_state
+    assert json_data.num_components == csv_data.num_components
+    by_id = {json_data.index_to_id[i] : json_data[i] for i in range(len(json_data))}
+    for i in range(len(csv_data)):
+        assert csv_data[i] == by_id[csv_data[i]["id"]]
+
+
+def test_columnar_batches_match(tables):
+    json_data, csv_data = tables
+    indices = list(range(0, len(csv_data), 3))
+    ids = [csv_data.index_to_id[i] for i in indices]
+    csv_subset = csv_data.subselect_entities_by_index(indices)
+    json_subset = json_data.subselect_entities_by_id(ids)
+    assert isinstance(csv_subset._entities, EntityColumns)
+    csv_entities, csv_adjacencies = stack_batch([csv_subset.component(i) for i in range(csv_subset.num_components)], csv_data.schema)
+    json_entities, json_adjacencies = stack_batch([json_subset.component(i) for i in range(json_subset.num_components)], json_data.schema)
+    csv_order = [csv_data.schema.id_field.decode(i) for i in csv_entities["id"]]
+    json_order = [json_data.schema.id_field.decode(i) for i in json_entities["id"]]
+    assert sorted(csv_order) == sorted(json_order)
+    # the two datasets may order components differently, so rows are compared by id
+    permutation = torch.tensor([json_order.index(i) for i in csv_order])
+    for k in json_data.schema.data_fields:
+        expected = json_entities[k][permutation]
+        actual = csv_entities[k]
+        if expected.is_floating_point():
+            assert torch.equal(torch.isnan(expected), torch.isnan(actual))
+            assert torch.equal(torch.nan_to_num(expected), torch.nan_to_num(actual))
+        else:
+            assert torch.equal(expected[:, :actual.shape[1]] if expected.dim() > 1 else expected, actual)
+    for k, adjacency in json_adjacencies.items():
+        assert torch.equal(adjacency[permutation][:, permutation], csv_adjacencies[k])
+
+
+@pytest.mark.parametrize("batchifier", [SampleComponents([]), SampleEntities([]), SampleSnowflakes([])])
+def test_columnar_batches_build_no_entities(tables, monkeypatch, batchifier):
+    _, csv_data = tables
+    def fail(self, index):
+        raise AssertionError("built an entity")
+    monkeypatch.setattr(EntityColumns, "__getitem__", fail)
+    batches = list(batchifier(csv_data, 32))
+    assert sum([len(e["id"]) for e, _ in batches]) >= len(csv_data) // 2
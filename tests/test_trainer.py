@@ -0,0 +1,65 @@
+import pytest
+import torch
+from starcoder.ensemble import GraphAutoencoder
+from starcoder.batchifiers import SampleComponents
+from starcoder.trainer import Trainer, Prefetcher
+
+
+def test_fit(build):
+    schema, data = build()
+    model = GraphAutoencoder(schema, 1, [16, 8])
+    trainer = Trainer(model, SampleComponents([]), batch_size=32)
+    history = trainer.fit(data, data, 2)
+    assert len(history) == 2
+    assert all([h["dev_loss"] > 0 for h in history])
+
+
+def test_prefetcher_stops_when_iteration_stops_early(build):
+    _, data = build()
+    prefetcher = Prefetcher(SampleComponents([]), data, 4, size=1, poll_seconds=0.01)
+    for _ in prefetcher:
+        break
+    prefetcher._thread.join(timeout=5)
+    assert not prefetcher._thread.is_alive()
+
+
+def test_prefetcher_stops_when_the_consumer_raises(build):
+    _, data = build()
+    prefetcher = Prefetcher(SampleComponents([]), data, 4, size=1, poll_seconds=0.01)
+    with pytest.raises(ValueError):
+        for _ in prefetcher:
+            raise ValueError()
+    prefetcher._thread.join(timeout=5)
+    assert not prefetcher._thread.is_alive()
+
+
+def test_prefetcher_reraises_batchifier_errors(build):
+    _, data = build()
+    def batchifier(data, batch_size):
+        yield from SampleComponents([])(data, batch_size)
+        raise ValueError()
+    with pytest.raises(ValueError):
+        list(Prefetcher(batchifier, data, 32))
+
+
+def test_gradient_accumulation_averages_short_last_group(build):
+    schema, data = build()
+    batches = list(SampleComponents([])(data, 16))[:4]
+    def first_three(data, batch_size):
+        return iter(batches[:3])
+    def last(data, batch_size):
+        return iter(batches[3:])
+    def all_four(data, batch_size):
+        return iter(batches)
+    accumulated = GraphAutoencoder(schema, 1, [16, 8])
+    separate = GraphAutoencoder(schema, 1, [16, 8])
+    separate.load_state_dict(accumulated.state_dict())
+    # with plain SGD, accumulating over 4 batches in groups of 3 is a step on the mean of the first
+    # three batches' gradients, then one on the last batch's
+    def trainer(model, batchifier, gradient_accumulation):
+        return Trainer(model, batchifier, optimizer=torch.optim.SGD(model.parameters(), lr=0.1), gradient_accumulation=gradient_accumulation, prefetch=0)
+    trainer(accumulated, all_four, 3).train_epoch(data)
+    trainer(separate, first_three, 3).train_epoch(data)
+    trainer(separate, last, 1).train_epoch(data)
+    for p, q in zip(accumulated.parameters(), separate.parameters()):
+        assert torch.allclose(p, q, atol=1e-6)